@@ -412,7 +412,9 @@ function refreshAllDropdowns() {
      r.getRange(START_ROW_RULES, COL_TAB_SOURCE, lr, 1).setDataValidation(SpreadsheetApp.newDataValidation().requireValueInList(tn, true).build());
      const op = r.getRange(START_ROW_RULES, COL_OPERATOR, lr, 1);
      op.setNumberFormat('@');  
-     op.setDataValidation(SpreadsheetApp.newDataValidation().requireValueInList([">", "<", ">=", "<=", "'="], true).build());
+     // Windowed operators (server-side rolling aggregates): agg(N m|h|d) op, e.g. "mean(2h) <"
+     const windowed = ["mean(2h) <", "mean(2h) >", "min(6h) <", "max(24h) >", "sum(24h) >", "slope(6h) <", "slope(6h) >"];
+     op.setDataValidation(SpreadsheetApp.newDataValidation().requireValueInList([">", "<", ">=", "<=", "'="].concat(windowed), true).setAllowInvalid(true).build());
   }
 }
 
@@ -1,9 +1,9 @@
 /**
  * =========================================================================
- * 🧪 AI DIAGNOSIS SIMULATOR (OFFLINE BAYESIAN ENGINE)
+ * 🧪 AI DIAGNOSIS SIMULATOR (SERVER-SCORED BAYESIAN ENGINE)
  * =========================================================================
- * This script runs entirely in Google Sheets and provides a realtime
- * toggle-based UI to test the Matrix Diagnosis logic and check Bayesian scores.
+ * Realtime toggle-based UI in Google Sheets to test the Matrix Diagnosis logic.
+ * Scoring runs on the bot (/api/simulate) against the compiled, weighted matrix.
  */
 
 function openSimulatorUI() {
@@ -73,7 +73,7 @@ function openSimulatorUI() {
       </div>
 
       <script>
-        let db = { parameters: [], diseases: [], totalFreq: 1 };
+        let db = { parameters: [] };
         let states = {}; // holds 'P', 'F', 'x'
 
         // Load Data
@@ -121,55 +121,26 @@ function openSimulatorUI() {
                 if(s !== 'x') snapshotText.push(\`\${p}=\${snapshot[p]}\`);
             });
 
-            const DEPTH_CAP = 6;
-            const W_DATA = 0.7;
-            const W_PRIOR = 0.3;
-
-            let results = [];
-
-            db.diseases.forEach(d => {
-                let totalCond = 0;
-                let matchedCond = 0;
-                let logs = [];
-
-                for (let param in d.reqs) {
-                    let reqVal = d.reqs[param];
-                    if (reqVal === 'PASS' || reqVal === 'FAIL') {
-                        totalCond++;
-                        if (snapshot[param] === reqVal) {
-                            matchedCond++;
-                            // Hitungan kasar matematika untuk tampilan log per item
-                            let pointEstim = (100 * W_DATA) / Math.max(totalCond, 1); 
-                            logs.push(\`<div class="log-good">✓ [\${param}] MATCH (\${reqVal})  (+\${pointEstim.toFixed(2)})</div>\`);
-                        } else {
-                            logs.push(\`<div class="log-bad">✗ [\${param}] MISS (Harusnya \${reqVal})</div>\`);
-                        }
-                    }
-                }
-
-                if (totalCond > 0) {
-                    let matchRatio = (matchedCond / totalCond) * 100;
-                    let depthWeight = Math.min(totalCond, DEPTH_CAP) / DEPTH_CAP;
-                    let weightedScore = matchRatio * depthWeight;
-                    
-                    let prior = d.freq / db.totalFreq;
-                    let priorScore = prior * 100;
-                    
-                    let finalScore = (weightedScore * W_DATA) + (priorScore * W_PRIOR);
-
-                    results.push({
-                        name: d.name,
-                        score: finalScore,
-                        basePrior: priorScore * W_PRIOR,
-                        weighted: weightedScore * W_DATA,
-                        freq: d.freq,
-                        logs: logs
-                    });
-                }
-            });
+            // Scoring dilakukan server (matrix terkompilasi di bot, /api/simulate)
+            document.getElementById('logContent').innerHTML = '⏳ Menghitung di server...';
+            google.script.run
+                .withSuccessHandler(results => renderResults(results, snapshotText))
+                .withFailureHandler(err => {
+                    document.getElementById('logContent').innerHTML = \`<div class="log-bad">⚠️ \${err.message || err}</div>\`;
+                })
+                .simulateOnServer(snapshot);
+        }
 
-            // URUTKAN DESCENDING
-            results.sort((a,b) => b.score - a.score);
+        function renderResults(ranked, snapshotText) {
+            let results = ranked.map(r => ({
+                name: r.diagnosis,
+                score: r.final_score,
+                basePrior: r.prior_points,
+                freq: r.frequency,
+                logs: r.contributions.map(c => c.matched
+                    ? \`<div class="log-good">✓ [\${c.param}] MATCH (\${c.required})  (+\${c.points.toFixed(2)}, bobot \${c.weight})</div>\`
+                    : \`<div class="log-bad">✗ [\${c.param}] MISS (Harusnya \${c.required}, bobot \${c.weight})</div>\`)
+            }));
 
             // RENDER JENDELA KANAN
             const rList = document.getElementById('resultsList');
@@ -228,7 +199,8 @@ function openSimulatorUI() {
 
 /** 
  * Fungsi Backend untuk Simulator
- * Menarik susunan Matrix dari Spreadsheet 
+ * Hanya menarik daftar parameter dari header Matrix (Baris 1).
+ * Scoring dilakukan bot lewat simulateOnServer() -> /api/simulate.
  */
 function getMatrixLogicForSimulator() {
   const ss = SpreadsheetApp.getActiveSpreadsheet();
@@ -236,33 +208,33 @@ function getMatrixLogicForSimulator() {
   if (!mSheet) return { error: "Matrix not found" };
   
   const lastCol = mSheet.getLastColumn();
-  const lastRow = mSheet.getLastRow();
-  if (lastCol < 4 || lastRow < 3) return { parameters: [], diseases: [], totalFreq: 1 };
+  if (lastCol < 4) return { parameters: [] };
   
-  // Baca nama parameter dari header Matrix (Baris 1)
   const headers = mSheet.getRange(1, 4, 1, lastCol - 3).getValues()[0].map(h => h.toString().trim());
   const parameters = headers.filter(h => h && !h.toLowerCase().includes("cost"));
-  
-  // Baca isi Matrix (Mulai baris 3)
-  const data = mSheet.getRange(3, 1, lastRow - 2, lastCol).getValues();
-  let diseases = [];
-  let totalFreq = 0;
-  
-  data.forEach(row => {
-     let diag = row[2].toString().trim();
-     if (!diag || diag.startsWith("COST") || diag === "-") return;
-     let freq = parseFloat(row[1]) || 0;
-     totalFreq += freq; // Hitung Prior
-     
-     let reqs = {};
-     headers.forEach((h, i) => {
-        if (!h.toLowerCase().includes("cost")) {
-           reqs[h] = row[3 + i].toString().trim().toUpperCase();
-        }
-     });
-     
-     diseases.push({ name: diag, freq: freq, reqs: reqs });
+  return { parameters: parameters };
+}
+
+/**
+ * Kirim snapshot ke bot (NGROK_URL dari server.gs) dan kembalikan ranking top 5
+ * lengkap dengan kontribusi per kondisi.
+ * Butuh Script Property BOT_API_TOKEN (sama dengan env BOT_API_TOKEN di server bot).
+ */
+function simulateOnServer(snapshot) {
+  const token = PropertiesService.getScriptProperties().getProperty("BOT_API_TOKEN");
+  if (!token) {
+    throw new Error("Script Property BOT_API_TOKEN belum diisi (Project Settings > Script Properties)");
+  }
+  const resp = UrlFetchApp.fetch(NGROK_URL + "/api/simulate", {
+    method: "post",
+    contentType: "application/json",
+    headers: { "X-Bot-Token": token },
+    payload: JSON.stringify({ snapshots: [snapshot], top_k: 5 }),
+    muteHttpExceptions: true
   });
-  
-  return { parameters: parameters, diseases: diseases, totalFreq: totalFreq || 1 };
+  const data = JSON.parse(resp.getContentText() || "{}");
+  if (resp.getResponseCode() !== 200) {
+    throw new Error("Simulator server error: " + (data.error || resp.getResponseCode()));
+  }
+  return data.results[0].ranked;
 }
@@ -15,6 +15,21 @@ function sendWebhook(endpoint, payload) {
   }
 }
 
+// Baris terakhir sheet sebagai {header: nilai}: server bisa cek Low DO / Listrik Mati
+// langsung dari payload, sebelum membaca Sheets
+function lastRowValues(sheet) {
+  if (!sheet) return null;
+  var lastRow = sheet.getLastRow(), lastCol = sheet.getLastColumn();
+  if (lastRow < 2 || lastCol < 1) return null;
+  var headers = sheet.getRange(1, 1, 1, lastCol).getDisplayValues()[0];
+  var row = sheet.getRange(lastRow, 1, 1, lastCol).getDisplayValues()[0];
+  var values = {};
+  for (var i = 0; i < headers.length; i++) {
+    if (headers[i] !== "") values[headers[i]] = row[i];
+  }
+  return values;
+}
+
 // TRIGGER ON CHANGE
 function notifyBot(e) {
   // CARA DETEKSI SHEET YANG LEBIH AKURAT UNTUK API
@@ -35,7 +50,10 @@ function notifyBot(e) {
   // 2. Jika Water Quality -> Sensor Webhook
   // [MODIFIKASI] Kita buat lebih longgar, jika mengandung kata "Water" atau "Quality"
   else if (sheetName.indexOf("Water") > -1 || sheetName.indexOf("Control") > -1) {
-     sendWebhook("/webhook/sensor-update", {"sheet": sheetName});
+     var payload = {"sheet": sheetName};
+     var values = lastRowValues(e.source.getSheetByName(sheetName));
+     if (values) payload.values = values;
+     sendWebhook("/webhook/sensor-update", payload);
   }
   
   // 3. FALLBACK: Jika Google gagal deteksi nama sheet saat API update
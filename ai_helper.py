@@ -1,13 +1,186 @@
 import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from google import genai
 from thresholds import SOP_THRESHOLDS
 from drive import get_recent_trends
+import llm_executor
+from message_splitter import StreamSplitter
 
 # Twilio numbers of experts who should receive alerts
 EXPERT_NUMBERS = ["+6281224982768"] # [MODIFIKASI] Nomor Pakar diganti ke user
 
 # Configure Gemini
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+# Every call goes through llm_executor (RPM/TPM budget, retry-after); client timeout is in ms
+client = genai.Client(
+    api_key=os.getenv("GEMINI_API_KEY"),
+    http_options={"timeout": int(llm_executor.LLM_CONFIG["call_timeout_s"] * 1000)}
+)
+GEMINI_MODEL = 'gemini-2.0-flash'
+OUTPUT_TOKEN_ESTIMATE = 400  # Budgeted per call on top of the prompt, settled from usage_metadata
+
+# === LLM RESPONSE CACHE ===
+# Prompts are normalized (whitespace collapsed, timestamps dropped, numbers rounded to
+# `number_precision` decimals) and hashed, so the same out-of-range alert arriving on every
+# sensor webhook reuses one Gemini answer. TTL + LRU bound, optional JSON file on disk.
+LLM_CACHE_CONFIG = {
+    "ttl_seconds": int(os.getenv("LLM_CACHE_TTL", "1800")),
+    "max_entries": int(os.getenv("LLM_CACHE_SIZE", "256")),
+    "number_precision": int(os.getenv("LLM_CACHE_PRECISION", "1")),
+    "disk_path": os.getenv("LLM_CACHE_PATH", ""),  # Empty = memory only
+}
+
+_TIMESTAMP_PATTERN = re.compile(r"\d{1,4}[-/]\d{1,2}[-/]\d{1,4}(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?")
+_NUMBER_PATTERN = re.compile(r"-?\d+(?:[.,]\d+)?")
+
+
+def normalize_prompt(prompt: str, precision: int = None) -> str:
+    """'DO: 3.14  mg/L @ 2026-02-20 10:00' -> 'DO: 3.1 mg/L @ <ts>' (cache key only, Gemini gets the original)."""
+    precision = LLM_CACHE_CONFIG["number_precision"] if precision is None else precision
+    text = _TIMESTAMP_PATTERN.sub("<ts>", prompt)
+
+    def bucket(m):
+        value = round(float(m.group(0).replace(",", ".")), precision)
+        return f"{value:.{precision}f}" if precision > 0 else str(int(value))
+    text = _NUMBER_PATTERN.sub(bucket, text)
+    return " ".join(text.split())
+
+
+class LLMCache:
+    """prompt hash -> (stored_at, text); LRU order, expired entries dropped on read."""
+
+    def __init__(self, config=LLM_CACHE_CONFIG):
+        self.config = config
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def key(self, model, prompt):
+        return hashlib.sha256(f"{model}\n{normalize_prompt(prompt)}".encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] >= self.config["ttl_seconds"]:
+                del self._entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.time(), text)
+            self._entries.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self._entries) > self.config["max_entries"]:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self._save()
+
+    def _load(self):
+        path = self.config["disk_path"]
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                for key, stored_at, text in json.load(f):
+                    if time.time() - stored_at < self.config["ttl_seconds"]:
+                        self._entries[key] = (stored_at, text)
+            print(f"🗄️ LLM cache: {len(self._entries)} entries loaded from {path}")
+        except Exception as e:
+            print(f"⚠️ LLM cache load failed: {e}")
+
+    def _save(self):
+        path = self.config["disk_path"]
+        if not path:
+            return
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump([[k, t, text] for k, (t, text) in self._entries.items()], f)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"⚠️ LLM cache save failed: {e}")
+
+
+llm_cache = LLMCache()
+
+
+def get_llm_cache_stats():
+    stats = dict(llm_cache.stats)
+    stats["entries"] = len(llm_cache._entries)
+    return stats
+
+
+def generate_text(prompt: str, model: str = GEMINI_MODEL, use_cache: bool = True) -> str:
+    """One-shot Gemini call through the response cache. Errors propagate (and are not cached)."""
+    key = llm_cache.key(model, prompt) if use_cache else None
+    if key:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+    response = llm_executor.call(
+        lambda: client.models.generate_content(model=model, contents=prompt),
+        est_tokens=llm_executor.estimate_tokens(prompt) + OUTPUT_TOKEN_ESTIMATE
+    )
+    text = response.text.strip()
+    if key:
+        llm_cache.put(key, text)
+    return text
+
+
+def stream_text(contents, on_message, prefix: str = "", suffix: str = "",
+                model: str = GEMINI_MODEL, use_cache: bool = True) -> str:
+    """
+    Streaming variant of generate_text: finished paragraphs go to on_message() as
+    WhatsApp-sized messages while Gemini is still generating. Returns the full text.
+    Only the request itself (up to the first chunk) is retried; a cache hit is sent at once.
+    """
+    key = llm_cache.key(model, contents) if use_cache and isinstance(contents, str) else None
+    splitter = StreamSplitter(on_message, prefix=prefix, suffix=suffix)
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        splitter.feed(cached)
+        splitter.close()
+        return cached
+
+    def start():
+        stream = client.models.generate_content_stream(model=model, contents=contents)
+        return next(stream, None), stream
+
+    (first, stream), slot = llm_executor.call(
+        start, est_tokens=llm_executor.estimate_tokens(contents) + OUTPUT_TOKEN_ESTIMATE,
+        keep_slot=True
+    )
+    parts = []
+    usage = None  # Reported on the last chunk
+    try:
+        if first is not None:
+            parts.append(first.text or "")
+            splitter.feed(parts[-1])
+            usage = getattr(first, "usage_metadata", None)
+        for chunk in stream:
+            parts.append(chunk.text or "")
+            splitter.feed(parts[-1])
+            usage = getattr(chunk, "usage_metadata", None) or usage
+    finally:
+        llm_executor.settle(slot, usage)
+    splitter.close()
+    text = "".join(parts).strip()
+    if key:
+        llm_cache.put(key, text)
+    return text
+
 
 def check_out_of_range(data):
     """Check which values fall outside SOP limits."""
@@ -55,19 +228,16 @@ def generate_recommendations(alerts, lang="en"):
     prompt += "\n\nOnly include specific, actionable suggestions based on the trends and values."
 
     try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt
-        )
-        content = response.text
-        return content.strip().split("\n")
+        content = generate_text(prompt)
+        return content.split("\n")
     except Exception as e:
         return [f"⚠️ Kesalahan AI: {e}" if lang == "id" else f"⚠️ AI error: {e}"]
 
-def generate_ai_analysis(dashboard_dict, diagnosis_result, lang="id"):
+def generate_ai_analysis(dashboard_dict, diagnosis_result, lang="id", on_message=None, prefix="", suffix=""):
     """
     Generate a more comprehensive AI narrative based on the 
     Matrix Diagnosis result and current sensor data.
+    With on_message, the narrative (wrapped in prefix/suffix) is streamed as WhatsApp messages.
     """
     prompt = (
         f"Sebagai ahli akuakultur, berikan analisis singkat untuk kondisi berikut:\n"
@@ -78,18 +248,108 @@ def generate_ai_analysis(dashboard_dict, diagnosis_result, lang="id"):
         f"MAKSIMAL 150 kata."
     )
     
+    if on_message:
+        # Streaming: errors go to the caller (it maps quota errors to a friendly message)
+        return stream_text(prompt, on_message, prefix=prefix, suffix=suffix)
     try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt
-        )
-        return response.text.strip()
+        return generate_text(prompt)
     except Exception as e:
         return f"⚠️ Gagal memuat analisa cerdas: {e}"
 
 # === INTERACTIVE COPILOT SESSIONS ===
 
-def start_do_copilot(aeration_data: dict) -> tuple:
+# History layout: [system facts (user), ack (model), optional summary pair, turns...]
+# The summary entry carries "summary": True (stripped before sending), never a text match.
+# Only the last `keep_turns` turns are kept verbatim; older ones are folded into a rolling
+# summary by a background LLM job, and every request is trimmed to `max_request_tokens`.
+COPILOT_CONFIG = {
+    "keep_turns": int(os.getenv("COPILOT_KEEP_TURNS", "6")),
+    "fold_turns": 4,              # Summarize once this many turns are beyond keep_turns
+    "max_unfolded_turns": 12,     # Hard cap: older turns beyond keep_turns are dropped unsummarized
+                                  # (only reached when summary jobs keep failing / never run)
+    "max_request_tokens": int(os.getenv("COPILOT_MAX_REQUEST_TOKENS", "6000")),
+    "summary_words": 150,
+}
+SUMMARY_PREFIX = "[RINGKASAN DISKUSI SEBELUMNYA]"
+SUMMARY_ACK = "Baik, saya akan melanjutkan diskusi dengan mengingat ringkasan tersebut."
+
+_history_lock = threading.Lock()
+_compacting = set()  # Sessions (sender) with a summary job in flight
+
+
+def _split_history(history):
+    """-> (system entries, summary pair or [], turns)"""
+    system, rest = history[:2], history[2:]
+    if rest and rest[0].get("summary"):
+        return system, rest[:2], rest[2:]
+    return system, [], rest
+
+
+def _request_contents(history):
+    """System + summary + newest turns that fit max_request_tokens (call under _history_lock)."""
+    system, summary, turns = _split_history(history)
+    budget = COPILOT_CONFIG["max_request_tokens"]
+    while len(turns) > 1 and llm_executor.estimate_tokens(system + summary + turns) > budget:
+        turns = turns[2:] if len(turns) > 2 else turns[1:]  # Drop the oldest user/model pair
+    summary = [{"role": entry["role"], "parts": entry["parts"]} for entry in summary]  # Without the flag
+    return system + summary + turns
+
+
+def _summarize_turns(history, summary, folded, session):
+    """Background job: fold `folded` (+ previous summary) into one summary entry of `history`."""
+    try:
+        previous = summary[0]["parts"][0]["text"][len(SUMMARY_PREFIX):].strip() if summary else "-"
+        lines = []
+        for entry in folded:
+            who = "Petambak" if entry["role"] == "user" else "Copilot"
+            lines.append(f"{who}: {entry['parts'][0]['text']}")
+        prompt = (
+            f"Ringkas diskusi petambak dengan Copilot akuakultur berikut dalam MAKSIMAL "
+            f"{COPILOT_CONFIG['summary_words']} kata. Pertahankan angka penting, keputusan, "
+            f"tindakan yang sudah dilakukan, dan pertanyaan yang belum terjawab.\n\n"
+            f"RINGKASAN SEBELUMNYA:\n{previous}\n\nLANJUTAN PERCAKAPAN:\n" + "\n".join(lines)
+        )
+        text = generate_text(prompt, use_cache=False)
+        with _history_lock:
+            _, current_summary, turns = _split_history(history)
+            # Apply only if the folded turns are still the oldest ones (session not reset meanwhile)
+            if current_summary == summary and len(turns) >= len(folded) and all(
+                    a is b for a, b in zip(turns, folded)):
+                history[2:] = [
+                    {"role": "user", "parts": [{"text": f"{SUMMARY_PREFIX}\n{text}"}], "summary": True},
+                    {"role": "model", "parts": [{"text": SUMMARY_ACK}]},
+                ] + turns[len(folded):]
+                print(f"🗜️ Copilot history: {len(folded) // 2} turns folded into summary")
+    except Exception as e:
+        print(f"⚠️ Copilot summary failed: {e}")
+    finally:
+        with _history_lock:
+            _compacting.discard(session)
+
+
+def _maybe_compact(history, session=None):
+    """
+    Queue a background summary when too many old turns piled up (call under _history_lock).
+    Without a session key only the hard cap applies.
+    """
+    _, summary, turns = _split_history(history)
+    keep = COPILOT_CONFIG["keep_turns"] * 2
+    old = len(turns) - keep
+    old -= old % 2
+    if session and old >= COPILOT_CONFIG["fold_turns"] * 2 and session not in _compacting:
+        _compacting.add(session)
+        if not llm_executor.submit(_summarize_turns, history, list(summary), turns[:old], session,
+                                   priority=llm_executor.PRIORITY_BACKGROUND):
+            _compacting.discard(session)
+    # Summaries keep failing -> hard cap so the history cannot grow forever
+    overflow = len(turns) - keep - COPILOT_CONFIG["max_unfolded_turns"] * 2
+    if overflow > 0:
+        overflow += overflow % 2
+        start = len(history) - len(turns)
+        del history[start:start + overflow]
+
+
+def start_do_copilot(aeration_data: dict, on_message=None, suffix: str = "", session: str = None) -> tuple:
     """
     Start an interactive Copilot session for DO analysis.
     Returns the initial AI message and the chat history list.
@@ -122,35 +382,54 @@ def start_do_copilot(aeration_data: dict) -> tuple:
         # We simulate the first user trigger to get the intro message
         first_trigger = "Tolong sampaikan hasil analisa DO saat ini kepada saya."
         
-        response, new_history = chat_with_copilot(history, first_trigger)
+        response, new_history = chat_with_copilot(history, first_trigger, on_message=on_message,
+                                                  suffix=suffix, session=session)
         return response, new_history
         
     except Exception as e:
-        return f"⚠️ Gagal memulai Copilot: {e}", []
+        error = f"⚠️ Gagal memulai Copilot: {e}"
+        if on_message:
+            on_message(error)
+        return error, []
 
-def chat_with_copilot(chat_history: list, user_message: str) -> tuple:
+def chat_with_copilot(chat_history: list, user_message: str, on_message=None, suffix: str = "",
+                      session: str = None) -> tuple:
     """
     Continue a Copilot session. Keep context via chat_history list.
+    Only system facts + summary + recent turns (within the token budget) are sent;
+    the list is compacted in place in the background (one job per session, e.g. the sender).
+    With on_message, the reply is streamed paragraph by paragraph (suffix on the last message).
     """
     try:
         # Add user message to history
-        chat_history.append({"role": "user", "parts": [{"text": user_message}]})
+        with _history_lock:
+            chat_history.append({"role": "user", "parts": [{"text": user_message}]})
+            contents = _request_contents(chat_history)
         
         # We format the history back to generative AI format
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=chat_history
-        )
-        ai_reply = response.text.strip()
+        if on_message:
+            ai_reply = stream_text(contents, on_message, suffix=suffix, use_cache=False)
+        else:
+            response = llm_executor.call(
+                lambda: client.models.generate_content(model=GEMINI_MODEL, contents=contents),
+                est_tokens=llm_executor.estimate_tokens(contents) + OUTPUT_TOKEN_ESTIMATE
+            )
+            ai_reply = response.text.strip()
         
         # Save AI reply to history
-        chat_history.append({"role": "model", "parts": [{"text": ai_reply}]})
+        with _history_lock:
+            chat_history.append({"role": "model", "parts": [{"text": ai_reply}]})
+            _maybe_compact(chat_history, session)
         
         return ai_reply, chat_history
         
     except Exception as e:
         # Remove the failed user message so it doesn't corrupt history
-        if chat_history and chat_history[-1]["role"] == "user":
-            chat_history.pop()
-        return f"⚠️ Maaf, Copilot sedang gangguan: {e}", chat_history
+        with _history_lock:
+            if chat_history and chat_history[-1]["role"] == "user":
+                chat_history.pop()
+        error = f"⚠️ Maaf, Copilot sedang gangguan: {e}"
+        if on_message:
+            on_message(f"{error}\n\n{suffix}" if suffix else error)
+        return error, chat_history
 
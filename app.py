@@ -1,9 +1,10 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from twilio.twiml.messaging_response import MessagingResponse
 from dotenv import load_dotenv
 from forms.daily_form import daily_form_id
 from forms.weekly_form import weekly_form_id
-from drive import log_reading, log_weekly, upload_photo, get_latest_daily_data, log_ai_analysis
+from drive import (log_reading, log_weekly, upload_photo, get_latest_daily_data, log_ai_analysis,
+                   log_sensor_data, sensor_payload_values)
 from scheduler import (
     send_whatsapp_message,
     notify_experts,
@@ -13,16 +14,18 @@ from scheduler import (
 )
 import os
 import re
-import threading
+import hmac
 from datetime import datetime
 from ai_helper import check_out_of_range, generate_recommendations # [MODIFIKASI] Import AI helper untuk fitur manual
+import llm_executor
+from message_splitter import split_message, WA_MAX_CHARS
 
 # [NEW] Import IoT monitoring modules
 try:
     from do_analyzer import format_aerasi_response, get_aeration_recommendation
     from ph_drift_detector import format_calibration_response, format_troubleshoot_response
     from feed_calculator import format_pakan_response, format_log_pakan_response, format_rekap_pakan_response
-    from diagnosis_engine import format_diagnosa_response, format_diagnosa_detail, generate_diagnosa_explanation, force_reload_config
+    from diagnosis_engine import format_diagnosa_response, format_diagnosa_detail, generate_diagnosa_explanation, force_reload_config, simulate
     IOT_MODULES_AVAILABLE = True
 except ImportError as e:
     print(f"⚠️ IoT modules not fully loaded: {e}")
@@ -32,36 +35,48 @@ load_dotenv()
 app = Flask(__name__)
 user_state = {}
 
+# Shared secret for /api/simulate and /api/sensor (same value as the BOT_API_TOKEN Script Property
+# in Apps Script / the token flashed into the ESP32)
+BOT_API_TOKEN = os.getenv("BOT_API_TOKEN", "")
+
+
+def check_bot_token(endpoint):
+    """Error response when the X-Bot-Token header is missing / wrong, None when authorized."""
+    if not BOT_API_TOKEN:
+        return jsonify({"error": f"{endpoint} disabled (BOT_API_TOKEN not set)"}), 503
+    if not hmac.compare_digest(request.headers.get("X-Bot-Token", ""), BOT_API_TOKEN):
+        return jsonify({"error": "unauthorized"}), 401
+    return None
+
 # === Async Reply Helper ===
 
+AI_BUSY_MESSAGE = "⏳ *AI sedang sibuk* (antrean penuh atau permintaanmu sebelumnya masih diproses).\nCoba lagi sebentar lagi.\n\nKetik 'Menu' untuk kembali."
+
 def send_async_reply(to_number: str, message: str):
     """Kirim pesan WA via Twilio REST API (untuk dipakai di background thread)."""
-    # Twilio WhatsApp limit: 1600 karakter
-    MAX_CHARS = 1500
-    if len(message) > MAX_CHARS:
-        message = message[:MAX_CHARS - 30].rsplit("\n", 1)[0] + "\n\n_...(pesan dipotong)_"
-
-    # Selalu print ke terminal dulu (bisa dipantau meski Twilio limit habis)
-    print(f"\n{'='*50}")
-    print(f"📋 [ASYNC OUTPUT] → {to_number}")
-    print(f"{'='*50}")
-    print(message)
-    print(f"{'='*50}\n")
+    # Twilio WhatsApp limit: 1600 karakter -> pesan panjang dipecah di batas paragraf, bukan dipotong
+    for part in split_message(message, WA_MAX_CHARS):
+        # Selalu print ke terminal dulu (bisa dipantau meski Twilio limit habis)
+        print(f"\n{'='*50}")
+        print(f"📋 [ASYNC OUTPUT] → {to_number}")
+        print(f"{'='*50}")
+        print(part)
+        print(f"{'='*50}\n")
 
-    try:
-        from twilio.rest import Client
-        account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-        auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-        from_number = os.getenv("TWILIO_PHONE_NUMBER", "whatsapp:+14155238886")
-        client = Client(account_sid, auth_token)
-        client.messages.create(
-            from_=from_number,
-            to=f"whatsapp:{to_number}",
-            body=message
-        )
-        print(f"📤 [ASYNC] Pesan terkirim ke {to_number} ({len(message)} chars)")
-    except Exception as e:
-        print(f"⚠️ [ASYNC] Gagal kirim ke WA (pesan tetap tercetak di atas): {e}")
+        try:
+            from twilio.rest import Client
+            account_sid = os.getenv("TWILIO_ACCOUNT_SID")
+            auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+            from_number = os.getenv("TWILIO_PHONE_NUMBER", "whatsapp:+14155238886")
+            client = Client(account_sid, auth_token)
+            client.messages.create(
+                from_=from_number,
+                to=f"whatsapp:{to_number}",
+                body=part
+            )
+            print(f"📤 [ASYNC] Pesan terkirim ke {to_number} ({len(part)} chars)")
+        except Exception as e:
+            print(f"⚠️ [ASYNC] Gagal kirim ke WA (pesan tetap tercetak di atas): {e}")
 
 # === Utilities ===
 
@@ -108,38 +123,122 @@ def config_update_webhook():
     """Endpoint for Google Apps Script to notify config changes."""
     try:
         force_reload_config()
-        print("🚀 Received update signal from Spreadsheet! Config reloaded.")
-        return "Config Reloaded", 200
+        print("🚀 Received update signal from Spreadsheet! Config reloading in background.")
+        return "Config Reload Started", 200
     except Exception as e:
         print(f"⚠️ Webhook update error: {e}")
         return f"Error: {e}", 500
 
+@app.route("/api/simulate", methods=["POST"])
+def simulate_api():
+    """
+    What-if diagnosis for the Sheets Simulator (scored server-side on the compiled matrix).
+    Body: {"snapshots": [{param: PASS/FAIL/?}, ...]} and/or {"base": {...}, "grid": true | [params]}, "top_k": 5
+    Header: X-Bot-Token: <BOT_API_TOKEN> (the URL is public through ngrok)
+    """
+    denied = check_bot_token("simulate API")
+    if denied:
+        return denied
+    if not IOT_MODULES_AVAILABLE:
+        return jsonify({"error": "IoT modules not available"}), 503
+    try:
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return jsonify({"error": "body must be a JSON object"}), 400
+        result = simulate(
+            snapshots=body.get("snapshots"),
+            base=body.get("base"),
+            grid=body.get("grid"),
+            top_k=body.get("top_k", 5)
+        )
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"⚠️ Simulate API error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/sensor", methods=["POST"])
+def sensor_api():
+    """
+    Readings posted directly by the ESP32 (same keys as log_sensor_data).
+    Body: {"device": "esp32-1", "do": 2.1, "do_adc": 1840, "ph": 7.2, ..., "ac_status": "OFF", ...}
+    Header: X-Bot-Token: <BOT_API_TOKEN>
+    Low DO / Power Outage are paged from the payload before the rows are written.
+    """
+    denied = check_bot_token("sensor API")
+    if denied:
+        return denied
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    device = str(body.get("device") or "ESP32")
+
+    # Emergency fast path: evaluated in memory on the payload rows (no Sheets read)
+    if IOT_MODULES_AVAILABLE:
+        try:
+            from diagnosis_engine import check_payload_emergency
+            from scheduler import notify_emergency
+            for sheet_name, values in sensor_payload_values(device, body).items():
+                emergencies = check_payload_emergency(sheet_name, values)
+                if emergencies:
+                    notify_emergency(emergencies, f"{sheet_name} ({device})")
+        except Exception as e:
+            print(f"⚠️ Emergency fast path error: {e}")
+
+    try:
+        log_sensor_data(device, body)  # Rows are buffered; diagnosis follows in the background
+        return jsonify({"status": "logged"}), 200
+    except Exception as e:
+        print(f"⚠️ Sensor API error: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/webhook/sensor-update", methods=["POST"])
 def sensor_update_webhook():
     """
     Endpoint for Google Apps Script to notify NEW SENSOR DATA.
     Triggered when ESP32 writes to 'Water Quality' or 'Farm Control'.
+    Payload: {"sheet": "...", "values": {"<header>": "<value>", ...}} (values optional:
+    the new row, sent by Apps Script / ESP32 so emergencies are paged before any Sheets read).
     """
     try:
         req_data = request.json
         sheet_name = req_data.get("sheet", "Unknown") if req_data else "Unknown"
         print(f"📡 New Sensor Data Signal from: {sheet_name}")
 
+        # 0. Emergency fast path: Low DO / Power Outage on the payload row, in memory
+        values = req_data.get("values") if req_data else None
+        if IOT_MODULES_AVAILABLE and isinstance(values, dict):
+            try:
+                from diagnosis_engine import check_payload_emergency
+                from scheduler import notify_emergency
+                emergencies = check_payload_emergency(sheet_name, values)
+                if emergencies:
+                    notify_emergency(emergencies, sheet_name)
+            except Exception as e:
+                print(f"⚠️ Emergency fast path error: {e}")
+
         # 1. Fetch Latest Data
         # We allow a small delay for GSheets to commit the write
         import time
         time.sleep(1) 
         
         # 2. Run Diagnosis & Check Alerts
-        from drive import run_diagnosis
-        # run_diagnosis() will internally log to 'AI Event Log'
-        # AND it calls 'notify_experts' if there is an EMERGENCY.
+        from drive import run_diagnosis, invalidate_diagnosis
+        # New rows in `sheet_name` -> run_diagnosis() updates the shared DiagnosisResult
+        # incrementally (only that tab's new rows / rules), so a following 'diagnosa' /
+        # 'detail' reuses it. It logs to 'AI Event Log' AND calls 'notify_experts' on EMERGENCY.
+        if "Unknown" in sheet_name:
+            invalidate_diagnosis("sensor update: unknown sheet")
+            run_diagnosis()
+        else:
+            run_diagnosis(changed_tabs=[sheet_name])
         
         # We can also force a specific notification if it's Farm Control (Status Change)
         if sheet_name == "Farm Control":
-             from drive import control_tab
-             rows = control_tab.get_all_values()
-             if len(rows) > 1:
+             from drive import control_tab, get_tail_rows
+             _, rows = get_tail_rows(control_tab, 1)
+             if rows:
                  last = rows[-1]
                  # AC=3, DC=4, Pump=5, Aerator=6
                  msg = f"🔧 *STATUS KONTROL UPDATE*\n\nAC: {last[3]}\nDC: {last[4]}\nPompa: {last[5]}\nAerator: {last[6]}"
@@ -272,10 +371,7 @@ def whatsapp_reply():
             # Logic AI Manual Trigger (Enhanced with Gemini) - ASYNC
             data = get_latest_daily_data()
             if data:
-                # Langsung balas loading agar tidak timeout
-                msg.body("🧠 *Sedang memproses analisa AI...* Hasilnya akan dikirim dalam beberapa detik.")
-
-                # Proses AI di background thread
+                # Proses AI di background (LLM worker pool)
                 def run_ai_analysis(target, sensor_ctx_copy):
                     try:
                         try:
@@ -283,8 +379,14 @@ def whatsapp_reply():
                         except:
                             diag = "Tidak tersedia"
                         from ai_helper import generate_ai_analysis
-                        ai_insight = generate_ai_analysis(sensor_ctx_copy, diag)
-                        result = f"🧠 *ANALISA CERDAS GEMINI AI*\n\n{ai_insight}\n\nKetik 'Menu' untuk kembali."
+                        # Streaming: tiap paragraf yang selesai langsung dikirim sebagai pesan WA
+                        generate_ai_analysis(
+                            sensor_ctx_copy, diag,
+                            on_message=lambda part: send_async_reply(target, part),
+                            prefix="🧠 *ANALISA CERDAS GEMINI AI*",
+                            suffix="Ketik 'Menu' untuk kembali."
+                        )
+                        return
                     except Exception as e:
                         error_str = str(e)
                         if "429" in error_str or "quota" in error_str.lower():
@@ -294,8 +396,12 @@ def whatsapp_reply():
                     send_async_reply(target, result)
 
                 sensor_ctx = {k: v for k, v in data.items() if v and v != "-"}
-                t = threading.Thread(target=run_ai_analysis, args=(sender, sensor_ctx), daemon=True)
-                t.start()
+                if llm_executor.submit(run_ai_analysis, sender, sensor_ctx, sender=sender,
+                                       priority=llm_executor.PRIORITY_DIAGNOSIS):
+                    # Langsung balas loading agar tidak timeout
+                    msg.body("🧠 *Sedang memproses analisa AI...* Hasilnya akan dikirim dalam beberapa detik.")
+                else:
+                    msg.body(AI_BUSY_MESSAGE)
             else:
                 msg.body("⚠️ Data tidak ditemukan untuk dianalisa.")
             
@@ -321,22 +427,26 @@ def whatsapp_reply():
                         msg.body("⚠️ Data DO belum cukup untuk dianalisa.")
                         return reply(resp)
                     
-                    # 2. Langsung balas loading
-                    msg.body("💨 *Sedang menganalisa DO dengan AI Copilot...* Hasilnya akan dikirim sebentar.")
-
-                    # 3. Proses Copilot di background
+                    # 2. Proses Copilot di background (LLM worker pool)
                     def run_do_copilot(target, aer_data, st):
                         try:
-                            initial_response, history = start_do_copilot(aer_data)
+                            initial_response, history = start_do_copilot(
+                                aer_data,
+                                on_message=lambda part: send_async_reply(target, part),
+                                session=target,
+                                suffix="_(Ketik 'Menu' kapan saja untuk mengakhiri sesi ini)_"
+                            )
                             st["stage"] = "copilot_session"
                             st["session_history"] = history
-                            full_response = f"{initial_response}\n\n_(Ketik 'Menu' kapan saja untuk mengakhiri sesi ini)_"
-                            send_async_reply(target, full_response)
                         except Exception as e:
                             send_async_reply(target, f"⚠️ Error DO Copilot: {e}")
 
-                    t = threading.Thread(target=run_do_copilot, args=(sender, aeration_data, state), daemon=True)
-                    t.start()
+                    # 3. Langsung balas loading
+                    if llm_executor.submit(run_do_copilot, sender, aeration_data, state, sender=sender,
+                                           priority=llm_executor.PRIORITY_CHAT):
+                        msg.body("💨 *Sedang menganalisa DO dengan AI Copilot...* Hasilnya akan dikirim sebentar.")
+                    else:
+                        msg.body(AI_BUSY_MESSAGE)
                 except Exception as e:
                     msg.body(f"⚠️ Error: {e}")
         
@@ -397,7 +507,7 @@ def whatsapp_reply():
             else:
                 try:
                     force_reload_config()
-                    msg.body("🔄 **Update Berhasil!**\n\nRules & Matrix Diagnosa baru saja diambil ulang dari Spreadsheet.\n\nSilakan coba diagnosa sekarang dengan data terbaru.")
+                    msg.body("🔄 **Update Diproses!**\n\nRules & Matrix Diagnosa sedang diambil ulang dari Spreadsheet di background.\n\nDiagnosa tetap jalan dengan rules lama sampai versi baru siap (biasanya beberapa detik).")
                 except Exception as e:
                     msg.body(f"⚠️ Gagal refresh: {e}")
         
@@ -406,8 +516,6 @@ def whatsapp_reply():
             if not IOT_MODULES_AVAILABLE:
                 msg.body("⚠️ Modul IoT belum tersedia.")
             else:
-                msg.body("🧠 *Sedang menyusun penjelasan AI...* Hasilnya akan dikirim sebentar.")
-
                 def run_diagnosa_explanation(target):
                     try:
                         ai_text = generate_diagnosa_explanation()
@@ -415,8 +523,11 @@ def whatsapp_reply():
                     except Exception as e:
                         send_async_reply(target, f"⚠️ Gagal analisa AI: {e}")
 
-                t = threading.Thread(target=run_diagnosa_explanation, args=(sender,), daemon=True)
-                t.start()
+                if llm_executor.submit(run_diagnosa_explanation, sender, sender=sender,
+                                       priority=llm_executor.PRIORITY_DIAGNOSIS):
+                    msg.body("🧠 *Sedang menyusun penjelasan AI...* Hasilnya akan dikirim sebentar.")
+                else:
+                    msg.body(AI_BUSY_MESSAGE)
         
         elif msg_lower == "detail":
             if not IOT_MODULES_AVAILABLE:
@@ -636,14 +747,21 @@ def whatsapp_reply():
                 for k, v in state["media"].items():
                     final_data[f"{k}_photo"] = v
             
-            log_reading(sender, final_data)
-            
-            # Diagnosis with new engine
-            try:
-                diag_result = format_diagnosa_response()
-                msg.body(f"✅ **DATA TERSIMPAN!**\n\n{diag_result}")
-            except:
-                msg.body("✅ **DATA TERSIMPAN!**\n\nKetik '9' untuk diagnosa.\nKetik 'Menu' untuk kembali.")
+            # Rows are written first; diagnosis runs in the background and is pushed when ready
+            def send_diagnosis(target=sender):
+                try:
+                    diag_result = format_diagnosa_response()
+                    send_async_reply(target, diag_result)
+                except Exception as e:
+                    print(f"⚠️ Post-log diagnosis error: {e}")
+                    send_async_reply(target, "Ketik '9' untuk diagnosa.\nKetik 'Menu' untuk kembali.")
+
+            if IOT_MODULES_AVAILABLE:
+                log_reading(sender, final_data, on_diagnosis=send_diagnosis)
+                msg.body("✅ **DATA TERSIMPAN!**\n\n⏳ Diagnosa sedang diproses, hasil dikirim sebentar lagi.\nKetik 'Menu' untuk kembali.")
+            else:
+                log_reading(sender, final_data)
+                msg.body("✅ **DATA TERSIMPAN!**\n\nKetik 'Menu' untuk kembali.")
             state["stage"] = "menu"
             state["responses"] = {}
         else:
@@ -764,9 +882,6 @@ def whatsapp_reply():
             
             history = state.get("session_history", [])
             
-            # Langsung balas loading agar tidak timeout
-            msg.body("💬 *Sedang memproses balasan AI...* Hasilnya akan dikirim sebentar.")
-            
             # Deteksi keyword refresh data
             REFRESH_KEYWORDS = [
                 "refresh", "cek ulang", "cek data", "data terbaru", "update data",
@@ -775,7 +890,7 @@ def whatsapp_reply():
             ]
             wants_refresh = any(kw in msg_lower for kw in REFRESH_KEYWORDS)
             
-            # Proses Gemini di background thread
+            # Proses Gemini di background (LLM worker pool)
             def run_copilot_chat(target, hist, user_msg, st, do_refresh):
                 try:
                     actual_msg = user_msg
@@ -808,14 +923,22 @@ def whatsapp_reply():
                         except Exception as e:
                             actual_msg = f"{user_msg}\n\n[Gagal ambil data terbaru: {e}]"
 
-                    ai_reply_text, new_history = chat_with_copilot(hist, actual_msg)
+                    ai_reply_text, new_history = chat_with_copilot(
+                        hist, actual_msg,
+                        on_message=lambda part: send_async_reply(target, part),
+                        session=target,
+                        suffix="_(Ketik 'Menu' untuk mengakhiri diskusi)_"
+                    )
                     st["session_history"] = new_history
-                    send_async_reply(target, f"{ai_reply_text}\n\n_(Ketik 'Menu' untuk mengakhiri diskusi)_")
                 except Exception as e:
                     send_async_reply(target, f"⚠️ Kesalahan sistem saat berdiskusi: {e}\n\nKetik 'Menu' untuk kembali.")
             
-            t = threading.Thread(target=run_copilot_chat, args=(sender, history, msg_text, state, wants_refresh), daemon=True)
-            t.start()
+            if llm_executor.submit(run_copilot_chat, sender, history, msg_text, state, wants_refresh,
+                                   sender=sender, priority=llm_executor.PRIORITY_CHAT):
+                # Langsung balas loading agar tidak timeout
+                msg.body("💬 *Sedang memproses balasan AI...* Hasilnya akan dikirim sebentar.")
+            else:
+                msg.body(AI_BUSY_MESSAGE)
         except Exception as e:
              msg.body(f"⚠️ Kesalahan sistem: {e}\n\nKetik 'Menu' untuk kembali.")
              
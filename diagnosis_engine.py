@@ -3,53 +3,166 @@ Diagnosis Engine Module
 Dynamic diagnosis system that reads rules and matrix from Google Sheets.
 Includes: Emergency Priority, In-Memory Cache, Weighted Scoring.
 """
+import os
+import json
+import time
 import drive
+import hashlib
 import gspread
-import time
+import operator
+import threading
+from collections import OrderedDict
+import sheets_gateway
+from sheets_gateway import gated
 from datetime import datetime, timedelta
+from rolling_window import RollingWindow, parse_window_operator, parse_timestamp
+from rule_logic import compile_logic
+from matrix_reference import match_matrix_loop as _match_matrix_loop
+
+try:
+    from matrix_engine import CompiledMatrix, MAX_GRID_SNAPSHOTS
+    MATRIX_ENGINE_AVAILABLE = True
+except ImportError:
+    MATRIX_ENGINE_AVAILABLE = False
+    print("⚠️ numpy not installed, matrix scoring uses the Python loop")
 
 # ===========================
 # SMART CACHE STRATEGY
-# Rules & Matrix: cached 30 min (rarely change)
+# Rules & Matrix: one ConfigVersion, swapped atomically on reload
+#   (readers keep the old version until the new one is fully built).
+#   rules / matrix / compiled_matrix never change after install; tab_headers and rule_plan
+#   are derived caches that are refreshed in place when a tab's header row changes.
+#   A failed reload backs off (RELOAD_RETRY_*) instead of retrying on every get_config().
 # Tab Data (sensor): ALWAYS fresh (changes frequently)
 # ===========================
 _cache = {
-    "rules": None,
-    "matrix": None,
-    "config_last_fetch": None,
+    "config": None,
     "config_ttl_minutes": 1440
 }
 
-SCORING_DATA_WEIGHT = 0.7
-SCORING_PRIOR_WEIGHT = 0.3
-DEPTH_CAP = 6
+
+class ConfigVersion:
+    """Rules + Matrix loaded together, with everything compiled from them."""
+
+    def __init__(self, rules, matrix_data):
+        self.version = 0
+        self.rules = rules
+        self.matrix = matrix_data
+        self.compiled_matrix = CompiledMatrix(matrix_data) if MATRIX_ENGINE_AVAILABLE else None
+        self.rule_plan = None
+        self.tab_headers = {}
+        self.loaded_at = datetime.now()
+        # Survives restarts (unlike `version`), used by the persisted diagnosis log state
+        self.digest = hashlib.sha1(json.dumps([rules, matrix_data]).encode()).hexdigest()[:16]
+
+    def is_fresh(self):
+        return datetime.now() - self.loaded_at < timedelta(minutes=_cache["config_ttl_minutes"])
+
+
+RELOAD_RETRY_MIN_SECONDS = 30
+RELOAD_RETRY_MAX_SECONDS = 900
+
+_config_lock = threading.RLock()      # Serializes loads (first load is synchronous)
+_reload_state = {"thread": None, "pending": False, "failures": 0, "next_retry_at": 0.0}
+_reload_state_lock = threading.Lock()
 
 
-def _is_config_cache_valid():
-    """Check if rules & matrix cache is still fresh."""
-    if _cache["config_last_fetch"] is None:
-        return False
-    elapsed = datetime.now() - _cache["config_last_fetch"]
-    return elapsed < timedelta(minutes=_cache["config_ttl_minutes"])
+def _install_config(cfg):
+    previous = _cache["config"]
+    cfg.version = previous.version + 1 if previous else 1
+    _cache["config"] = cfg  # Single reference swap: readers see old OR new, never a mix
+    print(f"🔄 Diagnosis Rules & Matrix v{cfg.version} loaded from Spreadsheet! (Next refresh in {_cache['config_ttl_minutes']} min)")
+    if previous is not None:
+        invalidate_diagnosis(f"config v{cfg.version}")
+
+
+def _load_config():
+    """Fetch, compile and install a new ConfigVersion (serialized)."""
+    with _config_lock:
+        cfg = _fetch_config()
+        # Warm header row + rule plan before readers see this version
+        try:
+            headers = _get_tab_headers(sorted(set(r["tab_source"] for r in cfg.rules)), cfg)
+            _get_rule_plan(cfg.rules, {t: h for t, h in headers.items() if h}, cfg)
+        except Exception as e:
+            print(f"⚠️ Diagnosis: header prefetch failed, will retry on first use: {e}")
+        _install_config(cfg)
+        return cfg
+
+
+def _reload_worker():
+    while True:
+        try:
+            _load_config()
+            with _reload_state_lock:
+                _reload_state["failures"] = 0
+                _reload_state["next_retry_at"] = 0.0
+        except Exception as e:
+            with _reload_state_lock:
+                _reload_state["failures"] += 1
+                delay = min(RELOAD_RETRY_MAX_SECONDS,
+                            RELOAD_RETRY_MIN_SECONDS * 2 ** (_reload_state["failures"] - 1))
+                _reload_state["next_retry_at"] = time.monotonic() + delay
+            print(f"⚠️ Config reload failed, keeping v{getattr(_cache['config'], 'version', 0)} "
+                  f"(next try in {delay:.0f}s): {e}")
+        with _reload_state_lock:
+            if not _reload_state["pending"]:
+                _reload_state["thread"] = None
+                return
+            _reload_state["pending"] = False
+
+
+def reload_config_async(follow_up=True):
+    """
+    Reload config in the background. Requests arriving while a reload runs are
+    coalesced into ONE follow-up reload (the sheet may have changed mid-read);
+    follow_up=False (TTL refresh) just joins the running reload.
+    """
+    with _reload_state_lock:
+        if _reload_state["thread"] is not None:
+            if follow_up:
+                _reload_state["pending"] = True
+            return False
+        _reload_state["thread"] = threading.Thread(target=_reload_worker, daemon=True)
+        _reload_state["thread"].start()
+        return True
+
+
+def get_config():
+    """Current ConfigVersion; stale versions are served while a background reload runs."""
+    cfg = _cache["config"]
+    if cfg is None:
+        # Nothing to serve yet: load now (concurrent first callers share one load)
+        with _config_lock:
+            cfg = _cache["config"] or _load_config()
+    elif not cfg.is_fresh() and time.monotonic() >= _reload_state["next_retry_at"]:
+        reload_config_async(follow_up=False)
+    return cfg
 
 
 def force_reload_config():
-    """Force clear cache so next fetch gets fresh rules."""
-    _cache["config_last_fetch"] = None
-    _cache["rules"] = None
-    _cache["matrix"] = None
-    print("🔄 Cache cleared via manual refresh.")
+    """Start a background reload; the current rules keep serving until it is ready."""
+    reload_config_async()
+    print("🔄 Config reload requested via manual refresh.")
     return True
 
 
+def _config_for(rules):
+    """ConfigVersion that owns this rules list (None for ad-hoc rules)."""
+    cfg = _cache["config"]
+    return cfg if cfg is not None and cfg.rules is rules else None
+
+
 def _fetch_config():
-    """Fetch rules and matrix (cached)."""
+    """Fetch rules and matrix from the Spreadsheet into a new (not yet installed) ConfigVersion."""
     sh = drive.dashboard
     if not sh:
         raise Exception("Dashboard connection not available")
     
     # 1. Read Diagnosis_Rules
-    rules_ws = sh.worksheet("Diagnosis_Rules")
+    rules_ws = drive.rules_tab
+    if not rules_ws:
+        raise Exception("Tab 'Diagnosis_Rules' not found")
     rules_data = rules_ws.get_all_values()
     rules_rows = rules_data[1:]
     
@@ -71,33 +184,206 @@ def _fetch_config():
         tab_names.add(tab_source)
     
     # 2. Read Matrix Diagnosis
-    matrix_ws = sh.worksheet("Matrix Diagnosis")
+    matrix_ws = drive.matrix_tab
+    if not matrix_ws:
+        raise Exception("Tab 'Matrix Diagnosis' not found")
     matrix_data = matrix_ws.get_all_values()
     
-    _cache["rules"] = rules
-    _cache["matrix"] = matrix_data
-    _cache["config_last_fetch"] = datetime.now()
-    print(f"🔄 Diagnosis Rules & Matrix reloaded from Spreadsheet! (Next refresh in {_cache['config_ttl_minutes']} min)")
-    
-    return rules, matrix_data
+    return ConfigVersion(rules, matrix_data)
+
+
+def _find_column(headers, keyword):
+    """First header containing keyword (case-insensitive) -> (index, header)."""
+    for idx, h in enumerate(headers):
+        if keyword.lower() in h.lower():
+            return idx, h
+    return None, None
+
+
+RULE_OPERATORS = {
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "=": operator.eq,
+}
+
+
+def _parse_float(text):
+    """'7,5' / '7.5' -> 7.5, None if not numeric."""
+    try:
+        return float(text.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _compile_rule_plan(rules, headers):
+    """
+    Compile Diagnosis_Rules once: resolved column, parsed threshold and operator per rule.
+    'columns' groups rule indexes per (tab, column) so each column is read once;
+    'tab_steps' lists the rules bound to each tab (for incremental updates);
+    'windows' groups windowed rules ("mean(2h) <") per (tab, column, seconds) so
+    rules sharing a window share one RollingWindow. Windowed tabs also read column A (timestamp).
+    Column F (logic) is compiled into a closure over the raw per-rule conditions.
+    """
+    steps = []
+    columns = {}
+    tab_steps = {}
+    windows = {}
+    for idx, rule in enumerate(rules):
+        tab_headers = headers.get(rule["tab_source"]) or []
+        col_idx, matched_col = _find_column(tab_headers, rule["keyword"])
+        window = parse_window_operator(rule["operator"])
+        op = window["op"] if window else rule["operator"]
+        steps.append({
+            "param": rule["param"],
+            "keyword": rule["keyword"],
+            "tab_source": rule["tab_source"],
+            "col_idx": col_idx,
+            "column": matched_col,
+            "operator": op,
+            "compare": RULE_OPERATORS.get(op),
+            "threshold": _parse_float(rule["value"]),
+            "value_lower": rule["value"].lower(),
+            "window": window,
+        })
+        if col_idx is not None:
+            columns.setdefault((rule["tab_source"], col_idx), []).append(idx)
+            tab_steps.setdefault(rule["tab_source"], []).append(idx)
+            if window:
+                window["key"] = (rule["tab_source"], col_idx, window["seconds"])
+                windows.setdefault(window["key"], []).append(idx)
+                columns.setdefault((rule["tab_source"], 0), [])
+    _compile_rule_logic(rules, steps)
+    return {"rules": rules, "headers": headers, "steps": steps, "columns": columns,
+            "tab_steps": tab_steps, "windows": windows}
+
+
+def _compile_rule_logic(rules, steps):
+    """step["logic"] = closure(raw) -> bool, or None when column F is empty. Bad cells fall back to SELF."""
+    # A parameter name refers to its last rule row (same as "later rules win" in the snapshot)
+    name_index = {rule["param"].strip().lower(): idx for idx, rule in enumerate(rules)}
+    for idx, rule in enumerate(rules):
+        try:
+            steps[idx]["logic"] = compile_logic(rule.get("logic", ""), idx, name_index)
+        except ValueError as e:
+            print(f"⚠️ Diagnosis_Rules logic for '{rule['param']}' ignored ({e}): {rule.get('logic')!r}")
+            steps[idx]["logic"] = None
+
+
+def _get_rule_plan(rules, headers, cfg=None):
+    """Rule plan cached on its ConfigVersion (rebuilt when a tab header row changes)."""
+    cfg = cfg or _config_for(rules)
+    plan = cfg.rule_plan if cfg else None
+    if plan is None or plan["headers"] != headers:
+        plan = _compile_rule_plan(rules, headers)
+        if cfg:
+            cfg.rule_plan = plan
+    return plan
+
+
+def _get_tab_headers(tab_names, cfg=None):
+    """
+    Header row of each tab (cached on the ConfigVersion).
+    Missing tabs are fetched together in ONE values_batch_get call.
+    """
+    headers = cfg.tab_headers if cfg else {}
+    missing = [t for t in tab_names if t not in headers]
+    if not missing:
+        return headers
+
+    sh = drive.dashboard
+    if not sh:
+        raise Exception("Dashboard connection not available")
+
+    try:
+        resp = gated(sh, "values_batch_get")([drive.a1_range(t, "1:1") for t in missing])
+        for tab_name, vr in zip(missing, resp.get("valueRanges", [])):
+            values = vr.get("values", [])
+            headers[tab_name] = values[0] if values else []
+    except Exception as e:
+        # One bad tab name fails the whole batch -> isolate per tab
+        print(f"⚠️ Diagnosis: batch header read failed ({e}), retrying per tab")
+        for tab_name in missing:
+            try:
+                resp = gated(sh, "values_batch_get")([drive.a1_range(tab_name, "1:1")])
+                values = resp.get("valueRanges", [{}])[0].get("values", [])
+                headers[tab_name] = values[0] if values else []
+            except Exception as e2:
+                print(f"⚠️ Diagnosis: cannot read tab '{tab_name}': {e2}")
+                headers[tab_name] = None
+    return headers
+
+
+def _read_rule_columns(sh, tab_cols):
+    """One values_batch_get for the rule columns -> {(tab, col): [header cell, values...]}."""
+    ranges, targets = [], []
+    for tab_name, cols in tab_cols.items():
+        for col_idx in sorted(cols):
+            letter = drive.col_letter(col_idx + 1)
+            ranges.append(drive.a1_range(tab_name, f"{letter}:{letter}"))
+            targets.append((tab_name, col_idx))
+    if not ranges:
+        return {}
+    resp = gated(sh, "values_batch_get")(ranges, params={"majorDimension": "COLUMNS"})
+    columns = {}
+    for (tab_name, col_idx), vr in zip(targets, resp.get("valueRanges", [])):
+        values = vr.get("values", [])
+        columns[(tab_name, col_idx)] = values[0] if values else []
+    return columns
 
 
 def _fetch_tab_data(rules):
-    """ALWAYS fetch fresh sensor data from tabs (no cache)."""
+    """
+    ALWAYS fetch fresh sensor data from tabs (no cache).
+    One values_batch_get for every tab, limited to the columns the rules use.
+    Rows are rebuilt at full header width so column indexes stay the same.
+    Each column's header cell is checked against the cached header row: if a column was
+    inserted / moved / renamed, the headers are re-read and the rule plan re-resolved.
+    """
     sh = drive.dashboard
     if not sh:
         raise Exception("Dashboard connection not available")
     
-    tab_names = set(r["tab_source"] for r in rules)
-    tab_data = {}
-    for tab_name in tab_names:
+    tab_names = sorted(set(r["tab_source"] for r in rules))
+    cfg = _config_for(rules)
+
+    for attempt in range(2):
+        headers = _get_tab_headers(tab_names, cfg)
+
+        # Columns each tab actually needs (resolved once in the rule plan)
+        plan = _get_rule_plan(rules, {t: headers[t] for t in tab_names if headers.get(t)}, cfg)
+        tab_cols = {}
+        for tab_name, col_idx in plan["columns"]:
+            tab_cols.setdefault(tab_name, set()).add(col_idx)
+
         try:
-            ws = sh.worksheet(tab_name)
-            tab_data[tab_name] = ws.get_all_values()
-            time.sleep(0.3)
+            columns = _read_rule_columns(sh, tab_cols)
         except Exception as e:
-            print(f"⚠️ Diagnosis: cannot read tab '{tab_name}': {e}")
-            tab_data[tab_name] = []
+            print(f"⚠️ Diagnosis: batch read failed: {e}")
+            return {t: [] for t in tab_names}
+
+        stale = sorted({tab_name for (tab_name, col_idx), values in columns.items()
+                        if (values[0] if values else "") != (headers[tab_name][col_idx:col_idx + 1] or [""])[0]})
+        if not stale or attempt:
+            break
+        print(f"🔄 Diagnosis: header row changed in {', '.join(stale)}, re-resolving columns")
+        for tab_name in stale:
+            headers.pop(tab_name, None)
+
+    tab_data = {}
+    for tab_name in tab_names:
+        tab_headers = headers.get(tab_name)
+        tab_data[tab_name] = [tab_headers] if tab_headers else []
+
+    for tab_name, cols in tab_cols.items():
+        width = len(headers[tab_name])
+        n_rows = max(len(columns.get((tab_name, c), [])) for c in cols) - 1  # minus header cell
+        rows = [[""] * width for _ in range(max(0, n_rows))]
+        for c in cols:
+            for i, val in enumerate(columns.get((tab_name, c), [])[1:]):
+                rows[i][c] = val
+        tab_data[tab_name].extend(rows)
     
     return tab_data
 
@@ -120,7 +406,7 @@ def get_latest_sensor_data():
     """
     try:
         # We need rules to identify the 'Water Quality' tab and its columns
-        rules, _ = _fetch_config() 
+        rules = get_config().rules
         
         # Filter rules to find the 'Water Quality' tab
         water_quality_rules = [r for r in rules if r["tab_source"] == "Water Quality"]
@@ -128,16 +414,13 @@ def get_latest_sensor_data():
             print("Warning: 'Water Quality' tab not found in rules. Returning default data.")
             return _DEFAULT_SENSOR_DATA
 
-        # Fetch data for 'Water Quality' tab specifically
-        tab_data = _fetch_tab_data(water_quality_rules)
-        
-        water_quality_data = tab_data.get("Water Quality")
-        if not water_quality_data or len(water_quality_data) < 2: # Need headers + at least one row
+        # Tail read: only the last row of 'Water Quality', not the whole tab
+        headers, rows = drive.get_tail_rows(drive.water_tab, 1)
+        if not rows: # Need headers + at least one row
             print("Warning: No data or insufficient data in 'Water Quality' tab. Returning default data.")
             return None # Return None to indicate no valid data found
         
-        headers = water_quality_data[0]
-        latest_row = water_quality_data[-1] # Get the very last row
+        latest_row = rows[-1] # Get the very last row
         
         # [NEW LOGIC] Check Source Column (Index 2 - 'ESP_Bioflok_01' etc)
         # If it starts with '+' (Phone Number), it's from WhatsApp -> IGNORE NOTIFICATION
@@ -176,169 +459,459 @@ def get_latest_sensor_data():
 
 def _fetch_all_data():
     """Fetch everything: config (cached) + sensor data (always fresh)."""
-    # Config: use cache if valid
-    if _is_config_cache_valid():
-        rules = _cache["rules"]
-        matrix_data = _cache["matrix"]
-    else:
-        rules, matrix_data = _fetch_config()
-    
-    # Sensor data: ALWAYS fresh
-    tab_data = _fetch_tab_data(rules)
+    # Diagnosis reads go ahead of menu lookups (auto-monitoring raises this to EMERGENCY)
+    with sheets_gateway.priority(sheets_gateway.PRIORITY_DIAGNOSIS):
+        # Config: current version (a stale one keeps serving while it reloads)
+        cfg = get_config()
+        rules, matrix_data = cfg.rules, cfg.matrix
+
+        # Sensor data: ALWAYS fresh
+        tab_data = _fetch_tab_data(rules)
     
     return rules, tab_data, matrix_data
 
 
-def _evaluate_rules(rules, tab_data):
-    """Evaluate all rules against latest data → PASS/FAIL snapshot."""
-    snapshot = {}
-    data_values = {}  # Store actual values for display
-    
-    for rule in rules:
-        tab_name = rule["tab_source"]
+# ===========================
+# SHARED DIAGNOSIS RESULT
+# "9" → "detail" → "analisa" within a minute reuse ONE pipeline run.
+# Invalidated by new sensor data, log_reading and config reload.
+# Sensor webhooks update it INCREMENTALLY: only the changed tab's new rows are read,
+# only rules bound to that tab are re-evaluated, matrix is skipped if nothing flipped.
+# ===========================
+RESULT_TTL_SECONDS = int(os.getenv("DIAGNOSIS_RESULT_TTL", "60"))
+FULL_RESYNC_SECONDS = int(os.getenv("DIAGNOSIS_FULL_RESYNC", "300"))
+RESULT_TOP_K = 5  # Formatters show at most the top 5 (detail / runner-ups)
+
+_result_lock = threading.Lock()
+# "last" outlives invalidation: an identical snapshot under the same config reuses its ranking
+_result_cache = {"result": None, "generation": 0, "last": None}
+
+
+def snapshot_fingerprint(snapshot):
+    """Short hash of the PASS set (everything else is FAIL), stable across restarts."""
+    active = sorted(k for k, v in snapshot.items() if v == "PASS")
+    return hashlib.sha1("|".join(active).encode()).hexdigest()[:16]
+
+
+class DiagnosisResult:
+    """One run of the diagnosis pipeline: snapshot, sensor values, ranking, emergencies."""
+
+    def __init__(self, rules, snapshot, data_values, results, emergencies, live=None):
+        self.rules = rules
+        self.snapshot = snapshot
+        self.data_values = data_values
+        self.results = results
+        self.emergencies = emergencies
+        self.fingerprint = snapshot_fingerprint(snapshot)
+        self.computed_at = time.time()
+        # Incremental state: config, plan, latest value per column, rows seen per tab,
+        # per-rule status, rolling windows and time of the last FULL read
+        # (only the windows are advanced in place, by later incremental updates and full reads)
+        self.live = live
+
+    @property
+    def top(self):
+        return self.results[0] if self.results else None
+
+    @property
+    def active(self):
+        return [k for k, v in self.snapshot.items() if v == "PASS"]
+
+    @property
+    def config_digest(self):
+        return self.live["config"].digest if self.live and self.live["config"] else None
+
+    def age(self):
+        return time.time() - self.computed_at
+
+    def needs_full_sync(self):
+        live = self.live
+        return (live is None or live["config"] is not _cache["config"]
+                or time.time() - live["synced_at"] >= FULL_RESYNC_SECONDS)
+
+
+def invalidate_diagnosis(reason=""):
+    """Drop the shared result so the next reader recomputes."""
+    _result_cache["generation"] += 1
+    _result_cache["result"] = None
+    if reason:
+        print(f"♻️ Diagnosis result invalidated ({reason})")
+
+
+def _store_result(result, generation):
+    # Data changed while we were reading -> serve it, but do not cache it
+    if generation == _result_cache["generation"]:
+        _result_cache["result"] = result
+    _result_cache["last"] = result
+    return result
+
+
+def _full_diagnosis():
+    """Whole pipeline: read every rule tab, evaluate every rule, score the matrix."""
+    rules, tab_data, matrix_data = _fetch_all_data()
+    headers = {t: data[0] for t, data in tab_data.items() if data}
+    plan = _get_rule_plan(rules, headers)
+    latest = _latest_values(plan, tab_data)
+    last = _result_cache["last"]
+    windows = _build_windows(plan, tab_data, last.live if last is not None else None)
+    tab_ok = set(headers)
+    statuses = _evaluate_steps(plan, range(len(plan["steps"])), tab_ok, latest, windows, datetime.now())
+    snapshot, data_values = _assemble_snapshot(plan, statuses)
+    cfg = _config_for(rules)
+    if (last is not None and last.live and last.live["config"] is cfg
+            and last.fingerprint == snapshot_fingerprint(snapshot)):
+        results = last.results  # Unchanged snapshot -> matrix scoring skipped
+    else:
+        results = _match_matrix(snapshot, matrix_data, top_k=RESULT_TOP_K)
+    emergencies = _check_emergency(snapshot, data_values)
+    live = {
+        "config": cfg,
+        "plan": plan,
+        "latest": latest,
+        "windows": windows,
+        "statuses": statuses,
+        "tab_ok": tab_ok,
+        "rows_seen": {t: len(data) for t, data in tab_data.items() if data},
+        "synced_at": time.time(),
+    }
+    return DiagnosisResult(rules, snapshot, data_values, results, emergencies, live)
+
+
+def get_diagnosis(max_age=None):
+    """
+    Shared DiagnosisResult (recomputed when older than RESULT_TTL_SECONDS or invalidated).
+    Concurrent callers wait for the same computation instead of running their own.
+    """
+    max_age = RESULT_TTL_SECONDS if max_age is None else max_age
+    with _result_lock:
+        cached = _result_cache["result"]
+        if cached is not None and cached.age() < max_age and not cached.needs_full_sync():
+            return cached
+
+        generation = _result_cache["generation"]
+        return _store_result(_full_diagnosis(), generation)
+
+
+def _fetch_new_rows(plan, tabs, rows_seen):
+    """Rows appended after rows_seen for the rule columns of `tabs` → ({(tab, col): values}, new rows_seen)."""
+    sh = drive.dashboard
+    if not sh:
+        raise Exception("Dashboard connection not available")
+
+    targets = [(t, c) for (t, c) in plan["columns"] if t in tabs]
+    ranges = []
+    for tab_name, col_idx in targets:
+        letter = drive.col_letter(col_idx + 1)
+        ranges.append(drive.a1_range(tab_name, f"{letter}1"))  # Header cell: detects moved columns
+        ranges.append(drive.a1_range(tab_name, f"{letter}{rows_seen[tab_name] + 1}:{letter}"))
+    if not ranges:
+        return {}, rows_seen
+
+    resp = gated(sh, "values_batch_get")(ranges, params={"majorDimension": "COLUMNS"})
+    value_ranges = resp.get("valueRanges", [])
+    new_values = {}
+    seen = dict(rows_seen)
+    for (tab_name, col_idx), head, vr in zip(targets, value_ranges[0::2], value_ranges[1::2]):
+        cell = head.get("values", [[""]])[0]
+        expected = (plan["headers"].get(tab_name) or [])[col_idx:col_idx + 1] or [""]
+        if (cell or [""])[0] != expected[0]:
+            raise Exception(f"header row of '{tab_name}' changed")
+        values = vr.get("values", [])
+        new_values[(tab_name, col_idx)] = values[0] if values else []
+        seen[tab_name] = max(seen[tab_name], rows_seen[tab_name] + len(new_values[(tab_name, col_idx)]))
+    return new_values, seen
+
+
+def update_diagnosis(changed_tabs):
+    """
+    Incremental diagnosis after new rows land in `changed_tabs`.
+    Falls back to the full pipeline when there is no usable previous state.
+    """
+    with _result_lock:
+        generation = _result_cache["generation"]
+        prev = _result_cache["result"]
+        if prev is None or prev.needs_full_sync():
+            return _store_result(_full_diagnosis(), generation)
+
+        live = prev.live
+        plan = live["plan"]
+        tabs = {t for t in changed_tabs if t in plan["tab_steps"]}
+        if not tabs:
+            return prev  # No rule reads these tabs
+        if not tabs <= live["tab_ok"]:
+            return _store_result(_full_diagnosis(), generation)
+
+        try:
+            with sheets_gateway.priority(sheets_gateway.PRIORITY_DIAGNOSIS):
+                new_values, rows_seen = _fetch_new_rows(plan, tabs, live["rows_seen"])
+        except Exception as e:
+            print(f"⚠️ Incremental read failed ({e}), running full diagnosis")
+            return _store_result(_full_diagnosis(), generation)
+
+        latest = dict(live["latest"])
+        for key, values in new_values.items():
+            for val in reversed(values):
+                if val.strip():
+                    latest[key] = (val.strip(), _parse_float(val.strip()))
+                    break
+        # Windows only ever move forward, so they are advanced in place (under _result_lock)
+        windows = live["windows"]
+        for (tab_name, col_idx, seconds), window in windows.items():
+            if tab_name in tabs:
+                _feed_window(window, new_values.get((tab_name, 0), []), new_values.get((tab_name, col_idx), []))
+
+        changed_steps = [idx for t in tabs for idx in plan["tab_steps"][t]]
+        # Windows of other tabs still slide with the clock (old readings expire)
+        changed_steps += [idx for idxs in plan["windows"].values() for idx in idxs if idx not in changed_steps]
+        statuses = dict(live["statuses"])
+        statuses.update(_evaluate_steps(plan, changed_steps, live["tab_ok"], latest, windows, datetime.now()))
+        snapshot, data_values = _assemble_snapshot(plan, statuses)
+
+        flipped = [p for p, status in snapshot.items() if prev.snapshot.get(p) != status]
+        if flipped:
+            results = _match_matrix(snapshot, live["config"].matrix, top_k=RESULT_TOP_K)
+            print(f"🔁 Incremental diagnosis: {len(changed_steps)} rules re-evaluated, flipped: {', '.join(flipped)}")
+        else:
+            results = prev.results
+            print(f"🔁 Incremental diagnosis: {len(changed_steps)} rules re-evaluated, no flip → matrix skipped")
+        emergencies = _check_emergency(snapshot, data_values)
+
+        new_live = dict(live, latest=latest, statuses=statuses, rows_seen=rows_seen)
+        result = DiagnosisResult(prev.rules, snapshot, data_values, results, emergencies, new_live)
+        return _store_result(result, generation)
+
+
+def _latest_values(plan, tab_data):
+    """Latest non-empty value of each referenced column, found and parsed ONCE."""
+    latest = {}
+    for (tab_name, col_idx) in plan["columns"]:
         data = tab_data.get(tab_name, [])
-        
-        if not data:
-            snapshot[rule["param"]] = "FAIL"
-            continue
-        
-        tab_headers = data[0]
-        tab_rows = data[1:]
-        
-        # Find column
-        col_idx = None
-        matched_col = None
-        for idx, h in enumerate(tab_headers):
-            if rule["keyword"].lower() in h.lower():
-                col_idx = idx
-                matched_col = h
-                break
-        
-        if col_idx is None:
-            snapshot[rule["param"]] = "FAIL"
-            continue
-        
-        # Get latest value
         latest_val = None
-        for row in reversed(tab_rows):
+        for row in reversed(data[1:]):
             if col_idx < len(row) and row[col_idx].strip():
                 latest_val = row[col_idx].strip()
                 break
-        
+        latest[(tab_name, col_idx)] = (latest_val, _parse_float(latest_val) if latest_val is not None else None)
+    return latest
+
+
+def _feed_window(window, timestamps, values):
+    """Push index-aligned column A timestamps + values (rows without either are skipped)."""
+    for i, val in enumerate(values):
+        ts = parse_timestamp(timestamps[i]) if i < len(timestamps) else None
+        num = _parse_float(val)
+        if ts is not None and num is not None:
+            window.add(ts, num)
+
+
+def _reusable_window(key, plan, tab_data, prev_live):
+    """Window of the previous result for `key`, if its tab kept the same header row and did not shrink."""
+    if not prev_live:
+        return None
+    tab_name = key[0]
+    window = prev_live["windows"].get(key)
+    if (window is None or window.latest is None
+            or prev_live["plan"]["headers"].get(tab_name) != plan["headers"].get(tab_name)
+            or len(tab_data.get(tab_name, [])) < prev_live["rows_seen"].get(tab_name, 0)):
+        return None
+    return window
+
+
+def _build_windows(plan, tab_data, prev_live=None):
+    """
+    RollingWindow per windowed (tab, column, seconds) from a full tab read.
+    Windows of the previous result (prev_live) are kept across config / result rebuilds and only
+    fed the rows newer than their last reading; the others are filled from the whole column.
+    """
+    windows = {}
+    for key in plan["windows"]:
+        tab_name, col_idx, seconds = key
+        rows = tab_data.get(tab_name, [])[1:]
+        window = _reusable_window(key, plan, tab_data, prev_live)
+        if window is None:
+            window = RollingWindow(seconds)
+        else:
+            # Rows are appended in time order: walk back to the last reading already in the window
+            start = len(rows)
+            while start > 0:
+                ts = parse_timestamp(rows[start - 1][0] if rows[start - 1] else "")
+                if ts is not None and ts <= window.latest:
+                    break
+                start -= 1
+            rows = rows[start:]
+        _feed_window(window,
+                     [row[0] if row else "" for row in rows],
+                     [row[col_idx] if col_idx < len(row) else "" for row in rows])
+        windows[key] = window
+    return windows
+
+
+def _evaluate_window_step(step, windows, now=None):
+    """Windowed rule: aggregate of the step's RollingWindow (ending at `now`) vs threshold, O(1)."""
+    window = (windows or {}).get(step["window"]["key"])
+    agg_val = window.value(step["window"]["agg"], now) if window else None
+    if agg_val is None:
+        return "FAIL", None
+    compare = step["compare"]
+    passed = compare(agg_val, step["threshold"]) if compare and step["threshold"] is not None else False
+    return "PASS" if passed else "FAIL", {
+        "value": f"{agg_val:.2f}",
+        "column": f"{step['column'] or step['keyword']} [{step['window']['label']}]",
+        "tab": step["tab_source"]
+    }
+
+
+def _step_passes(step, latest_val, num_val):
+    """Plain (non-windowed) rule condition on one value."""
+    if num_val is not None and step["threshold"] is not None:
+        compare = step["compare"]
+        return compare(num_val, step["threshold"]) if compare else False
+    if step["operator"] == "=":
+        return latest_val.lower() == step["value_lower"]
+    return False
+
+
+def _evaluate_steps(plan, step_indexes, tab_ok, latest, windows=None, now=None):
+    """
+    Evaluate plan steps → {step index: (status, data_value or None)}.
+    now: end of the rolling windows (live diagnosis: wall clock, replay: event time).
+    """
+    statuses = {}
+    for idx in step_indexes:
+        step = plan["steps"][idx]
+        tab_name = step["tab_source"]
+        if tab_name not in tab_ok or step["col_idx"] is None:
+            statuses[idx] = ("FAIL", None)
+            continue
+        if step["window"]:
+            statuses[idx] = _evaluate_window_step(step, windows, now)
+            continue
+
+        latest_val, num_val = latest[(tab_name, step["col_idx"])]
         if latest_val is None:
-            snapshot[rule["param"]] = "FAIL"
+            statuses[idx] = ("FAIL", None)
             continue
-        
-        # Evaluate
-        try:
-            num_val = float(latest_val.replace(",", "."))
-            num_threshold = float(rule["value"].replace(",", "."))
-            
-            op = rule["operator"]
-            if op == "<": passed = num_val < num_threshold
-            elif op == ">": passed = num_val > num_threshold
-            elif op == "<=": passed = num_val <= num_threshold
-            elif op == ">=": passed = num_val >= num_threshold
-            elif op == "=": passed = num_val == num_threshold
-            else: passed = False
-        except ValueError:
-            if rule["operator"] == "=":
-                passed = latest_val.lower() == rule["value"].lower()
-            else:
-                passed = False
-        
-        status = "PASS" if passed else "FAIL"
-        snapshot[rule["param"]] = status
-        data_values[rule["param"]] = {
+
+        passed = _step_passes(step, latest_val, num_val)
+        statuses[idx] = ("PASS" if passed else "FAIL", {
             "value": latest_val,
-            "column": matched_col or rule["keyword"],
+            "column": step["column"] or step["keyword"],
             "tab": tab_name
-        }
-    
+        })
+    return statuses
+
+
+def _assemble_snapshot(plan, statuses):
+    """
+    Per-rule statuses → snapshot / data_values (later rules win, in rule order).
+    Rules with a logic expression (column F) get its result over the raw conditions.
+    """
+    snapshot = {}
+    data_values = {}  # Store actual values for display
+    raw = [statuses[idx][0] == "PASS" for idx in range(len(plan["steps"]))]
+    for idx, step in enumerate(plan["steps"]):
+        status, value = statuses[idx]
+        if step["logic"]:
+            status = "PASS" if step["logic"](raw) else "FAIL"
+        snapshot[step["param"]] = status
+        if value is not None:
+            data_values[step["param"]] = value
     return snapshot, data_values
 
 
-def _match_matrix(snapshot, matrix_data):
-    """Match PASS/FAIL snapshot against Matrix Diagnosis."""
-    headers = matrix_data[0]
-    rows = matrix_data[1:]
-    
-    # Map columns
-    param_cols = {}
-    diag_col, freq_col, cost_col = 2, 1, None
-    
-    for i, h in enumerate(headers):
-        h_clean = h.strip()
-        if h_clean in snapshot:
-            param_cols[h_clean] = i
-        if "cost" in h.lower():
-            cost_col = i
-    
-    max_possible = len(param_cols)
-    
-    # Collect frequencies for prior
-    all_freq = []
-    for row in rows:
-        if len(row) <= diag_col: continue
-        d = row[diag_col].strip()
-        if d.startswith("COST") or d == "-" or not d: continue
-        try:
-            all_freq.append(float(row[freq_col].strip()))
-        except:
-            all_freq.append(0)
-    total_freq = sum(all_freq) if all_freq else 1
-    
-    # Score diagnoses
-    results = []
-    for row in rows:
-        if len(row) <= diag_col: continue
-        diag_name = row[diag_col].strip()
-        if diag_name.startswith("COST") or diag_name == "-" or not diag_name:
-            continue
-        
-        try:
-            freq_num = float(row[freq_col].strip())
-        except:
-            freq_num = 0
-        
-        total_cond = 0
-        matched_cond = 0
-        missed_params = []
-        
-        for param_name, col_idx in param_cols.items():
-            if col_idx >= len(row): continue
-            matrix_val = row[col_idx].strip().upper()
-            if matrix_val in ("?", "", "-"): continue
-            
-            current_val = snapshot.get(param_name, "FAIL")
-            total_cond += 1
-            if matrix_val == current_val:
-                matched_cond += 1
-            else:
-                missed_params.append(param_name)
-        
-        if total_cond == 0:
-            continue
-        
-        match_ratio = matched_cond / total_cond * 100
-        depth_weight = min(total_cond, DEPTH_CAP) / DEPTH_CAP
-        weighted_score = match_ratio * depth_weight
-        prior = freq_num / total_freq if total_freq > 0 else 0
-        final_score = (weighted_score * SCORING_DATA_WEIGHT) + (prior * 100 * SCORING_PRIOR_WEIGHT)
-        
-        if matched_cond > 0:
-            results.append({
-                "diagnosis": diag_name,
-                "final_score": final_score,
-                "match_ratio": match_ratio,
-                "matched": matched_cond,
-                "total": total_cond,
-                "frequency": freq_num,
-                "missed": missed_params
-            })
-    
-    results.sort(key=lambda x: x["final_score"], reverse=True)
-    return results
+def _evaluate_rules(rules, tab_data):
+    """Evaluate all rules against latest data → PASS/FAIL snapshot."""
+    headers = {t: data[0] for t, data in tab_data.items() if data}
+    plan = _get_rule_plan(rules, headers)
+    latest = _latest_values(plan, tab_data)
+    windows = _build_windows(plan, tab_data)
+    statuses = _evaluate_steps(plan, range(len(plan["steps"])), set(headers), latest, windows, datetime.now())
+    return _assemble_snapshot(plan, statuses)
+
+
+def _compiled_matrix(matrix_data):
+    """CompiledMatrix for matrix_data (reuses the one built at config load)."""
+    if not MATRIX_ENGINE_AVAILABLE:
+        return None
+    cfg = _cache["config"]
+    if cfg is not None and matrix_data is cfg.matrix and cfg.compiled_matrix is not None:
+        return cfg.compiled_matrix
+    return CompiledMatrix(matrix_data)
+
+
+def _match_matrix(snapshot, matrix_data, top_k=None):
+    """
+    Match PASS/FAIL snapshot against Matrix Diagnosis (weighted by row 2).
+    top_k: only the best k (inverted index + upper-bound pruning, same order as the full ranking).
+    """
+    return _match_matrix_batch([snapshot], matrix_data, top_k)[0]
+
+
+SIMULATE_MAX_TOP_K = 50
+# Batches (grid, or more than SIMULATE_EXPLAIN_MAX_SNAPSHOTS explicit snapshots): up to
+# MAX_GRID_SNAPSHOTS rankings, kept short and without per-condition contributions
+SIMULATE_EXPLAIN_MAX_SNAPSHOTS = 16
+SIMULATE_BATCH_MAX_TOP_K = 5
+
+
+def _is_str_dict(value):
+    return isinstance(value, dict) and all(isinstance(k, str) and isinstance(v, str) for k, v in value.items())
+
+
+def simulate(snapshots=None, base=None, grid=None, top_k=5):
+    """
+    What-if scoring against the current compiled matrix (used by /api/simulate).
+
+    Args:
+        snapshots: list of {param: PASS/FAIL/?} (unmentioned params = '?')
+        base + grid: expand '?' params of base (or the params listed in grid) into all PASS/FAIL combos
+        top_k: ranked results per snapshot (1..SIMULATE_MAX_TOP_K; clamped to SIMULATE_BATCH_MAX_TOP_K
+               and without per-condition contributions for a grid or more than
+               SIMULATE_EXPLAIN_MAX_SNAPSHOTS snapshots)
+    Raises:
+        ValueError: malformed input, or more than MAX_GRID_SNAPSHOTS snapshots in total
+    """
+    snapshots = [] if snapshots is None else snapshots
+    if not isinstance(snapshots, list) or not all(_is_str_dict(snap) for snap in snapshots):
+        raise ValueError("snapshots must be a list of {param: 'PASS' | 'FAIL' | '?'} objects")
+    if base is not None and not _is_str_dict(base):
+        raise ValueError("base must be a {param: 'PASS' | 'FAIL' | '?'} object")
+    if grid is not None and not isinstance(grid, bool) and not (
+            isinstance(grid, list) and all(isinstance(p, str) for p in grid)):
+        raise ValueError("grid must be true or a list of parameter names")
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= SIMULATE_MAX_TOP_K:
+        raise ValueError(f"top_k must be an integer between 1 and {SIMULATE_MAX_TOP_K}")
+
+    cfg = get_config()
+    compiled = cfg.compiled_matrix
+    if compiled is None:
+        raise Exception("Simulation needs numpy (matrix_engine) on the server")
+
+    # Explicit snapshots and the grid share ONE cap (the whole batch is scored in memory at once)
+    if len(snapshots) > MAX_GRID_SNAPSHOTS:
+        raise ValueError(f"{len(snapshots)} snapshots (max {MAX_GRID_SNAPSHOTS})")
+    snapshots = list(snapshots)
+    if base is not None or grid:
+        snapshots += compiled.grid(base or {}, grid if isinstance(grid, list) else None,
+                                   max_snapshots=MAX_GRID_SNAPSHOTS - len(snapshots))
+    batch = len(snapshots) > SIMULATE_EXPLAIN_MAX_SNAPSHOTS or base is not None or bool(grid)
+    if batch:
+        top_k = min(top_k, SIMULATE_BATCH_MAX_TOP_K)
+    full, ranked = compiled.simulate(snapshots, top_k, explain=not batch)
+    return {
+        "config_version": cfg.version,
+        "parameters": compiled.parameters,
+        "weights": compiled.parameter_weights(),
+        "results": [{"snapshot": s, "ranked": r} for s, r in zip(full, ranked)],
+    }
+
+
+def _match_matrix_batch(snapshots, matrix_data, top_k=None):
+    """Rank many snapshots at once (bot, backtesting). Returns list of results per snapshot."""
+    compiled = _compiled_matrix(matrix_data)
+    if compiled is not None:
+        return compiled.score(snapshots, top_k)
+    return [_match_matrix_loop(s, matrix_data)[:top_k] for s in snapshots]
 
 
 def _check_emergency(snapshot, data_values):
@@ -366,6 +939,95 @@ def _check_emergency(snapshot, data_values):
     return emergencies
 
 
+# ===========================
+# EMERGENCY FAST PATH
+# Sensor webhooks (Apps Script / ESP32) carry the new row. The rules of that tab are evaluated
+# on it IN MEMORY (cached config, no Sheets read) so experts are paged before the diagnosis runs.
+# Pages are deduplicated with run_diagnosis() per emergency type. A payload claim is only
+# re-armed by a diagnosis that has read past the payload row (the Sheets write can lag behind).
+# ===========================
+EMERGENCY_TYPES = {"Power Outage": "POWER", "Low DO": "DO"}
+EMERGENCY_REPAGE_SECONDS = int(os.getenv("EMERGENCY_REPAGE_SECONDS", "900"))
+
+_emergency_lock = threading.Lock()
+_emergency_pages = {}  # type -> {"at": time paged, "tab": payload tab, "rows": rows seen in it before the payload}
+
+
+def _can_rearm(page, rows_seen):
+    """A payload claim stays until the evaluated data includes a row appended after it."""
+    if page.get("tab") is None or rows_seen is None:
+        return True  # Claimed by a diagnosis / re-checked on a newer payload
+    if page.get("rows") is None:
+        return False  # Unknown position -> expires after EMERGENCY_REPAGE_SECONDS
+    return rows_seen.get(page["tab"], 0) > page["rows"]
+
+
+def claim_emergencies(emergencies, checked_types, rows_seen=None, payload_tab=None):
+    """
+    Emergencies that still need a page (not paged within EMERGENCY_REPAGE_SECONDS).
+    Types in checked_types that are no longer active are re-armed, unless they were
+    claimed from a webhook payload the data behind rows_seen ({tab: rows read}) predates.
+    payload_tab: the claim comes from check_payload_emergency() on that tab.
+    """
+    now = time.time()
+    active = {e["type"] for e in emergencies}
+    baseline = None
+    if payload_tab is not None:
+        last = _result_cache["last"]
+        if last is not None and last.live:
+            baseline = last.live["rows_seen"].get(payload_tab)
+    with _emergency_lock:
+        for t in set(checked_types) - active:
+            page = _emergency_pages.get(t)
+            if page is not None and _can_rearm(page, rows_seen):
+                del _emergency_pages[t]
+        claimed = []
+        for e in emergencies:
+            page = _emergency_pages.get(e["type"])
+            if page is None or now - page["at"] >= EMERGENCY_REPAGE_SECONDS:
+                _emergency_pages[e["type"]] = {"at": now, "tab": payload_tab, "rows": baseline}
+                claimed.append(e)
+    return claimed
+
+
+def check_payload_emergency(sheet_name, values):
+    """
+    Evaluate the rules of `sheet_name` against a webhook payload row ({header: value}).
+    Other tabs keep their last known status. Returns emergencies to page now (already claimed).
+    """
+    cfg = _cache["config"]
+    if cfg is None or not values:
+        return []  # No config in memory yet: the normal diagnosis path handles it
+
+    plan = cfg.rule_plan or _compile_rule_plan(cfg.rules, {})
+    prev = _result_cache["result"]
+    if prev is not None and prev.live and prev.live["plan"] is plan:
+        statuses = dict(prev.live["statuses"])
+    else:
+        statuses = {idx: ("FAIL", None) for idx in range(len(plan["steps"]))}
+
+    items = [(str(k), str(v).strip()) for k, v in values.items()]
+    headers = [k for k, _ in items]
+    checked = set()
+    for idx, step in enumerate(plan["steps"]):
+        if step["tab_source"] != sheet_name or step["window"]:
+            continue  # Windowed rules need history -> left to the diagnosis
+        col_idx, column = _find_column(headers, step["keyword"])
+        if col_idx is None or not items[col_idx][1]:
+            continue
+        val = items[col_idx][1]
+        passed = _step_passes(step, val, _parse_float(val))
+        statuses[idx] = ("PASS" if passed else "FAIL", {"value": val, "column": column, "tab": sheet_name})
+        if step["param"] in EMERGENCY_TYPES:
+            checked.add(EMERGENCY_TYPES[step["param"]])
+    if not checked:
+        return []
+
+    snapshot, data_values = _assemble_snapshot(plan, statuses)
+    emergencies = [e for e in _check_emergency(snapshot, data_values) if e["type"] in checked]
+    return claim_emergencies(emergencies, checked, payload_tab=sheet_name)
+
+
 def _format_data_summary(snapshot, data_values, rules):
     """Format sensor data summary for WhatsApp."""
     lines = []
@@ -414,17 +1076,10 @@ def _format_data_summary(snapshot, data_values, rules):
 def format_diagnosa_response():
     """Main entry point: run full diagnosis and return formatted WhatsApp message."""
     try:
-        # Always fetch (config cached internally, sensor data always fresh)
-        rules, tab_data, matrix_data = _fetch_all_data()
-        
-        # Phase 3: Evaluate rules
-        snapshot, data_values = _evaluate_rules(rules, tab_data)
-        
-        # Emergency check
-        emergencies = _check_emergency(snapshot, data_values)
-        
-        # Phase 4: Matrix matching
-        results = _match_matrix(snapshot, matrix_data)
+        # Shared result (fresh after new data, reused by 'detail' / 'analisa')
+        diag = get_diagnosis()
+        rules, snapshot, data_values = diag.rules, diag.snapshot, diag.data_values
+        results, emergencies = diag.results, diag.emergencies
         
         # Build WhatsApp message
         now = datetime.now().strftime("%d %b %Y, %H:%M WIB")
@@ -489,11 +1144,8 @@ def format_diagnosa_response():
 def format_diagnosa_detail():
     """Show detailed diagnosis breakdown."""
     try:
-        # Always fetch (config cached internally, sensor data always fresh)
-        rules, tab_data, matrix_data = _fetch_all_data()
-        
-        snapshot, data_values = _evaluate_rules(rules, tab_data)
-        results = _match_matrix(snapshot, matrix_data)
+        diag = get_diagnosis()
+        snapshot, data_values, results = diag.snapshot, diag.data_values, diag.results
         
         msg = "🔍 *DETAIL DIAGNOSA*\n"
         msg += "━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -525,76 +1177,159 @@ def format_diagnosa_detail():
         return f"⚠️ Error: {e}"
 
 
+# ===========================
+# AI EXPLANATION CACHE
+# 'analisa' answers from a cache keyed by (top diagnosis, snapshot fingerprint).
+# run_diagnosis() pre-generates it in the background when the top diagnosis changes,
+# so Gemini is only called on a miss (through ai_helper's prompt cache).
+# The cached text only depends on the key (conditions, no raw sensor numbers);
+# live values are appended to the reply outside the cached text.
+# ===========================
+EXPLANATION_TTL_SECONDS = int(os.getenv("DIAGNOSIS_EXPLANATION_TTL", "21600"))
+EXPLANATION_CACHE_SIZE = 32
+EXPLANATION_WAIT_SECONDS = 30  # 'analisa' during a background generation waits for it
+
+_explanation_lock = threading.Lock()
+_explanation_cache = {"entries": OrderedDict(), "inflight": {}}
+
+
+def _explanation_key(diag):
+    return diag.top["diagnosis"], diag.fingerprint
+
+
+def _cached_explanation(key):
+    """Call under _explanation_lock."""
+    entry = _explanation_cache["entries"].get(key)
+    if entry is None or time.time() - entry[0] >= EXPLANATION_TTL_SECONDS:
+        return None
+    _explanation_cache["entries"].move_to_end(key)
+    return entry[1]
+
+
+def _explanation_prompt(diag):
+    snapshot = diag.snapshot
+    results, emergencies = diag.results, diag.emergencies
+    top = results[0]
+    
+    # Condition status per parameter (no raw values: the text is cached per fingerprint)
+    status_text = "\n".join(f"  - {param}: {status}" for param, status in snapshot.items())
+    
+    # Active conditions
+    active = [k for k, v in snapshot.items() if v == "PASS"]
+    active_text = ", ".join(active) if active else "Tidak ada"
+    
+    # Build Gemini prompt
+    prompt = (
+        f"Kamu adalah ahli akuakultur bioflok Indonesia. "
+        f"Berdasarkan status kondisi kolam dan diagnosa berikut, berikan penjelasan untuk petambak.\n\n"
+        f"DIAGNOSA UTAMA: {top['diagnosis']} (confidence {int(top['final_score'])}%)\n"
+        f"Syarat cocok: {top['matched']}/{top['total']}\n\n"
+        f"STATUS KONDISI:\n{status_text}\n\n"
+        f"KONDISI AKTIF: {active_text}\n\n"
+    )
+    
+    if emergencies:
+        emg_text = ", ".join([e['title'] for e in emergencies])
+        prompt += f"⚠️ KONDISI DARURAT: {emg_text}\n\n"
+    
+    # Runner-ups for context
+    if len(results) > 1:
+        others = [f"{r['diagnosis']} ({int(r['final_score'])}%)" for r in results[1:3]]
+        prompt += f"KEMUNGKINAN LAIN: {', '.join(others)}\n\n"
+    
+    prompt += (
+        "TUGASMU:\n"
+        "1. Jelaskan MENGAPA diagnosa ini masuk akal\n"
+        "2. Hubungkan antar parameter (misal: suhu tinggi → DO turun)\n"
+        "3. Berikan 3 langkah KONKRIT yang harus dilakukan SEKARANG\n"
+        "4. Sebutkan 1 risiko jika tidak ditangani\n\n"
+        "FORMAT: Emoji + bullet points. Bahasa Indonesia. Mudah dimengerti petambak.\n"
+        "Jangan menyebut angka sensor (data terkini dikirim terpisah).\n"
+        "BATASAN: MAKSIMAL 120 kata. Sangat padat, langsung ke inti. Jangan bertele-tele."
+    )
+    return prompt
+
+
+def _explain(diag):
+    """Explanation text for diag: cache hit, wait for an in-flight generation, or call Gemini."""
+    key = _explanation_key(diag)
+    with _explanation_lock:
+        cached = _cached_explanation(key)
+        if cached is not None:
+            return cached
+        event = _explanation_cache["inflight"].get(key)
+        owner = event is None
+        if owner:
+            event = _explanation_cache["inflight"][key] = threading.Event()
+
+    if not owner:
+        event.wait(EXPLANATION_WAIT_SECONDS)
+        with _explanation_lock:
+            cached = _cached_explanation(key)
+        if cached is not None:
+            return cached
+        # Background generation failed / too slow -> generate here (not registered)
+
+    try:
+        from ai_helper import generate_text
+        ai_text = generate_text(_explanation_prompt(diag))
+        with _explanation_lock:
+            entries = _explanation_cache["entries"]
+            entries[key] = (time.time(), ai_text)
+            entries.move_to_end(key)
+            while len(entries) > EXPLANATION_CACHE_SIZE:
+                entries.popitem(last=False)
+        return ai_text
+    finally:
+        if owner:
+            with _explanation_lock:
+                _explanation_cache["inflight"].pop(key, None)
+            event.set()
+
+
+def _prefetch_worker(diag):
+    try:
+        _explain(diag)
+        print(f"🧠 Explanation pre-generated for {diag.top['diagnosis'][:40]}")
+    except Exception as e:
+        print(f"⚠️ Explanation prefetch failed: {e}")
+
+
+def prefetch_explanation(diag):
+    """Generate the explanation for diag on the LLM pool's background lane (no-op if cached or in flight)."""
+    if not diag.results:
+        return
+    key = _explanation_key(diag)
+    with _explanation_lock:
+        if _cached_explanation(key) is not None or key in _explanation_cache["inflight"]:
+            return
+    import llm_executor
+    llm_executor.submit(_prefetch_worker, diag, priority=llm_executor.PRIORITY_BACKGROUND)
+
+
 def generate_diagnosa_explanation():
     """
     Generate AI explanation for the current diagnosis.
     Calls Gemini to explain WHY the diagnosis makes sense,
     connects real data to the diagnosis, and gives actionable steps.
     Returns formatted WhatsApp message (separate bubble).
+    Served from the explanation cache when run_diagnosis() already pre-generated it.
     """
     try:
-        import os
-        from google import genai
-        client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-        
-        # Get fresh diagnosis data
-        rules, tab_data, matrix_data = _fetch_all_data()
-        snapshot, data_values = _evaluate_rules(rules, tab_data)
-        results = _match_matrix(snapshot, matrix_data)
-        emergencies = _check_emergency(snapshot, data_values)
+        # Same diagnosis the farmer just saw
+        diag = get_diagnosis()
         
-        if not results:
+        if not diag.results:
             return "✅ Tidak ada masalah terdeteksi. Kolam dalam kondisi baik."
         
-        top = results[0]
-        
-        # Build sensor context string
-        sensor_lines = []
-        for param, info in data_values.items():
-            sensor_lines.append(f"  - {param}: {info['value']}")
-        sensor_text = "\n".join(sensor_lines)
-        
-        # Active conditions
-        active = [k for k, v in snapshot.items() if v == "PASS"]
-        active_text = ", ".join(active) if active else "Tidak ada"
-        
-        # Build Gemini prompt
-        prompt = (
-            f"Kamu adalah ahli akuakultur bioflok Indonesia. "
-            f"Berdasarkan data sensor dan diagnosa berikut, berikan penjelasan untuk petambak.\n\n"
-            f"DIAGNOSA UTAMA: {top['diagnosis']} (confidence {int(top['final_score'])}%)\n"
-            f"Syarat cocok: {top['matched']}/{top['total']}\n\n"
-            f"DATA SENSOR TERKINI:\n{sensor_text}\n\n"
-            f"KONDISI AKTIF: {active_text}\n\n"
-        )
-        
-        if emergencies:
-            emg_text = ", ".join([e['title'] for e in emergencies])
-            prompt += f"⚠️ KONDISI DARURAT: {emg_text}\n\n"
-        
-        # Runner-ups for context
-        if len(results) > 1:
-            others = [f"{r['diagnosis']} ({int(r['final_score'])}%)" for r in results[1:3]]
-            prompt += f"KEMUNGKINAN LAIN: {', '.join(others)}\n\n"
-        
-        prompt += (
-            "TUGASMU:\n"
-            "1. Jelaskan MENGAPA diagnosa ini masuk akal\n"
-            "2. Hubungkan antar parameter (misal: suhu tinggi → DO turun)\n"
-            "3. Berikan 3 langkah KONKRIT yang harus dilakukan SEKARANG\n"
-            "4. Sebutkan 1 risiko jika tidak ditangani\n\n"
-            "FORMAT: Emoji + bullet points. Bahasa Indonesia. Mudah dimengerti petambak.\n"
-            "BATASAN: MAKSIMAL 120 kata. Sangat padat, langsung ke inti. Jangan bertele-tele."
-        )
+        ai_text = _explain(diag)
         
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt
-        )
-        ai_text = response.text.strip()
+        # Live values, never cached with the explanation text
+        live_lines = [f"  - {param}: {info['value']}" for param, info in diag.data_values.items()]
+        live_text = "\n\n📊 *Data terkini:*\n" + "\n".join(live_lines) if live_lines else ""
         
         # Format ringkas untuk WhatsApp (max 1500 char total)
-        msg = f"🧠 *PENJELASAN AI*\n\n{ai_text}\n\nKetik 'Menu' untuk kembali."
+        msg = f"🧠 *PENJELASAN AI*\n\n{ai_text}{live_text}\n\nKetik 'Menu' untuk kembali."
         
         return msg
         
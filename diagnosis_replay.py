@@ -0,0 +1,285 @@
+"""
+Diagnosis Replay Module
+=======================
+Backtest Diagnosis_Rules + Matrix Diagnosis terhadap seluruh histori tab sumber.
+
+Fitur:
+1. Replay urut timestamp atas semua tab yang dipakai rules (Water Quality, Farm Control,
+   Bio - Dead Fish, Feed Tracker, ...) dengan semantik _evaluate_rules / _match_matrix
+2. Time series snapshot + top-k diagnosa (hanya disimpan saat snapshot berubah)
+3. Skor terhadap Actual_Diagnosis / Status_Match di AI Event Log
+4. CLI + laporan teks / CSV
+
+Usage:
+    python diagnosis_replay.py --start 2026-01-01 --end 2026-03-31 --top-k 3 --csv replay.csv
+"""
+
+import re
+import csv
+import argparse
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, List
+
+import drive
+import diagnosis_engine as engine
+from rolling_window import RollingWindow, parse_timestamp
+from sheets_gateway import gated
+
+
+# === CONFIGURATION ===
+
+REPLAY_CONFIG = {
+    "top_k": 3,
+    "score_batch": 2000,   # Snapshot per panggilan batch scoring
+}
+
+# === DATA ===
+
+def _fetch_history(tab_names: List[str]) -> Dict[str, List[List[str]]]:
+    """Semua baris tiap tab dalam SATU values_batch_get."""
+    sh = drive.dashboard
+    if not sh:
+        raise Exception("Dashboard connection not available")
+    resp = gated(sh, "values_batch_get")([drive.a1_range(t) for t in tab_names])
+    history = {}
+    for tab_name, vr in zip(tab_names, resp.get("valueRanges", [])):
+        history[tab_name] = vr.get("values", [])
+    return history
+
+
+def _event_stream(history, start=None, end=None):
+    """(timestamp, tab, row) urut waktu; baris tanpa timestamp valid dilewati."""
+    events = []
+    for tab_name, values in history.items():
+        for row in values[1:]:
+            ts = parse_timestamp(row[0]) if row else None
+            if ts is None:
+                continue
+            events.append((ts, tab_name, row))
+    events.sort(key=lambda e: e[0])  # Stable: same timestamp keeps sheet order
+    # Rows before `start` still set the state, they are just not reported
+    return [e for e in events if end is None or e[0] <= end], start
+
+
+# === REPLAY ===
+
+def replay(start=None, end=None, top_k=None):
+    """
+    Replay diagnosis over history.
+
+    Returns:
+        List of change points: {"timestamp", "active", "top": [results...]}
+        (state holds until the next change point)
+    """
+    top_k = top_k or REPLAY_CONFIG["top_k"]
+    cfg = engine.get_config()
+    rules, matrix_data = cfg.rules, cfg.matrix
+    tab_names = sorted(set(r["tab_source"] for r in rules))
+
+    t0 = time.time()
+    history = _fetch_history(tab_names)
+    headers = {t: values[0] for t, values in history.items() if values and values[0]}
+    plan = engine._compile_rule_plan(rules, headers)
+    events, report_from = _event_stream(history, start, end)
+    print(f"📼 Replay: {len(events)} rows from {len(history)} tabs loaded in {time.time() - t0:.1f}s")
+
+    tab_ok = set(headers)
+    tab_columns = {}
+    for (tab_name, col_idx) in plan["columns"]:
+        tab_columns.setdefault(tab_name, []).append(col_idx)
+
+    latest = {key: (None, None) for key in plan["columns"]}
+    windows = {key: RollingWindow(key[2]) for key in plan["windows"]}
+    tab_windows = {}
+    for key in plan["windows"]:
+        tab_windows.setdefault(key[0], []).append(key)
+    window_steps = [idx for idxs in plan["windows"].values() for idx in idxs]
+    statuses = engine._evaluate_steps(plan, range(len(plan["steps"])), tab_ok, latest, windows)
+    snapshot, _ = engine._assemble_snapshot(plan, statuses)
+
+    t1 = time.time()
+    points = []
+    last_reported = None
+    for ts, tab_name, row in events:
+        touched = False
+        for col_idx in tab_columns.get(tab_name, []):
+            if col_idx < len(row) and row[col_idx].strip():
+                val = row[col_idx].strip()
+                latest[(tab_name, col_idx)] = (val, engine._parse_float(val))
+                touched = True
+        for key in tab_windows.get(tab_name, []):
+            col_idx = key[1]
+            num = engine._parse_float(row[col_idx]) if col_idx < len(row) else None
+            if num is not None:
+                windows[key].add(ts, num)
+        # Windows of every tab slide with the event time, not only the touched tab's
+        steps = plan["tab_steps"].get(tab_name, []) if touched else []
+        steps = list(steps) + [idx for idx in window_steps if idx not in steps]
+        if steps:
+            changed = engine._evaluate_steps(plan, steps, tab_ok, latest, windows, ts)
+            if any(statuses[i][0] != st[0] for i, st in changed.items()):
+                statuses.update(changed)
+                snapshot, _ = engine._assemble_snapshot(plan, statuses)
+            else:
+                statuses.update(changed)
+
+        if report_from is not None and ts < report_from:
+            continue
+        if last_reported is None or snapshot is not last_reported:
+            points.append({"timestamp": ts, "snapshot": snapshot})
+            last_reported = snapshot
+
+    # Score only distinct change points, in batches
+    batch = REPLAY_CONFIG["score_batch"]
+    for i in range(0, len(points), batch):
+        chunk = points[i:i + batch]
+        ranked = engine._match_matrix_batch([p["snapshot"] for p in chunk], matrix_data, top_k)
+        for p, results in zip(chunk, ranked):
+            p["top"] = results
+            p["active"] = [k for k, v in p["snapshot"].items() if v == "PASS"]
+    print(f"📼 Replay: {len(points)} snapshot changes scored in {time.time() - t1:.1f}s")
+    return points
+
+
+# === EVALUATION ===
+
+DIAGNOSIS_CODE_PATTERN = re.compile(r"^\s*(D\d+)\b", re.IGNORECASE)
+
+
+def _same_diagnosis(a: str, b: str) -> bool:
+    """Same diagnosis code ('D23' vs 'D23 – Low DO'), otherwise normalized exact match."""
+    code_a, code_b = DIAGNOSIS_CODE_PATTERN.match(a), DIAGNOSIS_CODE_PATTERN.match(b)
+    if code_a and code_b:
+        return code_a.group(1).upper() == code_b.group(1).upper()
+    a, b = " ".join(a.lower().split()), " ".join(b.lower().split())
+    return bool(a) and a == b
+
+
+def state_at(points, ts):
+    """Change point in effect at ts (None if before the first one)."""
+    idx = bisect_right([p["timestamp"] for p in points], ts) - 1
+    return points[idx] if idx >= 0 else None
+
+
+def evaluate_against_event_log(points, top_k=None, end=None):
+    """
+    Compare replay with AI Event Log rows that have Actual_Diagnosis filled in.
+    Only rows inside the replayed period (first change point .. end) are scored;
+    the others are counted as skipped.
+
+    Returns:
+        Dict with counts, hit@1 / hit@k and per-row details.
+    """
+    top_k = top_k or REPLAY_CONFIG["top_k"]
+    values = drive.event_log_tab.get_all_values() if drive.event_log_tab else []
+    header = [h.strip() for h in values[0]] if values else []
+    actual_col = header.index("Actual_Diagnosis") if "Actual_Diagnosis" in header else 4
+    status_col = header.index("Status_Match") if "Status_Match" in header else 5
+    timestamps = [p["timestamp"] for p in points]
+
+    rows, status_counts, skipped = [], {}, 0
+    for row in values[1:]:
+        ts = parse_timestamp(row[0]) if row else None
+        actual = row[actual_col].strip() if len(row) > actual_col else ""
+        if ts is None or not actual:
+            continue
+        if not points or ts < timestamps[0] or (end is not None and ts > end):
+            skipped += 1
+            continue
+        status = row[status_col].strip() if len(row) > status_col else ""
+        status_counts[status or "-"] = status_counts.get(status or "-", 0) + 1
+
+        top = points[bisect_right(timestamps, ts) - 1]["top"]
+        names = [r["diagnosis"] for r in top[:top_k]]
+        rows.append({
+            "timestamp": ts,
+            "logged": row[1] if len(row) > 1 else "",
+            "actual": actual,
+            "status_match": status,
+            "replay_top": names,
+            "hit1": bool(names) and _same_diagnosis(names[0], actual),
+            "hitk": any(_same_diagnosis(n, actual) for n in names),
+        })
+
+    n = len(rows)
+    return {
+        "labelled": n,
+        "skipped": skipped,
+        "hit1": sum(r["hit1"] for r in rows),
+        "hitk": sum(r["hitk"] for r in rows),
+        "top_k": top_k,
+        "status_match": status_counts,
+        "rows": rows,
+    }
+
+
+# === REPORT ===
+
+def format_report(points, evaluation) -> str:
+    lines = ["📼 *DIAGNOSIS REPLAY REPORT*", "━━━━━━━━━━━━━━━━━━━━"]
+    if points:
+        lines.append(f"Periode: {points[0]['timestamp']:%Y-%m-%d %H:%M} → {points[-1]['timestamp']:%Y-%m-%d %H:%M}")
+    lines.append(f"Perubahan snapshot: {len(points)}")
+
+    # Time spent as top-1 per diagnosis (by number of change points)
+    top_counts = {}
+    for p in points:
+        name = p["top"][0]["diagnosis"] if p["top"] else "(tidak ada)"
+        top_counts[name] = top_counts.get(name, 0) + 1
+    lines.append("\nTop-1 terbanyak:")
+    for name, count in sorted(top_counts.items(), key=lambda x: -x[1])[:10]:
+        lines.append(f"  {count:>6}x  {name}")
+
+    n = evaluation["labelled"]
+    lines.append(f"\nEvent Log berlabel (Actual_Diagnosis): {n}"
+                 f" (+{evaluation['skipped']} di luar periode replay, tidak dinilai)")
+    if n:
+        lines.append(f"  Hit@1: {evaluation['hit1']}/{n} ({evaluation['hit1'] / n * 100:.0f}%)")
+        lines.append(f"  Hit@{evaluation['top_k']}: {evaluation['hitk']}/{n} ({evaluation['hitk'] / n * 100:.0f}%)")
+        lines.append("  Status_Match di log: " + ", ".join(f"{k}={v}" for k, v in evaluation["status_match"].items()))
+        misses = [r for r in evaluation["rows"] if not r["hitk"]][:10]
+        if misses:
+            lines.append("\nMiss (max 10):")
+            for r in misses:
+                lines.append(f"  {r['timestamp']:%Y-%m-%d %H:%M} actual={r['actual']} | replay={', '.join(r['replay_top']) or '-'}")
+    return "\n".join(lines)
+
+
+def write_csv(points, path, top_k=None):
+    top_k = top_k or REPLAY_CONFIG["top_k"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        header = ["Timestamp", "Active"]
+        for i in range(1, top_k + 1):
+            header += [f"Top{i}", f"Score{i}"]
+        writer.writerow(header)
+        for p in points:
+            row = [p["timestamp"].strftime("%Y-%m-%d %H:%M:%S"), ", ".join(p["active"])]
+            for r in p["top"][:top_k]:
+                row += [r["diagnosis"], round(r["final_score"], 1)]
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay diagnosis over sheet history and score it against the AI Event Log.")
+    parser.add_argument("--start", help="Report from this date (YYYY-MM-DD), earlier rows still build state")
+    parser.add_argument("--end", help="Stop at this date (YYYY-MM-DD, inclusive)")
+    parser.add_argument("--top-k", type=int, default=REPLAY_CONFIG["top_k"])
+    parser.add_argument("--csv", help="Write the snapshot time series to this CSV file")
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, "%Y-%m-%d") if args.start else None
+    end = datetime.strptime(args.end + " 23:59:59", "%Y-%m-%d %H:%M:%S") if args.end else None
+
+    points = replay(start, end, args.top_k)
+    evaluation = evaluate_against_event_log(points, args.top_k, end)
+    print(format_report(points, evaluation))
+    if args.csv:
+        write_csv(points, args.csv, args.top_k)
+        print(f"\n💾 Time series saved to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
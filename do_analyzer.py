@@ -12,14 +12,15 @@ Fitur:
 import os
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Optional
-import gspread
 
 # Import from existing modules
 try:
     from drive import water_tab
     from thresholds import SOP_THRESHOLDS
+    import sensor_mirror
 except ImportError:
     water_tab = None
+    sensor_mirror = None
     SOP_THRESHOLDS = {"do": {"min": 5.0, "max": 6.5}}
 
 
@@ -57,67 +58,24 @@ def get_recent_do_readings(hours: int = 4, fallback: bool = False) -> List[Dict]
     Returns:
         List of dict dengan keys: timestamp, do_value, device
     """
-    if not water_tab:
+    if not water_tab or not sensor_mirror:
         return []
     
     try:
-        all_data = water_tab.get_all_values()
-        if len(all_data) < 2:
-            return []
+        # Sinkronisasi inkremental ke mirror lokal, lalu query window secara lokal
+        sensor_mirror.sync_water_quality()
+        cutoff_time = None if fallback else datetime.now() - timedelta(hours=hours)
         
         readings = []
-        cutoff_time = datetime.now() - timedelta(hours=hours)
-        
-        # Column indices
-        ts_idx = 0  # Timestamp
-        do_idx = 3  # DO column (index 3)
-        device_idx = 2  # Device
-        
-        for row in all_data[1:]:
-            try:
-                ts_str = row[ts_idx] if len(row) > ts_idx else ""
-                if not ts_str:
-                    continue
-                
-                # Robust Timestamp Parsing
-                ts = None
-                formats = [
-                    "%Y-%m-%d %H:%M:%S", 
-                    "%d/%m/%Y %H:%M:%S", 
-                    "%m/%d/%Y %H:%M:%S",
-                    "%Y/%m/%d %H:%M:%S"
-                ]
-                for fmt in formats:
-                    try:
-                        ts = datetime.strptime(ts_str, fmt)
-                        break
-                    except ValueError:
-                        continue
-                
-                if not ts:
-                    print(f"⚠️ Failed to parse TS: {ts_str}")
-                    continue
-
-                # Filter waktu hanya jika BUKAN fallback mode
-                if not fallback and ts < cutoff_time:
-                    continue
-                
-                do_str = row[do_idx] if len(row) > do_idx else ""
-                if not do_str or do_str == "-":
-                    continue
-                
-                do_val = float(do_str.replace(",", "."))
-                device = row[device_idx] if len(row) > device_idx else "Unknown"
-                
-                readings.append({
-                    "timestamp": ts,
-                    "do_value": do_val,
-                    "device": device
-                })
-            except (ValueError, IndexError):
+        for row in sensor_mirror.query_water_quality(since=cutoff_time):
+            if row["timestamp"] is None or row["do_value"] is None:
                 continue
+            readings.append({
+                "timestamp": row["timestamp"],
+                "do_value": row["do_value"],
+                "device": row["device"] if row["device"] is not None else "Unknown"
+            })
         
-        readings.sort(key=lambda x: x["timestamp"])
         return readings
         
     except Exception as e:
@@ -1,10 +1,15 @@
 import os
 import io
+import re
 import json
+import time
+import atexit
 import base64
 import pickle
+import threading
 import gspread
 import requests
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import random  # For mock confidence in demo
 from dotenv import load_dotenv
@@ -13,6 +18,13 @@ from google.oauth2 import service_account
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
+import sheets_gateway
+from sheets_gateway import gated
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: only the in-process lock guards the diagnosis log state
 
 # Load environment variables
 load_dotenv()
@@ -68,41 +80,421 @@ except Exception as e:
     print(f"❌ Error connecting to Google Sheets: {e}")
     dashboard = None
 
-# Define Worksheets (Safe Init)
-# Define Worksheets (Safe Init)
-def get_worksheet(name, headers):
-    if not dashboard: return None
-    
-    # 1. Try exact match
-    try:
-        ws = dashboard.worksheet(name)
-        # Check/Update Header if found
-        try:
-             # Basic check: if A1 is empty, likely new/empty
-             if not ws.acell('A1').value:
-                 ws.append_row(headers)
-                 ws.format('A1:Z1', {'textFormat': {'bold': True}})
-        except: pass
-        return ws
-    except gspread.WorksheetNotFound:
-        # 2. Try Case-Insensitive Match
+# === Lazy Worksheet Registry ===
+# All tabs are listed with ONE metadata call (dashboard.worksheets()) on first use.
+# Handles are created lazily and header validation ("is A1 empty?") is done once
+# per tab and remembered on disk, so importing drive.py costs no Sheets calls.
+HEADER_CACHE_PATH = os.getenv("SHEET_HEADER_CACHE", ".sheet_headers_ok.json")
+# A missing tab without headers (e.g. no Diagnosis_Rules) is not re-listed on every lookup
+MISSING_TAB_TTL_SECONDS = float(os.getenv("MISSING_TAB_TTL", "60"))
+
+
+class WorksheetRegistry:
+    """Title -> Worksheet lookup built from a single spreadsheet metadata fetch."""
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self._by_title = None
+        self._lock = threading.Lock()
+        self._validated = set()
+        self._missing = {}  # title -> time of the lookup that did not find it
         try:
-            all_sheets = dashboard.worksheets()
-            for sheet in all_sheets:
-                if sheet.title.lower() == name.lower():
-                    print(f"⚠️ Found sheet '{sheet.title}' matching '{name}', using it.")
-                    return sheet
-        except: pass
+            with open(HEADER_CACHE_PATH) as f:
+                self._validated = set(json.load(f))
+        except Exception:
+            pass
+
+    def _tabs(self, refresh=False):
+        if self._by_title is None or refresh:
+            self._by_title = {ws.title: ws for ws in gated(self.spreadsheet, "worksheets")()}
+        return self._by_title
+
+    def _find(self, name, refresh=False):
+        tabs = self._tabs(refresh)
+        if name in tabs:
+            return tabs[name]
+        for title, sheet in tabs.items():
+            if title.lower() == name.lower():
+                print(f"⚠️ Found sheet '{title}' matching '{name}', using it.")
+                return sheet
+        return None
 
-        # 3. Create New
+    def _validate_headers(self, ws, headers):
+        key = f"{self.spreadsheet.id}:{ws.id}"
+        if key in self._validated:
+            return
         try:
-            ws = dashboard.add_worksheet(title=name, rows=1000, cols=15)
-            ws.append_row(headers)
-            ws.format('A1:Z1', {'textFormat': {'bold': True}})
-            return ws
+            # Basic check: if A1 is empty, likely new/empty
+            if not gated(ws, "acell")('A1').value:
+                gated(ws, "append_row")(headers)
+                gated(ws, "format")('A1:Z1', {'textFormat': {'bold': True}})
+            self._validated.add(key)
+            with open(HEADER_CACHE_PATH, "w") as f:
+                json.dump(sorted(self._validated), f)
         except Exception as e:
-             print(f"❌ Failed to create worksheet '{name}': {e}")
-             return None
+            print(f"⚠️ Header check failed for '{ws.title}': {e}")
+
+    def open(self, name, headers=None):
+        """
+        Worksheet by title (exact, then case-insensitive).
+        With headers: missing tabs are created and empty tabs get the header row.
+        Without headers: a missing tab is answered with None for MISSING_TAB_TTL_SECONDS.
+        """
+        if not self.spreadsheet:
+            return None
+        with self._lock:
+            if headers is None and time.time() - self._missing.get(name, float("-inf")) < MISSING_TAB_TTL_SECONDS:
+                return None
+            try:
+                ws = self._find(name) or self._find(name, refresh=True)
+            except Exception as e:
+                print(f"❌ Cannot list worksheets: {e}")
+                return None
+
+            if ws is None:
+                if headers is None:
+                    self._missing[name] = time.time()
+                    return None
+                try:
+                    ws = gated(self.spreadsheet, "add_worksheet")(title=name, rows=1000, cols=15)
+                    gated(ws, "append_row")(headers)
+                    gated(ws, "format")('A1:Z1', {'textFormat': {'bold': True}})
+                    self._by_title[ws.title] = ws
+                    self._validated.add(f"{self.spreadsheet.id}:{ws.id}")
+                except Exception as e:
+                    print(f"❌ Failed to create worksheet '{name}': {e}")
+                    return None
+            elif headers:
+                self._validate_headers(ws, headers)
+            return ws
+
+
+class LazyWorksheet:
+    """
+    Stand-in for a gspread Worksheet, resolved through the registry on first use.
+    Every method call goes through sheets_gateway (quota limiter + 429 backoff).
+    """
+
+    def __init__(self, registry, name, headers=None):
+        self._registry = registry
+        self._name = name
+        self._headers = headers
+        self._ws = None
+
+    def resolve(self):
+        if self._ws is None:
+            self._ws = self._registry.open(self._name, self._headers)
+        return self._ws
+
+    def __bool__(self):
+        return self.resolve() is not None
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        ws = self.resolve()
+        if ws is None:
+            raise AttributeError(f"Worksheet '{self._name}' is not available ({attr})")
+        if callable(getattr(type(ws), attr, None)):
+            return gated(ws, attr)
+        return getattr(ws, attr)
+
+    def __repr__(self):
+        return f"<LazyWorksheet '{self._name}' resolved={self._ws is not None}>"
+
+
+registry = WorksheetRegistry(dashboard)
+
+
+def get_worksheet(name, headers=None):
+    """Resolve a worksheet now (None if missing and no headers to create it with)."""
+    return registry.open(name, headers)
+
+
+def lazy_worksheet(name, headers=None):
+    """Worksheet handle that costs no API call until it is first used."""
+    return LazyWorksheet(registry, name, headers)
+
+# === Tail Reader (Latest Rows Without get_all_values) ===
+# Row count per worksheet is learned once by probing single rows across the grid
+# (a few tiny batch reads, never a whole column) and kept locally; the header row is
+# re-read with every tail request (same batch call), never trusted from cache.
+# Every read probes a few rows past the known end, so rows appended by
+# ESP32 / Apps Script are picked up without downloading the whole tab.
+TAIL_PROBE_ROWS = 50
+TAIL_SEARCH_FANOUT = 16  # Rows probed per batch call while locating the last data row
+_tail_state = {}  # worksheet id -> {"rows": last data row (1-based), "headers": last row 1 read}
+
+
+def col_letter(col):
+    """1-based column number -> A1 column letter (1 -> A, 27 -> AA)."""
+    letters = ""
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def a1_range(tab_name, rng=None):
+    """Sheet-qualified A1 range, e.g. ('Water Quality', 'D:D') -> 'Water Quality'!D:D (no rng = whole tab)."""
+    quoted = "'" + tab_name.replace("'", "''") + "'"
+    return f"{quoted}!{rng}" if rng else quoted
+
+
+def _last_data_row(ws):
+    """
+    Last non-empty row, narrowed down from the grid size (row_count metadata) with batch reads
+    of TAIL_SEARCH_FANOUT single rows each: ~log16(grid rows) calls, whatever the tab length.
+    Assumes the data rows are contiguous (no empty row inside the data, as with append-only
+    log tabs): an empty row hit by a probe makes the result an underestimate, which
+    get_tail_rows() then corrects by probing forward.
+    """
+    lo, hi = 1, max(1, ws.row_count)  # Data ends somewhere in [lo, hi]
+    while hi - lo > TAIL_PROBE_ROWS:
+        step = (hi - lo) / TAIL_SEARCH_FANOUT
+        probes = sorted({min(hi, lo + max(1, round(step * i))) for i in range(1, TAIL_SEARCH_FANOUT + 1)})
+        found = ws.batch_get([f"{row}:{row}" for row in probes])
+        filled = [row for row, values in zip(probes, found) if values]
+        if filled:
+            lo = filled[-1]
+        hi = next((row - 1 for row in probes if row > lo), hi)
+    values = ws.batch_get([f"{lo}:{hi}"])[0]
+    return lo + len(values) - 1 if values else lo - 1
+
+
+def _tail_entry(ws):
+    entry = _tail_state.get(ws.id)
+    if entry is None:
+        entry = {"rows": _last_data_row(ws), "headers": []}
+        _tail_state[ws.id] = entry
+    return entry
+
+
+def reset_tail_cache(ws=None):
+    """Forget cached row counts/headers (all tabs, or a single worksheet)."""
+    if ws is None:
+        _tail_state.clear()
+    else:
+        _tail_state.pop(ws.id, None)
+
+
+def get_tail_rows(ws, n=1):
+    """
+    Read only the last n data rows of a worksheet by A1 range.
+    Row 1 is re-read in the same batch request, so inserted / reordered columns
+    are picked up at once. Returns (headers, rows); rows are cut/padded to the header width.
+    """
+    if not ws:
+        return [], []
+
+    entry = _tail_entry(ws)
+    start = max(2, entry["rows"] - n + 1)
+    probe = TAIL_PROBE_ROWS
+    relearned = False
+
+    while True:
+        end = start + n + probe
+        head, values = ws.batch_get(["1:1", f"{start}:{end}"])
+        headers = entry["headers"] = list(head[0]) if head else []
+        if not values:
+            if start <= 2:
+                entry["rows"] = 1
+                return headers, []
+            if relearned:
+                return headers, []
+            # Tab shrank (rows deleted) -> learn the row count again
+            reset_tail_cache(ws)
+            entry = _tail_entry(ws)
+            start = max(2, entry["rows"] - n + 1)
+            relearned = True
+            continue
+
+        entry["rows"] = start + len(values) - 1
+        if len(values) < end - start + 1:
+            break
+        # Probe window completely filled -> more rows may follow. The cached count can be far
+        # behind (rows appended by ESP32 / Apps Script): double the probe, O(log rows behind) calls
+        start = max(2, entry["rows"] - n + 1)
+        probe *= 2
+
+    width = max(len(headers), 1)
+    rows = [(list(r) + [""] * width)[:width] for r in values[-n:]]
+    return headers, rows
+
+
+# === Write-Behind Append Buffer ===
+# Rows are grouped per tab and written with ONE append_rows per tab,
+# either on a short timer or as soon as the buffer reaches APPEND_MAX_ROWS.
+# Every reader of a buffered tab calls flush_writes(<tab>) first (read-after-write).
+APPEND_FLUSH_SECONDS = float(os.getenv("APPEND_FLUSH_SECONDS", "2"))
+APPEND_MAX_ROWS = int(os.getenv("APPEND_MAX_ROWS", "50"))
+# Hard cap while Sheets is down: the oldest rows beyond this are dropped (and printed, so they
+# can be recovered from the log) instead of growing the buffer without bound
+APPEND_MAX_PENDING = int(os.getenv("APPEND_MAX_PENDING", "2000"))
+
+
+def _note_appended(ws, resp, n_rows):
+    """Keep the tail reader's row counter in sync with our own appends."""
+    entry = _tail_state.get(ws.id)
+    if entry is None:
+        return
+    try:
+        updated = resp["updates"]["updatedRange"]
+        entry["rows"] = max(entry["rows"], int(re.search(r"(\d+)$", updated).group(1)))
+    except Exception:
+        entry["rows"] += n_rows
+
+
+def _row_key(row):
+    """Comparable form of a row as written (RAW) and as read back (strings, '7,5' / '7.5')."""
+    cells = []
+    for value in row:
+        text = str(value).strip()
+        try:
+            cells.append(float(text.replace(",", ".")))
+        except ValueError:
+            cells.append(text)
+    while cells and cells[-1] == "":
+        cells.pop()
+    return tuple(cells)
+
+
+def _tab_name(ws):
+    """Buffer key of a worksheet handle: lazy handles are named without resolving them."""
+    if isinstance(ws, LazyWorksheet):
+        return ws._name
+    return ws.title
+
+
+class AppendBuffer:
+    """
+    Per-worksheet write buffer flushed by a background timer thread.
+    Rows are queued by tab name; the worksheet is only resolved when they are flushed, so a
+    Sheets outage before the tab was first opened keeps the rows queued instead of losing them.
+    A flush that failed with 5xx / timeout may still have been committed: those rows are
+    re-queued as "unconfirmed" and checked against the tab's tail before they are written again.
+    """
+
+    def __init__(self, flush_seconds=APPEND_FLUSH_SECONDS, max_rows=APPEND_MAX_ROWS,
+                 max_pending=APPEND_MAX_PENDING):
+        self.flush_seconds = flush_seconds
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.stats = {"rows": 0, "append_calls": 0, "errors": 0, "dropped": 0, "deduped": 0}
+        self._pending = {}      # tab name -> (worksheet handle, [rows])
+        self._unconfirmed = {}  # tab name -> [rows] of a failed append that may have landed
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def append(self, ws, row):
+        if ws is None:
+            raise ValueError("append to a worksheet that does not exist")
+        with self._lock:
+            self._pending.setdefault(_tab_name(ws), (ws, []))[1].append(row)
+            self.stats["rows"] += 1
+            queued = self._enforce_cap()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        if queued >= self.max_rows:
+            self.flush()
+
+    def flush(self, ws=None):
+        """Write pending rows now (all tabs, or only ws). Returns rows written."""
+        written = 0
+        with self._flush_lock:
+            with self._lock:
+                if ws is None:
+                    batch, self._pending = self._pending, {}
+                    unconfirmed, self._unconfirmed = self._unconfirmed, {}
+                else:
+                    name = _tab_name(ws)
+                    entry = self._pending.pop(name, None)
+                    batch = {name: entry} if entry else {}
+                    unconfirmed = {name: self._unconfirmed.pop(name)} if name in self._unconfirmed else {}
+
+            for name, (tab, rows) in batch.items():
+                suspects = unconfirmed.get(name, [])
+                try:
+                    if not tab:
+                        raise RuntimeError(f"worksheet '{name}' is not available")
+                    if suspects:
+                        rows = self._drop_committed(tab, rows, suspects)
+                        if not rows:
+                            continue
+                    resp = tab.append_rows(rows, value_input_option="RAW")
+                    with self._lock:
+                        self.stats["append_calls"] += 1
+                    _note_appended(tab, resp, len(rows))
+                    written += len(rows)
+                except Exception as e:
+                    print(f"❌ Append flush failed for '{name}' ({len(rows)} rows), will retry: {e}")
+                    with self._lock:
+                        self.stats["errors"] += 1
+                        # Put rows back in front so order is kept for the next attempt
+                        self._pending.setdefault(name, (tab, []))[1][:0] = rows
+                        if sheets_gateway.may_have_committed(e) or suspects:
+                            self._unconfirmed[name] = (suspects + rows)[-self.max_pending:]
+                        self._enforce_cap()
+        return written
+
+    def _drop_committed(self, tab, rows, suspects):
+        """Remove rows the failed append did write (found in the tab's tail). Raises if the tail can't be read."""
+        _, tail = get_tail_rows(tab, len(suspects) + TAIL_PROBE_ROWS)
+        landed = {}
+        for row in tail:
+            key = _row_key(row)
+            landed[key] = landed.get(key, 0) + 1
+        suspect_keys = {_row_key(row) for row in suspects}
+        kept = []
+        for row in rows:
+            key = _row_key(row)
+            if key in suspect_keys and landed.get(key):
+                landed[key] -= 1
+                continue
+            kept.append(row)
+        if len(kept) < len(rows):
+            with self._lock:
+                self.stats["deduped"] += len(rows) - len(kept)
+            print(f"♻️ Append retry for '{_tab_name(tab)}': {len(rows) - len(kept)} rows were already written, skipped")
+        return kept
+
+    def _enforce_cap(self):
+        """Drop the oldest rows of the largest tab while over max_pending (call under _lock). Returns rows queued."""
+        queued = sum(len(rows) for _, rows in self._pending.values())
+        while queued > self.max_pending:
+            name, (_, rows) = max(self._pending.items(), key=lambda item: len(item[1][1]))
+            dropped = rows[:queued - self.max_pending]
+            del rows[:len(dropped)]
+            queued -= len(dropped)
+            self.stats["dropped"] += len(dropped)
+            print(f"🗑️ Append buffer full ({self.max_pending} rows): dropped {len(dropped)} oldest rows for '{name}'")
+            for row in dropped:
+                print(f"   DROPPED {name}: {row}")
+        return queued
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            if self._pending:
+                with sheets_gateway.priority(sheets_gateway.PRIORITY_BACKGROUND):
+                    self.flush()
+
+
+append_buffer = AppendBuffer()
+atexit.register(append_buffer.flush)
+
+
+def buffered_append(ws, row):
+    """Queue a row for ws (written by the next flush)."""
+    append_buffer.append(ws, row)
+
+
+def flush_writes(ws=None):
+    """Force pending rows to the spreadsheet (read-after-write)."""
+    return append_buffer.flush(ws)
+
 
 # [MODIFIKASI] Definisi Header Baru (Sesuai 3 Kategori)
 # 1. Water Quality (Value & ADC first, then Photos at far right)
@@ -179,38 +571,39 @@ MATRIX_HEADERS = [
 # 8. AI Event Log Analysis (History of triggered diagnoses)
 EVENT_LOG_HEADERS = ["Timestamp", "Diagnosis", "Trigger Data", "Note", "Actual_Diagnosis", "Status_Match"]
 
-# Initialize Tabs
-water_tab = get_worksheet("Water Quality", WATER_HEADERS)
-control_tab = get_worksheet("Farm Control", CONTROL_HEADERS)
-video_tab = get_worksheet("Media - General Video", VIDEO_HEADERS)
-inverter_tab = get_worksheet("Machine - Inverter Data", INVERTER_HEADERS)
+# Initialize Tabs (lazy - resolved on first use)
+water_tab = lazy_worksheet("Water Quality", WATER_HEADERS)
+control_tab = lazy_worksheet("Farm Control", CONTROL_HEADERS)
+video_tab = lazy_worksheet("Media - General Video", VIDEO_HEADERS)
+inverter_tab = lazy_worksheet("Machine - Inverter Data", INVERTER_HEADERS)
 
 # Bio Tabs
-dead_fish_tab = get_worksheet("Bio - Dead Fish", DEAD_FISH_HEADERS)
-sampling_tab = get_worksheet("Sampling", SAMPLING_HEADERS)  # Renamed for clarity
+dead_fish_tab = lazy_worksheet("Bio - Dead Fish", DEAD_FISH_HEADERS)
+sampling_tab = lazy_worksheet("Sampling", SAMPLING_HEADERS)  # Renamed for clarity
 
 # Config (Dashboard removed - no longer needed)
-threshold_tab = get_worksheet("THRESHOLD", THRESHOLD_HEADERS)
+threshold_tab = lazy_worksheet("THRESHOLD", THRESHOLD_HEADERS)
 # realtime_tab = None  # Dashboard tab removed
-matrix_tab = get_worksheet("Matrix Diagnosis", MATRIX_HEADERS)
-event_log_tab = get_worksheet("AI Event Log Analysis", EVENT_LOG_HEADERS)
+matrix_tab = lazy_worksheet("Matrix Diagnosis", MATRIX_HEADERS)
+rules_tab = lazy_worksheet("Diagnosis_Rules")  # Config tab, never auto-created
+event_log_tab = lazy_worksheet("AI Event Log Analysis", EVENT_LOG_HEADERS)
 
 # === FEED TRACKER (Consolidated - Sukabumi Pilot Farm Methodology) ===
 
 # Unified Feed Tracker Tab (replaces 3 old tabs)
-feed_tracker_tab = get_worksheet("Feed Tracker", FEED_TRACKER_HEADERS)
+feed_tracker_tab = lazy_worksheet("Feed Tracker", FEED_TRACKER_HEADERS)
 
 # Target Pangan - Reference data from Sukabumi
 TARGET_FEED_HEADERS = [
     "Minggu", "Bobot Target (g)", "Feed Rate (%)", "Pangan Target (kg)", "FCR Standard"
 ]
-target_feed_tab = get_worksheet("Target Pangan", TARGET_FEED_HEADERS)
+target_feed_tab = lazy_worksheet("Target Pangan", TARGET_FEED_HEADERS)
 
 # FCR Analysis - Feed Conversion Ratio tracking (from client CSV Row 88-93)
 FCR_ANALYSIS_HEADERS = [
     "Minggu", "Kenaikan Bobot (kg)", "Pakan Mingguan (kg)", "FCR Real", "FCR Target", "Status"
 ]
-fcr_analysis_tab = get_worksheet("FCR Analysis", FCR_ANALYSIS_HEADERS)
+fcr_analysis_tab = lazy_worksheet("FCR Analysis", FCR_ANALYSIS_HEADERS)
 
 # Backward compatibility aliases
 feed_tab = feed_tracker_tab  # Alias for old code
@@ -222,75 +615,167 @@ weekly_tab = sampling_tab  # Fallback compatibility
 
 # === AI Dashboard & Diagnosis ===
 
-def update_dashboard(data_dict):
+def invalidate_diagnosis(reason=""):
+    """Source data changed -> drop the shared DiagnosisResult."""
+    try:
+        from diagnosis_engine import invalidate_diagnosis as _invalidate
+        _invalidate(reason)
+    except ImportError:
+        pass
+
+def update_dashboard(data_dict, on_diagnosis=None):
     """
     [UPDATED] Dashboard tab removed. Now only triggers diagnosis.
-    Called after data is logged to source tabs.
+    Called AFTER data is logged to source tabs: enqueues a background run
+    (see DiagnosisQueue), on_diagnosis() is called when it is done.
     """
+    diagnosis_queue.enqueue(on_diagnosis)
+
+# === Diagnosis Log State ===
+# Fingerprint of the last PASS/FAIL snapshot + last logged diagnosis, kept on disk so
+# run_diagnosis() never re-reads the whole AI Event Log. Rebuilt once per process from
+# a tail read of the log; a file lock stops several workers logging the same row twice.
+DIAGNOSIS_STATE_PATH = os.getenv("DIAGNOSIS_STATE_PATH", ".diagnosis_state.json")
+EVENT_LOG_TAIL_ROWS = 20
+_diag_state = {"loaded": False}
+_diag_state_lock = threading.Lock()
+
+
+@contextmanager
+def _diagnosis_state_locked():
+    """Thread lock + (POSIX) exclusive flock shared by every worker process."""
+    with _diag_state_lock:
+        with open(DIAGNOSIS_STATE_PATH + ".lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_diagnosis_state():
     try:
-        run_diagnosis()
-    except Exception as e:
-        print(f"⚠️ Auto-diagnosis error: {e}")
+        with open(DIAGNOSIS_STATE_PATH) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _write_diagnosis_state(state):
+    tmp = DIAGNOSIS_STATE_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, DIAGNOSIS_STATE_PATH)
 
-def run_diagnosis():
+
+def _state_from_event_log():
+    """Last Auto-Diagnosis row of the Event Log (one tail read) -> state, None if unreadable."""
+    from diagnosis_engine import snapshot_fingerprint
+    try:
+        _, rows = get_tail_rows(event_log_tab, EVENT_LOG_TAIL_ROWS)
+    except Exception as e:
+        print(f"⚠️ Event Log tail read failed: {e}")
+        return None
+    for row in reversed(rows):
+        # Sheets drops trailing empty cells: short rows have no AI note, skip them
+        if len(row) > 3 and row[3].startswith("Auto-Diagnosis"):
+            active = [t.rsplit(":", 1)[0] for t in row[2].split(", ") if t.endswith(":PASS")]
+            # Config digest unknown -> the next reading rescores once, then compares diagnosis text
+            return {"fingerprint": snapshot_fingerprint({p: "PASS" for p in active}),
+                    "config": None, "diagnosis": row[1]}
+    return {"fingerprint": None, "config": None, "diagnosis": ""}
+
+
+def _load_diagnosis_state():
+    """Call under _diagnosis_state_locked(). First call per process syncs with the Event Log tail."""
+    if not _diag_state["loaded"]:
+        _diag_state["loaded"] = True
+        rebuilt = _state_from_event_log()
+        if rebuilt is not None:
+            _write_diagnosis_state(rebuilt)
+            return rebuilt
+    return _read_diagnosis_state()
+
+
+def run_diagnosis(changed_tabs=None):
     """
     [UPDATED] Uses new diagnosis_engine for consistent results.
     Reads from source tabs directly (no Dashboard dependency).
     Logs to Event Log and notifies experts if diagnosis changes.
+    changed_tabs: only these tabs got new rows -> incremental update.
+    Unchanged snapshots (persisted fingerprint) stop before any Event Log access.
     """
     if not event_log_tab: return
     
     try:
-        from diagnosis_engine import _fetch_all_data, _evaluate_rules, _match_matrix, _check_emergency
-        
-        # Run full diagnosis pipeline
-        rules, tab_data, matrix_data = _fetch_all_data()
-        snapshot, data_values = _evaluate_rules(rules, tab_data)
-        results = _match_matrix(snapshot, matrix_data)
-        emergencies = _check_emergency(snapshot, data_values)
-        
-        if not results:
-            print("✅ Auto-Diagnosis: No issues detected")
-            return
-        
-        top = results[0]
-        diag_text = top["diagnosis"]
-        score = int(top["final_score"])
-        
-        # Only log if score >= 40% (meaningful match)
-        if score < 40:
-            print(f"✅ Auto-Diagnosis: Top match below threshold ({score}%)")
-            return
-        
-        # Check if diagnosis changed from last event log entry
-        try:
-            log_data = event_log_tab.get_all_values()
-            last_diag = log_data[-1][1] if len(log_data) > 1 else ""
-        except:
-            last_diag = ""
-        
-        if diag_text == last_diag:
-            print(f"📉 Auto-Diagnosis: Same as last ({diag_text[:40]}), skipping log")
-            return
+        from diagnosis_engine import (get_diagnosis, update_diagnosis, claim_emergencies,
+                                      EMERGENCY_TYPES, prefetch_explanation)
         
-        # Build trigger summary
-        triggers = [f"{k}:{v}" for k, v in snapshot.items() if v == "PASS"]
-        trigger_str = ", ".join(triggers)
+        # Run diagnosis pipeline (emergency lane: runs ahead of menu lookups)
+        with sheets_gateway.priority(sheets_gateway.PRIORITY_EMERGENCY):
+            diag = update_diagnosis(changed_tabs) if changed_tabs else get_diagnosis()
+        snapshot, data_values = diag.snapshot, diag.data_values
+        results, emergencies = diag.results, diag.emergencies
         
-        # Log without Gemini (save API quota for manual 'analisa' requests)
-        ai_note = f"Auto-Diagnosis ({score}%): {top['matched']}/{top['total']} conditions matched"
-        
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        event_log_tab.append_row([timestamp, diag_text, trigger_str, ai_note, "", ""])
-        print(f"🚨 Matrix Diagnosis: {diag_text[:50]} ({score}%) | Logged")
-        
-        # Emergency notification
-        if emergencies:
+        # Emergency notification: once per emergency, shared with the webhook fast path
+        # (cleared emergencies re-arm, so the next occurrence pages again)
+        rows_seen = diag.live["rows_seen"] if diag.live else None
+        if claim_emergencies(emergencies, EMERGENCY_TYPES.values(), rows_seen):
             try:
                 from scheduler import notify_experts
                 sensor_ctx = {p: info["value"] for p, info in data_values.items()}
                 notify_experts("SYSTEM-AUTO", sensor_ctx)
             except: pass
+        
+        with _diagnosis_state_locked():
+            state = _load_diagnosis_state()
+            if state.get("fingerprint") == diag.fingerprint and state.get("config") == diag.config_digest:
+                print("📉 Auto-Diagnosis: Snapshot unchanged, skipping")
+                return
+
+            def mark_seen(**extra):
+                # Only once the snapshot is fully handled: a failed Event Log write must retry next run
+                state.update(fingerprint=diag.fingerprint, config=diag.config_digest, **extra)
+                _write_diagnosis_state(state)
+            
+            if not results:
+                mark_seen()
+                print("✅ Auto-Diagnosis: No issues detected")
+                return
+            
+            top = results[0]
+            diag_text = top["diagnosis"]
+            score = int(top["final_score"])
+            
+            # Only log if score >= 40% (meaningful match)
+            if score < 40:
+                mark_seen()
+                print(f"✅ Auto-Diagnosis: Top match below threshold ({score}%)")
+                return
+            
+            # Check if diagnosis changed from the last logged one (persisted state, no sheet read)
+            if diag_text == state.get("diagnosis", ""):
+                mark_seen()
+                print(f"📉 Auto-Diagnosis: Same as last ({diag_text[:40]}), skipping log")
+                return
+            
+            # Build trigger summary
+            triggers = [f"{k}:{v}" for k, v in snapshot.items() if v == "PASS"]
+            trigger_str = ", ".join(triggers)
+            
+            # Log without Gemini (save API quota for manual 'analisa' requests)
+            ai_note = f"Auto-Diagnosis ({score}%): {top['matched']}/{top['total']} conditions matched"
+            
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            event_log_tab.append_row([timestamp, diag_text, trigger_str, ai_note, "", ""])
+            mark_seen(diagnosis=diag_text)
+            print(f"🚨 Matrix Diagnosis: {diag_text[:50]} ({score}%) | Logged")
+        
+        # New top diagnosis -> have the 'analisa' explanation ready before anyone asks
+        # (same top diagnosis: 'analisa' fills the cache on a miss)
+        prefetch_explanation(diag)
     
     except Exception as e:
         print(f"⚠️ Diagnosis matching error: {e}")
@@ -303,6 +788,65 @@ def run_diagnosis():
 
 
 
+# === Background Diagnosis Queue ===
+# Writers (log_reading / log_sensor_data) enqueue a diagnosis AFTER their rows are queued.
+# Requests arriving within DIAGNOSIS_COALESCE_SECONDS collapse into ONE run (flush + diagnosis);
+# requests arriving during a run trigger exactly one more. Callbacks fire after the run.
+DIAGNOSIS_COALESCE_SECONDS = float(os.getenv("DIAGNOSIS_COALESCE_SECONDS", "2"))
+
+
+class DiagnosisQueue:
+    """Single background worker running coalesced run_diagnosis() jobs."""
+
+    def __init__(self, coalesce_seconds=DIAGNOSIS_COALESCE_SECONDS):
+        self.coalesce_seconds = coalesce_seconds
+        self.stats = {"requests": 0, "runs": 0, "errors": 0}
+        self._pending = False
+        self._callbacks = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def enqueue(self, callback=None):
+        with self._cond:
+            self._pending = True
+            self.stats["requests"] += 1
+            if callback:
+                self._callbacks.append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.coalesce_seconds)  # Let the rest of the burst land
+            with self._cond:
+                self._pending = False
+                callbacks, self._callbacks = self._callbacks, []
+
+            self.stats["runs"] += 1
+            try:
+                flush_writes()  # Diagnosis must see the rows just logged
+                # A get_diagnosis() during the coalesce window read the sheet BEFORE the flush
+                # and cached that result; drop it so run_diagnosis() reads the new rows
+                invalidate_diagnosis("rows flushed")
+                run_diagnosis()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"⚠️ Auto-diagnosis error: {e}")
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"⚠️ Diagnosis callback error: {e}")
+
+
+diagnosis_queue = DiagnosisQueue()
+
+
 # === Google Drive ===
 drive_service = build('drive', 'v3', credentials=drive_creds)
 TARGET_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
@@ -425,16 +969,15 @@ def upload_photo(field_name, phone, date, file_url):
     raise Exception(f"Failed to upload photo to Drive after {max_retries} attempts")
 
 
-def log_reading(phone, data_dict):
+def log_reading(phone, data_dict, on_diagnosis=None):
     """
     Log manual reading from WhatsApp to multiple tabs based on data type.
     Updated for SPLIT BIOLOGICAL TABS and DASHBOARD integration.
+    Rows are written first; diagnosis runs afterwards in the background and
+    on_diagnosis() (e.g. the WhatsApp reply) is called once it has finished.
     """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Update Real-time Dashboard
-    update_dashboard(data_dict)
-    
     # 1. Log to Water Quality Tab (if DO/pH/Temp/TDS exists)
     water_keys = ["do", "ph", "temp", "tds"]
     if any(k in data_dict for k in water_keys):
@@ -450,7 +993,7 @@ def log_reading(phone, data_dict):
             data_dict.get("temp_photo", ""),
             data_dict.get("note", "")
         ]
-        water_tab.append_row(row)
+        buffered_append(water_tab, row)
         print("✅ Logged to Water Quality")
 
     # 1B. Log to General Video Tab
@@ -458,7 +1001,7 @@ def log_reading(phone, data_dict):
         video_link = data_dict.get("general_video_photo") or data_dict.get("general_video", "")
         if str(video_link).startswith("http"):
             row = [timestamp, phone, video_link, data_dict.get("note", "")]
-            video_tab.append_row(row)
+            buffered_append(video_tab, row)
             print("✅ Logged to Media - General Video")
 
     # 2. Log to Farm Control (IoT Machinery)
@@ -472,7 +1015,7 @@ def log_reading(phone, data_dict):
             data_dict.get("aerator_relay", ""),
             data_dict.get("control_note", "")
         ]
-        control_tab.append_row(row)
+        buffered_append(control_tab, row)
         print("✅ Logged to Farm Control")
 
     # 2B. Log to Machine - Inverter Data (Manual)
@@ -483,7 +1026,7 @@ def log_reading(phone, data_dict):
             data_dict.get("inv_rest", ""), data_dict.get("inv_rest_photo", ""),
             data_dict.get("control_note", "") or data_dict.get("note", "")
         ]
-        inverter_tab.append_row(row)
+        buffered_append(inverter_tab, row)
         print("✅ Logged to Machine - Inverter Data")
 
     # 3. Log to Bio - Dead Fish
@@ -494,7 +1037,7 @@ def log_reading(phone, data_dict):
             data_dict.get("dead_fish_photo", ""),
             data_dict.get("bio_note", "")
         ]
-        dead_fish_tab.append_row(row)
+        buffered_append(dead_fish_tab, row)
         print("✅ Logged to Bio - Dead Fish")
 
     # 4. Log to Bio - Feeding Data (Merged)
@@ -506,21 +1049,21 @@ def log_reading(phone, data_dict):
             data_dict.get("feed_weight_photo", ""),
             data_dict.get("bio_note", "")
         ]
-        feed_tab.append_row(row)
+        buffered_append(feed_tab, row)
         print("✅ Logged to Bio - Feeding Data")
 
-def log_sensor_data(device_id, sensor_data):
-    """
-    Log automatic sensor data to Water Quality and Control Tabs.
-    """
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    invalidate_diagnosis("manual reading")
     
-    # Update Real-time Dashboard
-    update_dashboard(sensor_data)
+    # Diagnosis after the write (background, coalesced)
+    update_dashboard(data_dict, on_diagnosis)
+
+def _sensor_rows(device_id, sensor_data, timestamp):
+    """ESP32 readings -> {worksheet handle: row} for Water Quality / Farm Control."""
+    rows = {}
     
-    # 1. Log to Water Quality
+    # 1. Water Quality
     if any(k in sensor_data for k in ["do", "ph", "tds", "temp"]):
-        row = [
+        rows[water_tab] = [
             timestamp, "IoT-Sensor", device_id,
             sensor_data.get("do", ""), sensor_data.get("do_adc", ""),
             sensor_data.get("ph", ""), sensor_data.get("ph_adc", ""),
@@ -529,11 +1072,10 @@ def log_sensor_data(device_id, sensor_data):
             "", "", "", "", # Photo columns (empty for IoT)
             "" # Note
         ]
-        water_tab.append_row(row)
     
-    # 2. Log to Farm Control (IoT Machinery Status)
+    # 2. Farm Control (IoT Machinery Status)
     if any(k in sensor_data for k in ["ac_status", "dc_status", "pump_relay", "aerator_relay"]):
-        row = [
+        rows[control_tab] = [
             timestamp, "IoT-Sensor", device_id,
             sensor_data.get("ac_status", ""),
             sensor_data.get("dc_status", ""),
@@ -541,9 +1083,31 @@ def log_sensor_data(device_id, sensor_data):
             sensor_data.get("aerator_relay", ""),
             "" # Note
         ]
-        control_tab.append_row(row)
+    return rows
+
+
+def sensor_payload_values(device_id, sensor_data):
+    """
+    ESP32 readings as {tab name: {header: value}} - the rows log_sensor_data() writes,
+    in the same shape as the Apps Script payload (emergency fast path).
+    """
+    headers = {water_tab: WATER_HEADERS, control_tab: CONTROL_HEADERS}
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {_tab_name(tab): {h: str(v) for h, v in zip(headers[tab], row)}
+            for tab, row in _sensor_rows(device_id, sensor_data, timestamp).items()}
+
+
+def log_sensor_data(device_id, sensor_data):
+    """
+    Log automatic sensor data to Water Quality and Control Tabs.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for tab, row in _sensor_rows(device_id, sensor_data, timestamp).items():
+        buffered_append(tab, row)
         
     print(f"✅ Sensor data logged from {device_id}")
+    invalidate_diagnosis("sensor data")
+    update_dashboard(sensor_data)
 
 def log_weekly(phone, data_dict):
     """
@@ -595,20 +1159,22 @@ def log_weekly(phone, data_dict):
 def get_recent_trends(n=3):
     """Fetch and format last n rows of daily readings as AI prompt context."""
     try:
-        records = daily_tab.get_all_records()
+        # Local Water Quality mirror (incremental sync, no full-tab download)
+        from sensor_mirror import sync_water_quality, query_water_quality
+        sync_water_quality()
+        records = query_water_quality(last_n=n)
         if not records:
             return "No recent data available."
 
-        recent = records[-n:]
+        def fmt(val):
+            return "?" if val is None else val
+
         trend_lines = []
-        for row in recent:
-            timestamp = row.get("Timestamp", "Unknown time")
-            do = row.get("DATA 1 - DO (mg/L)", "?")
-            ph = row.get("DATA 3 - pH", "?")
-            temp = row.get("DATA 5 - Temp (°C)", "?")
-            deaths = row.get("DATA 9 - Fish Deaths", "?")
+        for row in records:
+            timestamp = row.get("ts_raw") or "Unknown time"
             trend_lines.append(
-                f"{timestamp} — DO: {do}, pH: {ph}, Temp: {temp}, Deaths: {deaths}"
+                f"{timestamp} — DO: {fmt(row['do_value'])}, pH: {fmt(row['ph_value'])}, "
+                f"Temp: {fmt(row['temp_value'])}, TDS: {fmt(row['tds_value'])}"
             )
 
         return "\n".join(trend_lines)
@@ -618,15 +1184,14 @@ def get_recent_trends(n=3):
 # [MODIFIKASI] Fungsi untuk mengambil data terakhir dari Spreadsheet
 def get_latest_daily_data():
     try:
-        # Ambil semua data (hati-hati jika data sangat banyak, tapi untuk pemula ini oke)
-        # Lebih efisien ambil baris terakhir saja jika tahu jumlah baris
-        all_values = daily_tab.get_all_values()
+        # Ambil baris terakhir saja (tail read), bukan seluruh tab
+        flush_writes(daily_tab)
+        headers, rows = get_tail_rows(daily_tab, 1)
         
-        if len(all_values) < 2: # Cuma header atau kosong
+        if not rows: # Cuma header atau kosong
             return None
             
-        headers = all_values[0]
-        last_row = all_values[-1]
+        last_row = rows[-1]
         
         # Gabungkan Header dengan Isinya
         data = {}
@@ -648,22 +1213,26 @@ def get_latest_logged_data():
     """
     state = {}
     try:
+        # Rows of the reading just confirmed may still be buffered
+        for tab in (water_tab, dead_fish_tab, feed_tab, control_tab):
+            flush_writes(tab)
+
         # Water Quality
-        water_rows = water_tab.get_all_values()
-        if len(water_rows) > 1:
+        _, water_rows = get_tail_rows(water_tab, 1)
+        if water_rows:
             last = water_rows[-1]
             state.update({"do": last[3], "ph": last[5], "tds": last[7], "temp": last[9]})
         
         # Bio
-        death_rows = dead_fish_tab.get_all_values()
-        if len(death_rows) > 1: state["dead_fish"] = death_rows[-1][2]
+        _, death_rows = get_tail_rows(dead_fish_tab, 1)
+        if death_rows: state["dead_fish"] = death_rows[-1][2]
         
-        feed_rows = feed_tab.get_all_values()
-        if len(feed_rows) > 1: state["feed_weight"] = feed_rows[-1][2]
+        _, feed_rows = get_tail_rows(feed_tab, 1)
+        if feed_rows: state["feed_weight"] = feed_rows[-1][2]
 
         # Control
-        control_rows = control_tab.get_all_values()
-        if len(control_rows) > 1:
+        _, control_rows = get_tail_rows(control_tab, 1)
+        if control_rows:
             last = control_rows[-1]
             state.update({"ac_status": last[3], "dc_status": last[4], "pump_relay": last[5], "aerator_relay": last[6]})
 
@@ -723,6 +1292,9 @@ def log_daily_feed(pangan_kg: float, harga_per_kg: float = 11000,
         return {"status": "ERROR", "message": "Tab 'Feed Tracker' tidak tersedia"}
     
     try:
+        # Rows still buffered (log_reading) must land before counting days
+        flush_writes(feed_tracker_tab)
+
         # Get current data to calculate Day number
         all_data = feed_tracker_tab.get_all_values()
         day_number = len(all_data)  # Row 1 = header, so len = day number
@@ -764,6 +1336,7 @@ def get_daily_feed_count():
     if not feed_tracker_tab:
         return 0
     try:
+        flush_writes(feed_tracker_tab)
         all_data = feed_tracker_tab.get_all_values()
         return max(0, len(all_data) - 1)  # Exclude header
     except:
@@ -785,6 +1358,7 @@ def get_weekly_feed_summary(week_number: int = None):
         return {"status": "ERROR", "message": "Tab tidak tersedia"}
     
     try:
+        flush_writes(feed_tracker_tab)
         all_data = feed_tracker_tab.get_all_values()
         if len(all_data) < 2:
             return {"status": "NO_DATA", "message": "Belum ada data pakan"}
@@ -0,0 +1,391 @@
+"""
+LLM Executor Module
+===================
+Satu pintu untuk semua panggilan Gemini (mirip sheets_gateway untuk Sheets).
+
+Fitur:
+1. Worker pool terbatas + antrean terbatas (menggantikan threading.Thread per request)
+2. Priority lane: alert pakar > diagnosa > chat petambak > background
+   (alert punya pool kecil + antrean sendiri, background maksimal workers-1 agar selalu ada worker untuk petambak)
+3. Fairness per pengirim: job ke-n seorang sender antre di belakang job pertama sender lain
+4. Budget RPM / TPM (sliding window 60 detik), waiter prioritas tinggi dilayani dulu
+5. Timeout per panggilan + hormati retry-after dari 429, backoff untuk 5xx
+"""
+
+import os
+import re
+import time
+import heapq
+import random
+import threading
+import itertools
+from collections import deque
+from contextlib import contextmanager
+
+
+# === CONFIGURATION ===
+
+LLM_CONFIG = {
+    "workers": int(os.getenv("LLM_WORKERS", "3")),
+    "queue_max": int(os.getenv("LLM_QUEUE_MAX", "30")),
+    "max_per_sender": int(os.getenv("LLM_MAX_PER_SENDER", "2")),
+    "max_background": int(os.getenv("LLM_MAX_BACKGROUND", "1")),  # Capped below `workers` (0 = only when idle)
+    "alert_workers": int(os.getenv("LLM_ALERT_WORKERS", "1")),
+    "alert_queue_max": int(os.getenv("LLM_ALERT_QUEUE_MAX", "20")),
+    "rpm": int(os.getenv("LLM_RPM", "15")),
+    "tpm": int(os.getenv("LLM_TPM", "1000000")),
+    "call_timeout_s": float(os.getenv("LLM_CALL_TIMEOUT", "60")),
+    "admission_timeout_s": float(os.getenv("LLM_ADMISSION_TIMEOUT", "90")),  # Max wait for budget
+    "max_retries": 3,
+    "backoff_base_s": 2.0,
+}
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Priority lanes (angka kecil = didahulukan)
+PRIORITY_ALERT = 0
+PRIORITY_DIAGNOSIS = 1
+PRIORITY_CHAT = 2
+PRIORITY_BACKGROUND = 3
+
+
+class LLMBusyError(Exception):
+    """Antrean penuh / budget tidak tersedia dalam batas waktu."""
+
+
+# === PRIORITY CONTEXT ===
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level):
+    """Semua panggilan Gemini di blok ini (thread yang sama) memakai lane `level`."""
+    previous = getattr(_local, "priority", None)
+    _local.priority = level if previous is None else min(previous, level)
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    level = getattr(_local, "priority", None)
+    return PRIORITY_CHAT if level is None else level
+
+
+# === RPM / TPM BUDGET ===
+
+class RateBudget:
+    """Sliding 60 s window of (time, tokens); next slot always goes to the most important waiter."""
+
+    WINDOW_S = 60.0
+
+    def __init__(self, rpm, tpm):
+        self.rpm = max(1, rpm)
+        self.tpm = max(1, tpm)
+        self.blocked_until = 0.0  # Set from retry-after on 429
+        self._calls = deque()     # (time, tokens)
+        self._tokens = 0
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _expire(self, now):
+        while self._calls and now - self._calls[0][0] >= self.WINDOW_S:
+            self._tokens -= self._calls.popleft()[1]
+
+    def _wait_time(self, now, tokens, level):
+        # Alerts still try during a retry-after pause (call() backs off again if it 429s)
+        if level > PRIORITY_ALERT and now < self.blocked_until:
+            return self.blocked_until - now
+        if len(self._calls) >= self.rpm:
+            return self._calls[0][0] + self.WINDOW_S - now
+        if self._calls and self._tokens + tokens > self.tpm:
+            return self._calls[0][0] + self.WINDOW_S - now
+        return 0.0
+
+    def acquire(self, tokens, level, timeout):
+        """Reserve one request + `tokens`. Returns a slot for settle(); raises LLMBusyError on timeout."""
+        deadline = time.monotonic() + timeout
+        ticket = (level, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._expire(now)
+                    wait = self._wait_time(now, tokens, level) if self._waiters[0] == ticket else None
+                    if wait == 0.0:
+                        slot = [now, tokens]
+                        self._calls.append(slot)
+                        self._tokens += tokens
+                        return slot
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise LLMBusyError("Gemini budget not available in time")
+                    self._cond.wait(min(remaining, wait) if wait is not None else remaining)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def settle(self, slot, actual_tokens):
+        """Replace the estimate with the real token count from usage metadata."""
+        if actual_tokens is None:
+            return
+        with self._cond:
+            if slot in self._calls:
+                self._tokens += actual_tokens - slot[1]
+                slot[1] = actual_tokens
+
+    def block_for(self, seconds):
+        """Server said quota exhausted: every lane except alerts pauses until retry-after."""
+        with self._cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+
+budget = RateBudget(LLM_CONFIG["rpm"], LLM_CONFIG["tpm"])
+
+
+# === STATS ===
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "errors": 0, "retries": 0, "rejected": 0, "submitted": 0, "wait_s": 0.0}
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["queued"] = executor.queued()
+    return stats
+
+
+# === CALL ===
+
+def _status_of(error):
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return code
+    text = str(error)
+    if "RESOURCE_EXHAUSTED" in text or "429" in text:
+        return 429
+    match = re.search(r"\b(50[0-4])\b", text)
+    return int(match.group(1)) if match else None
+
+
+def _retry_after(error):
+    """Seconds from 'retryDelay': '37s' / 'retry in 37.5s' in the error, None if absent."""
+    match = re.search(r"retry(?:Delay['\"]?\s*:\s*['\"]?| in |[-_ ]after\s*:?\s*)(\d+(?:\.\d+)?)\s*s", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+
+def estimate_tokens(contents):
+    """~4 characters per token, enough for budgeting."""
+    return max(1, len(str(contents)) // 4)
+
+
+def settle(slot, usage):
+    """Replace the slot's token estimate with usage_metadata.total_token_count (if known)."""
+    budget.settle(slot, getattr(usage, "total_token_count", None))
+
+
+def call(fn, est_tokens=1, level=None, keep_slot=False):
+    """
+    Run one Gemini request `fn()` under the RPM/TPM budget with retries.
+
+    Args:
+        fn: Zero-argument callable doing the request (client timeout set in ai_helper)
+        est_tokens: Prompt + expected output tokens (settled from usage_metadata afterwards)
+        level: Priority lane (default: from `priority()` context)
+        keep_slot: Streaming: return (response, slot) and let the caller settle() the slot
+                   once the last chunk (with usage_metadata) has arrived
+    """
+    level = current_priority() if level is None else level
+    deadline = time.monotonic() + LLM_CONFIG["admission_timeout_s"]
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        slot = budget.acquire(est_tokens, level, max(0.0, deadline - started))
+        _count("wait_s", time.monotonic() - started)
+        _count("calls")
+        try:
+            response = fn()
+            if keep_slot:
+                return response, slot
+            settle(slot, getattr(response, "usage_metadata", None))
+            return response
+        except Exception as e:
+            status = _status_of(e)
+            if status not in RETRYABLE_STATUS or attempt >= LLM_CONFIG["max_retries"]:
+                _count("errors")
+                raise
+            delay = _retry_after(e) if status == 429 else None
+            if delay is None:
+                delay = LLM_CONFIG["backoff_base_s"] * (2 ** attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+            if status == 429:
+                budget.block_for(delay)
+            if time.monotonic() + delay > deadline:
+                _count("errors")
+                raise
+            attempt += 1
+            _count("retries")
+            print(f"⏳ Gemini {status}, retry {attempt}/{LLM_CONFIG['max_retries']} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# === EXECUTOR ===
+
+class LLMExecutor:
+    """
+    Bounded pool; queue ordered by (priority, sender's pending count, arrival).
+    Alert jobs bypass the pool on their own small pool (alert_workers threads, FIFO queue of
+    alert_queue_max), so a busy pool never delays them and an alert storm cannot spawn a
+    thread per alert. Background jobs never hold more than max_background workers
+    (at most workers - 1, so one worker stays free for chat). With max_background = 0 a
+    background job only starts when nothing else is queued and the whole pool is idle.
+    """
+
+    def __init__(self, workers, queue_max, max_per_sender, max_background=1,
+                 alert_workers=1, alert_queue_max=20):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.max_per_sender = max_per_sender
+        self.max_background = max(0, min(max_background, workers - 1))
+        self.alert_workers = max(1, alert_workers)
+        self.alert_queue_max = alert_queue_max
+        self._alerts = deque()
+        self._alert_cond = threading.Condition()
+        self._alert_threads = []
+        self._background_running = 0
+        self._running = 0    # Pool jobs running (alerts excluded)
+        self._heap = []
+        self._pending = {}   # sender -> queued + running jobs
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def queued(self):
+        with self._cond:
+            queued = len(self._heap)
+        with self._alert_cond:
+            return queued + len(self._alerts)
+
+    def submit(self, fn, *args, sender=None, priority=PRIORITY_CHAT):
+        """
+        Queue fn(*args) for a worker. Returns False (job dropped) when the queue is full
+        or the sender already has `max_per_sender` jobs pending. Alerts go to the alert pool
+        (never stuck behind a busy pool); they are only dropped when its queue is full.
+        """
+        if priority <= PRIORITY_ALERT:
+            return self._submit_alert(fn, args)
+        with self._cond:
+            pending = self._pending.get(sender, 0) if sender else 0
+            if len(self._heap) >= self.queue_max or (sender and pending >= self.max_per_sender):
+                _count("rejected")
+                print(f"⛔ LLM queue: job from {sender or '-'} rejected (queued={len(self._heap)}, pending={pending})")
+                return False
+            if sender:
+                self._pending[sender] = pending + 1
+            # A sender's 2nd job sorts behind everyone's 1st job in the same lane
+            heapq.heappush(self._heap, (priority, pending, next(self._seq), sender, fn, args))
+            _count("submitted")
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._cond.notify()
+        return True
+
+    def _submit_alert(self, fn, args):
+        with self._alert_cond:
+            if len(self._alerts) >= self.alert_queue_max:
+                _count("rejected")
+                print(f"⛔ LLM alert queue full ({len(self._alerts)}), alert job rejected")
+                return False
+            self._alerts.append((fn, args))
+            _count("submitted")
+            while len(self._alert_threads) < self.alert_workers:
+                t = threading.Thread(target=self._run_alerts, daemon=True)
+                t.start()
+                self._alert_threads.append(t)
+            self._alert_cond.notify()
+        return True
+
+    def _run_alerts(self):
+        while True:
+            with self._alert_cond:
+                while not self._alerts:
+                    self._alert_cond.wait()
+                fn, args = self._alerts.popleft()
+            self._execute(PRIORITY_ALERT, None, fn, args)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Heap top is background only when nothing more important is queued
+                while not self._heap or (self._heap[0][0] >= PRIORITY_BACKGROUND
+                                         and not self._background_slot()):
+                    self._cond.wait()
+                level, _, _, sender, fn, args = heapq.heappop(self._heap)
+                self._running += 1
+                if level >= PRIORITY_BACKGROUND:
+                    self._background_running += 1
+            self._execute(level, sender, fn, args, pooled=True)
+
+    def _background_slot(self):
+        if self.max_background == 0:
+            return self._running == 0
+        return self._background_running < self.max_background
+
+    def _execute(self, level, sender, fn, args, pooled=False):
+        try:
+            with priority(level):
+                fn(*args)
+        except Exception as e:
+            print(f"⚠️ LLM job error: {e}")
+        finally:
+            with self._cond:
+                if pooled:
+                    self._running -= 1
+                    if level >= PRIORITY_BACKGROUND:
+                        self._background_running -= 1
+                    self._cond.notify()
+                if sender:
+                    left = self._pending.get(sender, 1) - 1
+                    if left > 0:
+                        self._pending[sender] = left
+                    else:
+                        self._pending.pop(sender, None)
+
+
+executor = LLMExecutor(LLM_CONFIG["workers"], LLM_CONFIG["queue_max"], LLM_CONFIG["max_per_sender"],
+                       LLM_CONFIG["max_background"], LLM_CONFIG["alert_workers"], LLM_CONFIG["alert_queue_max"])
+
+
+def submit(fn, *args, sender=None, priority=PRIORITY_CHAT):
+    return executor.submit(fn, *args, sender=sender, priority=priority)
+
+
+if __name__ == "__main__":
+    # Test module
+    print("=== LLM Executor Test ===")
+    done = []
+
+    def job(name):
+        call(lambda: time.sleep(0.05), est_tokens=10)
+        done.append(name)
+
+    for i in range(3):
+        submit(job, f"A{i}", sender="+62A")
+    submit(job, "B0", sender="+62B")
+    submit(job, "ALERT", priority=PRIORITY_ALERT)
+    time.sleep(1)
+    print(done, get_stats())
@@ -0,0 +1,328 @@
+"""
+Matrix Engine Module
+====================
+Matrix Diagnosis yang dikompilasi sekali (per load config) ke array NumPy.
+
+Fitur:
+1. Kode sel per diagnosis x kolom: PASS / FAIL / lainnya / don't-care ('?', '', '-')
+2. Mask required-PASS, required-FAIL, care, depth weight dan prior per layout parameter
+3. Scoring satu snapshot atau batch ribuan snapshot (backtest) dengan operasi array
+4. Top-k via inverted index (parameter, PASS/FAIL) -> diagnosis + pruning upper bound
+5. Bobot per parameter dari baris 2 (ditulis Rule2Matrix.gs, default 1)
+6. Simulasi what-if batch (snapshot eksplisit / grid parameter '?') + kontribusi per kondisi
+Hasil identik dengan loop Python di matrix_reference.match_matrix_loop.
+"""
+
+import itertools
+import numpy as np
+from matrix_reference import SCORING_DATA_WEIGHT, SCORING_PRIOR_WEIGHT, DEPTH_CAP
+
+DIAG_COL = 2
+FREQ_COL = 1
+WEIGHT_ROW = 1  # Baris 2 di Sheet (index 1 di matrix_data)
+DEFAULT_WEIGHT = 1.0
+MAX_GRID_SNAPSHOTS = 4096
+
+CELL_DONT_CARE = 0
+CELL_PASS = 1
+CELL_FAIL = 2
+CELL_OTHER = 3  # Dihitung sebagai kondisi tapi tidak pernah match
+
+
+def _is_diagnosis_row(row):
+    if len(row) <= DIAG_COL:
+        return False
+    name = row[DIAG_COL].strip()
+    return bool(name) and name != "-" and not name.startswith("COST")
+
+
+def _parse_freq(row):
+    try:
+        return float(row[FREQ_COL].strip())
+    except:
+        return 0
+
+
+def parse_weights(matrix_data):
+    """Bobot per kolom dari baris 2 (kosong / bukan angka / negatif -> 1)."""
+    n_cols = len(matrix_data[0]) if matrix_data else 0
+    weights = [DEFAULT_WEIGHT] * n_cols
+    if len(matrix_data) <= WEIGHT_ROW or _is_diagnosis_row(matrix_data[WEIGHT_ROW]):
+        return weights  # Matrix lama tanpa baris bobot
+    row = matrix_data[WEIGHT_ROW]
+    for c in range(min(n_cols, len(row))):
+        try:
+            w = float(str(row[c]).replace(",", "."))
+            weights[c] = w if w >= 0 else DEFAULT_WEIGHT
+        except ValueError:
+            pass
+    return weights
+
+
+def _cell_code(val):
+    val = val.strip().upper()
+    if val in ("?", "", "-"):
+        return CELL_DONT_CARE
+    if val == "PASS":
+        return CELL_PASS
+    if val == "FAIL":
+        return CELL_FAIL
+    return CELL_OTHER
+
+
+class CompiledMatrix:
+    """Matrix Diagnosis dalam bentuk array; layout parameter di-cache per set nama parameter."""
+
+    def __init__(self, matrix_data):
+        self.headers = [h.strip() for h in matrix_data[0]] if matrix_data else []
+        # Kolom parameter (setelah Index/Frequency/Diagnosis, tanpa kolom Cost)
+        self.parameters = [h for h in self.headers[DIAG_COL + 1:] if h and "cost" not in h.lower()]
+        self.weights = np.array(parse_weights(matrix_data), dtype=float)
+        rows = [row for row in matrix_data[1:] if _is_diagnosis_row(row)]
+
+        self.names = [row[DIAG_COL].strip() for row in rows]
+        freqs = [_parse_freq(row) for row in rows]
+        total_freq = sum(freqs) if freqs else 1
+        self.freq = np.array(freqs, dtype=float)
+        self.prior = self.freq / total_freq if total_freq > 0 else np.zeros(len(rows))
+
+        n_cols = len(self.headers)
+        self.codes = np.zeros((len(rows), n_cols), dtype=np.int8)
+        for r, row in enumerate(rows):
+            for c in range(min(n_cols, len(row))):
+                self.codes[r, c] = _cell_code(row[c])
+
+        self._layouts = {}
+
+    def layout(self, param_names):
+        """
+        Mask untuk parameter yang ada di matrix (urutan kolom seperti _match_matrix).
+        Returns: dict params, pass_mask, fail_mask, care_mask, total, depth
+        """
+        key = frozenset(param_names)
+        cached = self._layouts.get(key)
+        if cached is not None:
+            return cached
+
+        param_cols = {}
+        for i, h in enumerate(self.headers):
+            if h in key:
+                param_cols[h] = i
+
+        cols = list(param_cols.values())
+        sub = self.codes[:, cols]
+        weights = self.weights[cols]
+        care = sub != CELL_DONT_CARE
+        total = care.sum(axis=1)
+        depth = np.minimum(total, DEPTH_CAP) / DEPTH_CAP
+        pass_mask = (sub == CELL_PASS).astype(np.int32)
+        fail_mask = (sub == CELL_FAIL).astype(np.int32)
+
+        # Inverted index: (param, PASS/FAIL) -> diagnosis rows requiring it
+        postings = {}
+        for j, param in enumerate(param_cols):
+            postings[(param, "PASS")] = np.flatnonzero(sub[:, j] == CELL_PASS)
+            postings[(param, "FAIL")] = np.flatnonzero(sub[:, j] == CELL_FAIL)
+
+        # Best score a row can reach (every condition matched); rows in descending
+        # upper-bound order, ties by row index like the stable sort in rank()
+        upper = (100.0 * depth * SCORING_DATA_WEIGHT) + (self.prior * 100 * SCORING_PRIOR_WEIGHT)
+        cached = {
+            "params": list(param_cols.keys()),
+            "cols": cols,
+            "pass_mask": pass_mask,
+            "fail_mask": fail_mask,
+            "care_mask": care,
+            "total": total,
+            "depth": depth,
+            # Weighted variants: matched weight / required weight drives match_ratio
+            "pass_w": pass_mask * weights,
+            "fail_w": fail_mask * weights,
+            "total_w": care @ weights,
+            "postings": postings,
+            "upper": upper,
+            "upper_order": np.argsort(-upper, kind="stable"),
+        }
+        self._layouts[key] = cached
+        return cached
+
+    def _state(self, snapshots, params):
+        """PASS / FAIL indicator matrices (n_snapshot, n_param); param hilang = FAIL, '?' = bukan keduanya."""
+        values = [[snap.get(p, "FAIL") for p in params] for snap in snapshots]
+        shape = (len(snapshots), len(params))
+        passed = np.array([[v == "PASS" for v in row] for row in values], dtype=np.int32).reshape(shape)
+        failed = np.array([[v == "FAIL" for v in row] for row in values], dtype=np.int32).reshape(shape)
+        return passed, failed
+
+    def _final(self, lay, rows, matched_w):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            match_ratio = matched_w / lay["total_w"][rows] * 100
+        weighted = match_ratio * lay["depth"][rows]
+        return (weighted * SCORING_DATA_WEIGHT) + (self.prior[rows] * 100 * SCORING_PRIOR_WEIGHT)
+
+    def _keep(self, lay, rows, matched):
+        return (lay["total"][rows] > 0) & (lay["total_w"][rows] > 0) & (matched > 0)
+
+    def score_snapshots(self, snapshots):
+        """
+        Score banyak snapshot sekaligus (semua harus punya set parameter yang sama).
+
+        Returns:
+            (layout, matched, matched_w, final_score) - berbentuk (n_snapshot, n_diagnosis)
+        """
+        lay = self.layout(snapshots[0].keys() if snapshots else [])
+        passed, failed = self._state(snapshots, lay["params"])
+        matched = passed @ lay["pass_mask"].T + failed @ lay["fail_mask"].T
+        matched_w = passed @ lay["pass_w"].T + failed @ lay["fail_w"].T
+        final = self._final(lay, slice(None), matched_w)
+        return lay, matched, matched_w, final
+
+    def score(self, snapshots, top_k=None, min_score=None, explain=False):
+        """
+        Satu-satunya fungsi scoring (bot, backtest, simulator): ranking weighted per snapshot.
+        top_k: hanya k terbaik (satu snapshot: inverted index + pruning); min_score: buang skor
+        di bawahnya; explain: kontribusi tiap kondisi. Returns: list results per snapshot.
+        """
+        if len(snapshots) == 1 and top_k:
+            return [self.top_k(snapshots[0], top_k, min_score, explain)]
+        ranked = self.rank_batch(snapshots, top_k, explain)
+        if min_score is None:
+            return ranked
+        return [[r for r in results if r["final_score"] >= min_score] for results in ranked]
+
+    def parameter_weights(self):
+        """Bobot per parameter dari kolom yang dipakai scoring (header dobel -> kolom terakhir, seperti layout())."""
+        lay = self.layout(self.parameters)
+        return {p: float(self.weights[c]) for p, c in zip(lay["params"], lay["cols"])}
+
+    def rank(self, snapshot):
+        """Hasil ranking satu snapshot, format sama dengan diagnosis_engine._match_matrix."""
+        lay, matched, matched_w, final = self.score_snapshots([snapshot])
+        return self._results(lay, snapshot, matched[0], matched_w[0], final[0])
+
+    def top_k(self, snapshot, k, min_score=None, explain=False):
+        """
+        Top-k ranking (same order as rank()[:k]) scoring only diagnoses touched by the
+        snapshot, in upper-bound order, stopping once no remaining row can enter the top k.
+        min_score: rows that cannot reach it are skipped too (results below it are dropped).
+        """
+        lay = self.layout(snapshot.keys())
+        n = len(self.names)
+        params = lay["params"]
+        touched = np.zeros(n, dtype=bool)
+        for param in params:
+            posting = lay["postings"].get((param, snapshot.get(param, "FAIL")))
+            if posting is not None:
+                touched[posting] = True
+
+        order = lay["upper_order"][touched[lay["upper_order"]]]
+        upper = lay["upper"]
+        passed, failed = self._state([snapshot], params)
+        passed, failed = passed[0], failed[0]
+        floor = min_score if min_score is not None else -np.inf
+
+        best = []  # (score, row) sorted by score desc, row asc
+        block = max(4 * k, 64)
+        for start in range(0, len(order), block):
+            rows = order[start:start + block]
+            cutoff = best[k - 1][0] if len(best) >= k else -np.inf
+            if upper[rows[0]] < max(cutoff, floor):
+                break  # Upper bounds only go down from here
+            matched = lay["pass_mask"][rows] @ passed + lay["fail_mask"][rows] @ failed
+            matched_w = lay["pass_w"][rows] @ passed + lay["fail_w"][rows] @ failed
+            final = self._final(lay, rows, matched_w)
+            keep = self._keep(lay, rows, matched)
+            best.extend((float(final[i]), int(rows[i])) for i in np.flatnonzero(keep) if final[i] >= floor)
+            best.sort(key=lambda x: (-x[0], x[1]))
+            del best[k:]
+
+        if not best:
+            return []
+        rows = np.array([r for _, r in best])
+        matched = np.zeros(n, dtype=np.int64)
+        matched_w = np.zeros(n)
+        matched[rows] = lay["pass_mask"][rows] @ passed + lay["fail_mask"][rows] @ failed
+        matched_w[rows] = lay["pass_w"][rows] @ passed + lay["fail_w"][rows] @ failed
+        final = np.zeros(n)
+        final[rows] = [s for s, _ in best]
+        return self._build(lay, snapshot, rows, matched, matched_w, final, explain)
+
+    def rank_batch(self, snapshots, top_k=None, explain=False):
+        """Ranking untuk setiap snapshot (list of results, dipotong ke top_k bila diisi)."""
+        if not snapshots:
+            return []
+        lay, matched, matched_w, final = self.score_snapshots(snapshots)
+        return [self._results(lay, snap, matched[i], matched_w[i], final[i], top_k, explain)
+                for i, snap in enumerate(snapshots)]
+
+    def simulate(self, snapshots, top_k=5, explain=True):
+        """
+        What-if scoring untuk simulator: parameter yang tidak disebut dianggap '?'
+        (tidak diketahui), hasil berisi kontribusi tiap kondisi (explain=True).
+        Returns: (snapshot lengkap, results per snapshot)
+        """
+        full = [{p: str(snap.get(p, "?")).upper() for p in self.parameters} for snap in snapshots]
+        return full, self.score(full, top_k, explain=explain)
+
+    def grid(self, base, params=None, max_snapshots=MAX_GRID_SNAPSHOTS):
+        """Semua kombinasi PASS/FAIL untuk parameter '?' di base (atau hanya `params`)."""
+        base = {p: str(base.get(p, "?")).upper() for p in self.parameters}
+        if params:
+            params = [p for p in params if p in base]
+        else:
+            params = [p for p in self.parameters if base[p] == "?"]
+        if 2 ** len(params) > max_snapshots:
+            raise ValueError(f"Grid over {len(params)} parameters = {2 ** len(params)} snapshots (max {max_snapshots})")
+        snapshots = []
+        for combo in itertools.product(("PASS", "FAIL"), repeat=len(params)):
+            snap = dict(base)
+            snap.update(zip(params, combo))
+            snapshots.append(snap)
+        return snapshots
+
+    def _results(self, lay, snapshot, matched, matched_w, final, top_k=None, explain=False):
+        keep = np.flatnonzero(self._keep(lay, slice(None), matched))
+        order = keep[np.argsort(-final[keep], kind="stable")][:top_k]
+        return self._build(lay, snapshot, order, matched, matched_w, final, explain)
+
+    def _contributions(self, lay, snapshot, r, hit):
+        """Poin tiap kondisi ke final_score (hanya kondisi yang match menyumbang)."""
+        per_weight = 100 * lay["depth"][r] * SCORING_DATA_WEIGHT / lay["total_w"][r]
+        items = []
+        for c in np.flatnonzero(lay["care_mask"][r]):
+            col = lay["cols"][c]
+            weight = float(self.weights[col])
+            items.append({
+                "param": lay["params"][c],
+                "required": {CELL_PASS: "PASS", CELL_FAIL: "FAIL"}.get(int(self.codes[r, col]), "OTHER"),
+                "observed": snapshot.get(lay["params"][c], "FAIL"),
+                "weight": weight,
+                "matched": bool(hit[c]),
+                "points": float(weight * per_weight) if hit[c] else 0.0,
+            })
+        return items
+
+    def _build(self, lay, snapshot, order, matched, matched_w, final, explain=False):
+        total = lay["total"]
+        params = lay["params"]
+        passed, failed = self._state([snapshot], params)
+        passed, failed = passed[0].astype(bool), failed[0].astype(bool)
+        results = []
+        for r in order:
+            care = lay["care_mask"][r]
+            hit = (lay["pass_mask"][r].astype(bool) & passed) | (lay["fail_mask"][r].astype(bool) & failed)
+            missed = [params[c] for c in np.flatnonzero(care & ~hit)]
+            result = {
+                "diagnosis": self.names[r],
+                "final_score": float(final[r]),
+                "match_ratio": float(matched_w[r] / lay["total_w"][r] * 100),
+                "matched": int(matched[r]),
+                "total": int(total[r]),
+                "frequency": float(self.freq[r]),
+                "missed": missed
+            }
+            if explain:
+                result["prior_points"] = float(self.prior[r] * 100 * SCORING_PRIOR_WEIGHT)
+                result["contributions"] = self._contributions(lay, snapshot, r, hit)
+            results.append(result)
+        return results
@@ -0,0 +1,109 @@
+"""
+Matrix Reference Module
+=======================
+Scoring Matrix Diagnosis versi loop Python murni (tanpa numpy).
+
+Fitur:
+1. Fallback diagnosis_engine._match_matrix kalau numpy tidak terpasang
+2. Referensi untuk matrix_engine.CompiledMatrix: ranking harus identik
+"""
+
+# Scoring constants (shared with matrix_engine)
+SCORING_DATA_WEIGHT = 0.7
+SCORING_PRIOR_WEIGHT = 0.3
+DEPTH_CAP = 6
+
+
+def match_matrix_loop(snapshot, matrix_data):
+    """Reference implementation (pure Python) used when numpy is unavailable."""
+    headers = matrix_data[0]
+    rows = matrix_data[1:]
+    
+    # Map columns
+    param_cols = {}
+    diag_col, freq_col = 2, 1
+    
+    for i, h in enumerate(headers):
+        h_clean = h.strip()
+        if h_clean in snapshot:
+            param_cols[h_clean] = i
+    
+    # Per-parameter weights from row 2 (written by Rule2Matrix.gs, default 1)
+    weights = [1.0] * len(headers)
+    weight_row = rows[0] if rows else []
+    weight_name = weight_row[diag_col].strip() if len(weight_row) > diag_col else ""
+    if weight_name in ("", "-") or weight_name.startswith("COST"):
+        for i in range(min(len(headers), len(weight_row))):
+            try:
+                w = float(str(weight_row[i]).replace(",", "."))
+                weights[i] = w if w >= 0 else 1.0
+            except ValueError:
+                pass
+    
+    # Collect frequencies for prior
+    all_freq = []
+    for row in rows:
+        if len(row) <= diag_col: continue
+        d = row[diag_col].strip()
+        if d.startswith("COST") or d == "-" or not d: continue
+        try:
+            all_freq.append(float(row[freq_col].strip()))
+        except:
+            all_freq.append(0)
+    total_freq = sum(all_freq) if all_freq else 1
+    
+    # Score diagnoses
+    results = []
+    for row in rows:
+        if len(row) <= diag_col: continue
+        diag_name = row[diag_col].strip()
+        if diag_name.startswith("COST") or diag_name == "-" or not diag_name:
+            continue
+        
+        try:
+            freq_num = float(row[freq_col].strip())
+        except:
+            freq_num = 0
+        
+        total_cond = 0
+        matched_cond = 0
+        total_weight = 0.0
+        matched_weight = 0.0
+        missed_params = []
+        
+        for param_name, col_idx in param_cols.items():
+            if col_idx >= len(row): continue
+            matrix_val = row[col_idx].strip().upper()
+            if matrix_val in ("?", "", "-"): continue
+            
+            current_val = snapshot.get(param_name, "FAIL")
+            total_cond += 1
+            total_weight += weights[col_idx]
+            if matrix_val == current_val:
+                matched_cond += 1
+                matched_weight += weights[col_idx]
+            else:
+                missed_params.append(param_name)
+        
+        if total_cond == 0 or total_weight == 0:
+            continue
+        
+        match_ratio = matched_weight / total_weight * 100
+        depth_weight = min(total_cond, DEPTH_CAP) / DEPTH_CAP
+        weighted_score = match_ratio * depth_weight
+        prior = freq_num / total_freq if total_freq > 0 else 0
+        final_score = (weighted_score * SCORING_DATA_WEIGHT) + (prior * 100 * SCORING_PRIOR_WEIGHT)
+        
+        if matched_cond > 0:
+            results.append({
+                "diagnosis": diag_name,
+                "final_score": final_score,
+                "match_ratio": match_ratio,
+                "matched": matched_cond,
+                "total": total_cond,
+                "frequency": freq_num,
+                "missed": missed_params
+            })
+    
+    results.sort(key=lambda x: x["final_score"], reverse=True)
+    return results
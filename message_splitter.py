@@ -0,0 +1,136 @@
+"""
+Message Splitter Module
+=======================
+Memecah teks panjang menjadi beberapa pesan WhatsApp (Twilio limit 1600 karakter).
+
+Fitur:
+1. split_message(): potong di batas paragraf, lalu baris, lalu kata (tidak pernah dipotong "...")
+2. StreamSplitter: untuk streaming Gemini, paragraf yang sudah selesai langsung dikirim
+   sebagai pesan <= WA_MAX_CHARS begitu pesan berikutnya mulai terisi
+"""
+
+WA_MAX_CHARS = 1500
+WA_MIN_CHARS = 400  # A streamed message goes out once it has at least this much text
+
+
+def _cut(text, limit, start=0):
+    """
+    -> (head of at most limit chars, cut at a line / word boundary when possible, rest)
+    start: no cut at or before this position (keeps a prefix together with some text)
+    """
+    if len(text) <= limit:
+        return text, ""
+    cut = text.rfind("\n", start, limit)
+    if cut <= start:
+        cut = text.rfind(" ", start, limit)
+    if cut <= start:
+        cut = limit
+    return text[:cut].strip(), text[cut:].strip()
+
+
+def _blocks(text, limit):
+    """Paragraphs of text; paragraphs longer than limit are cut at line / word boundaries."""
+    for para in text.split("\n\n"):
+        para = para.strip()
+        while len(para) > limit:
+            head, para = _cut(para, limit)
+            yield head
+        if para:
+            yield para
+
+
+def split_message(text: str, limit: int = WA_MAX_CHARS) -> list:
+    """Pack paragraphs greedily into messages of at most `limit` chars."""
+    messages, current = [], ""
+    for block in _blocks(text.strip(), limit):
+        candidate = f"{current}\n\n{block}" if current else block
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            messages.append(current)
+            current = block
+    if current:
+        messages.append(current)
+    return messages
+
+
+class StreamSplitter:
+    """Feed streamed text; complete messages are passed to send() as soon as they are final."""
+
+    def __init__(self, send, limit=WA_MAX_CHARS, min_chars=WA_MIN_CHARS, prefix="", suffix=""):
+        self.send = send
+        self.limit = limit
+        self.min_chars = min_chars
+        self.prefix = prefix.strip()  # Glued to the first content block, never sent alone
+        self.suffix = suffix.strip()  # Glued to the last message, never sent alone
+        self.sent = 0
+        self._ready = ""      # Finished paragraphs of the message being built
+        self._head = 0        # Leading chars of _ready (the prefix) that must not be cut off
+        self._partial = ""    # Paragraph still streaming
+
+    def _send(self, text):
+        self.send(text)
+        self.sent += 1
+        self._head = 0
+
+    def _emit(self):
+        if self._ready:
+            self._send(self._ready)
+            self._ready = ""
+
+    def _pack(self, text, tail=0):
+        """
+        Send messages cut off the front of text until the rest fits in one; returns the rest.
+        A rest that would be a short fragment is avoided by splitting the last two evenly.
+        tail: trailing chars (the suffix) that stay in the rest.
+        """
+        while len(text) > self.limit:
+            if len(text) - self.limit < self.min_chars:
+                target, start = len(text) // 2, len(text) - self.limit
+            else:
+                target, start = self.limit, 0
+            head, text = _cut(text, min(target, len(text) - tail), max(start, self._head))
+            self._send(head)
+        return text
+
+    def _add(self, para):
+        if self.prefix:
+            self._ready, self._head = self.prefix, len(self.prefix) + 2
+            self.prefix = ""
+        elif len(self._ready) >= self.min_chars:
+            # Message already long enough -> it is final now that more text follows
+            self._emit()
+        self._ready = self._pack(f"{self._ready}\n\n{para}" if self._ready else para)
+
+    def feed(self, text: str):
+        self._partial += text
+        while "\n\n" in self._partial:
+            para, self._partial = self._partial.split("\n\n", 1)
+            if para.strip():
+                self._add(para.strip())
+
+    def close(self):
+        """End of stream: flush the last paragraph, with the suffix attached to the last message."""
+        for para in self._partial.split("\n\n"):
+            if para.strip():
+                self._add(para.strip())
+        self._partial = ""
+        if self.prefix:  # Nothing was streamed
+            self._ready, self.prefix = self.prefix, ""
+        self._head = 0
+        if self.suffix:
+            text = f"{self._ready}\n\n{self.suffix}" if self._ready else self.suffix
+            self._ready = self._pack(text, tail=len(self.suffix) + 2)
+        self._emit()
+
+
+if __name__ == "__main__":
+    # Test module
+    text = "\n\n".join(f"Paragraf {i}: " + "kata " * 60 for i in range(8))
+    print([len(m) for m in split_message(text)])
+    out = []
+    splitter = StreamSplitter(out.append, prefix="🧠 *JUDUL*", suffix="Ketik 'Menu' untuk kembali.")
+    for i in range(0, len(text), 37):
+        splitter.feed(text[i:i + 37])
+    splitter.close()
+    print([len(m) for m in out], out[-1][-30:])
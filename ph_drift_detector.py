@@ -18,8 +18,10 @@ import math
 try:
     from drive import water_tab
     from thresholds import SOP_THRESHOLDS
+    import sensor_mirror
 except ImportError:
     water_tab = None
+    sensor_mirror = None
     SOP_THRESHOLDS = {"ph": {"min": 6.5, "max": 8.5}}
 
 
@@ -138,48 +140,24 @@ def get_recent_ph_readings(hours: int = 24) -> List[Dict]:
     """
     Ambil data pH dari Water Quality tab dalam window waktu tertentu.
     """
-    if not water_tab:
+    if not water_tab or not sensor_mirror:
         return []
     
     try:
-        all_data = water_tab.get_all_values()
-        if len(all_data) < 2:
-            return []
-        
-        readings = []
+        # Sinkronisasi inkremental ke mirror lokal, lalu query window secara lokal
+        sensor_mirror.sync_water_quality()
         cutoff_time = datetime.now() - timedelta(hours=hours)
         
-        # Column indices (from WATER_HEADERS in drive.py)
-        ts_idx = 0   # Timestamp
-        ph_idx = 5   # pH column
-        device_idx = 2
-        
-        for row in all_data[1:]:
-            try:
-                ts_str = row[ts_idx] if len(row) > ts_idx else ""
-                if not ts_str:
-                    continue
-                
-                ts = datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-                if ts < cutoff_time:
-                    continue
-                
-                ph_str = row[ph_idx] if len(row) > ph_idx else ""
-                if not ph_str or ph_str == "-":
-                    continue
-                
-                ph_val = float(ph_str.replace(",", "."))
-                device = row[device_idx] if len(row) > device_idx else "Unknown"
-                
-                readings.append({
-                    "timestamp": ts,
-                    "ph_value": ph_val,
-                    "device": device
-                })
-            except (ValueError, IndexError):
+        readings = []
+        for row in sensor_mirror.query_water_quality(since=cutoff_time):
+            if row["ph_value"] is None:
                 continue
+            readings.append({
+                "timestamp": row["timestamp"],
+                "ph_value": row["ph_value"],
+                "device": row["device"] if row["device"] is not None else "Unknown"
+            })
         
-        readings.sort(key=lambda x: x["timestamp"])
         return readings
         
     except Exception as e:
@@ -0,0 +1,174 @@
+"""
+Rolling Window Module
+=====================
+Agregat time-window inkremental per kolom untuk rule berjendela, mis.
+"mean(2h) <", "max(24h) >", "slope(6h) <" di Diagnosis_Rules.
+
+Fitur:
+1. add() O(1) amortized: running sum / count / least-squares sums + monotonic deque min/max
+   (sums di-rebuild dari deque sesekali, jadi tidak drift)
+2. Waktu referensi = `now` saat dibaca (jam server): kalau sensor berhenti mengirim,
+   pembacaan lama tetap kedaluwarsa (tanpa `now`: timestamp pembacaan terbaru, untuk replay)
+3. Agregat: mean, min, max, sum, count, slope (perubahan per jam)
+"""
+
+import re
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+# "mean(2h) <", "max (24h) >=", "slope(30m) <"
+WINDOW_OPERATOR_PATTERN = re.compile(
+    r"^\s*(mean|avg|min|max|sum|count|slope)\s*\(\s*(\d+(?:[.,]\d+)?)\s*([mhd])\s*\)\s*(<=|>=|<|>|=)\s*$",
+    re.IGNORECASE
+)
+UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400}
+
+TIMESTAMP_FORMATS = [
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M:%S",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+]
+
+# Running sums drift a little with every subtraction; rebuild them from the deque now and then
+REBUILD_EVERY = 10000
+
+
+def parse_timestamp(ts_str: str) -> Optional[datetime]:
+    ts_str = ts_str.strip() if ts_str else ""
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(ts_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_window_operator(operator: str):
+    """
+    'mean(2h) <' -> {"agg": "mean", "seconds": 7200, "op": "<", "label": "mean 2h"}
+    None jika operator biasa.
+    """
+    m = WINDOW_OPERATOR_PATTERN.match(operator or "")
+    if not m:
+        return None
+    agg, amount, unit, op = m.group(1).lower(), m.group(2).replace(",", "."), m.group(3).lower(), m.group(4)
+    agg = "mean" if agg == "avg" else agg
+    return {
+        "agg": agg,
+        "seconds": float(amount) * UNIT_SECONDS[unit],
+        "op": op,
+        "label": f"{agg} {amount}{unit}",
+    }
+
+
+class RollingWindow:
+    """Time window [latest - seconds, latest] atas pembacaan (timestamp, nilai) yang datang berurutan."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.items = deque()   # (t_seconds, t_hours, value) relative to origin
+        self._min = deque()    # Monotonic increasing values
+        self._max = deque()    # Monotonic decreasing values
+        self.origin = None
+        self.latest = None
+        self.base = 0.0        # Hours; sums are taken relative to this to avoid cancellation
+        self._reset_sums()
+        self._evicted = 0
+
+    def _reset_sums(self):
+        self.s = self.st = self.stt = self.stv = 0.0
+
+    def _offset(self, ts: datetime) -> float:
+        if self.origin is None:
+            self.origin = ts
+        return (ts - self.origin).total_seconds()
+
+    def add(self, ts: datetime, value: float) -> bool:
+        """Tambah satu pembacaan. Pembacaan yang lebih lama dari yang terakhir diabaikan (False)."""
+        if self.latest is not None and ts < self.latest:
+            return False
+        self.latest = ts
+        sec = self._offset(ts)
+        t = sec / 3600.0
+
+        self.items.append((sec, t, value))
+        self._accumulate(t - self.base, value, 1)
+        while self._min and self._min[-1][1] > value:
+            self._min.pop()
+        self._min.append((sec, value))
+        while self._max and self._max[-1][1] < value:
+            self._max.pop()
+        self._max.append((sec, value))
+
+        self._evict(sec - self.seconds)
+        return True
+
+    def _evict(self, cutoff: float):
+        items = self.items
+        while items and items[0][0] < cutoff:
+            _, t, value = items.popleft()
+            self._accumulate(t - self.base, value, -1)
+            self._evicted += 1
+        while self._min and self._min[0][0] < cutoff:
+            self._min.popleft()
+        while self._max and self._max[0][0] < cutoff:
+            self._max.popleft()
+        # Re-anchor when the window has drifted far from base (slope precision) or after many evictions
+        drifted = items and items[-1][1] - self.base > 4 * self.seconds / 3600.0
+        if self._evicted >= REBUILD_EVERY or drifted:
+            self._evicted = 0
+            self.base = items[0][1] if items else 0.0
+            self._reset_sums()
+            for _, t, value in items:
+                self._accumulate(t - self.base, value, 1)
+
+    def _accumulate(self, t: float, value: float, sign: int):
+        self.s += sign * value
+        self.st += sign * t
+        self.stt += sign * t * t
+        self.stv += sign * t * value
+
+    def value(self, agg: str, now: Optional[datetime] = None) -> Optional[float]:
+        """
+        Nilai agregat atas [now - seconds, now] (None kalau window kosong / slope butuh
+        >= 2 titik berbeda waktu). Pembacaan yang sudah lewat dibuang saat dibaca.
+        """
+        if now is not None and self.origin is not None:
+            self._evict((now - self.origin).total_seconds() - self.seconds)
+        n = len(self.items)
+        if agg == "count":
+            return float(n)
+        if n == 0:
+            return None
+        if agg == "mean":
+            return self.s / n
+        if agg == "sum":
+            return self.s
+        if agg == "min":
+            return self._min[0][1]
+        if agg == "max":
+            return self._max[0][1]
+        if agg == "slope":
+            denom = n * self.stt - self.st * self.st
+            if n < 2 or abs(denom) < 1e-12:
+                return None
+            return (n * self.stv - self.st * self.s) / denom
+        return None
+
+
+if __name__ == "__main__":
+    # Test module
+    from datetime import timedelta
+    w = RollingWindow(2 * 3600)
+    start = datetime(2026, 1, 1, 0, 0)
+    for i in range(10):
+        w.add(start + timedelta(minutes=30 * i), 5.0 - 0.25 * i)
+    print(parse_window_operator("mean(2h) <"))
+    print("mean", w.value("mean"), "min", w.value("min"), "max", w.value("max"),
+          "count", w.value("count"), "slope/h", w.value("slope"))
+    print("1 day later, count", w.value("count", now=start + timedelta(days=1)))
@@ -0,0 +1,154 @@
+"""
+Rule Logic Module
+=================
+Bahasa ekspresi kecil untuk kolom F (Logic) di Diagnosis_Rules.
+
+Contoh:
+    SELF AND NOT [Power Outage]
+    SELF OR (High Temp AND Low DO)
+    "Low DO" && !"High Pump"
+
+Fitur:
+1. AND / OR / NOT (juga && || !), kurung, SELF = kondisi rule itu sendiri
+2. Referensi rule lain lewat nama Parameter: [Nama], "Nama" atau kata biasa (Low DO)
+3. Referensi memakai kondisi MENTAH rule lain (bukan hasil logic-nya) → tidak ada siklus
+4. Dikompilasi sekali per config version jadi closure: evaluasi per snapshot ~mikrodetik
+"""
+
+import re
+
+TOKEN_PATTERN = re.compile(r'\s*(\(|\)|&&|\|\||!|"[^"]*"|\[[^\]]*\]|[^\s()!&|"\[\]]+)')
+KEYWORDS = {"AND": "AND", "OR": "OR", "NOT": "NOT", "&&": "AND", "||": "OR", "!": "NOT"}
+SELF_NAMES = {"SELF", "THIS"}
+
+
+def tokenize(text: str):
+    """'SELF AND NOT [Power Outage]' -> [('NAME','SELF'), ('AND',), ('NOT',), ('NAME','Power Outage')]"""
+    tokens, pos, text = [], 0, text.strip()
+    while pos < len(text):
+        m = TOKEN_PATTERN.match(text, pos)
+        if not m:
+            raise ValueError(f"unexpected character at {pos}: {text[pos:pos + 10]!r}")
+        pos = m.end()
+        tok = m.group(1)
+        if tok in ("(", ")"):
+            tokens.append((tok,))
+        elif tok.upper() in KEYWORDS:
+            tokens.append((KEYWORDS[tok.upper()],))
+        elif tok[0] in "\"[":
+            tokens.append(("NAME", tok[1:-1].strip(), True))
+        elif tokens and tokens[-1][0] == "NAME" and not tokens[-1][2]:
+            # Bare words run together into one name: Low DO -> "Low DO"
+            tokens[-1] = ("NAME", tokens[-1][1] + " " + tok, False)
+        else:
+            tokens.append(("NAME", tok, False))
+    return tokens
+
+
+class _Parser:
+    """Recursive descent: or_expr := and_expr (OR and_expr)*; and_expr := not_expr (AND not_expr)*"""
+
+    def __init__(self, tokens, resolve):
+        self.tokens = tokens
+        self.pos = 0
+        self.resolve = resolve  # name -> step index
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        fn = self.or_expr()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"unexpected {self.tokens[self.pos][0]}")
+        return fn
+
+    def or_expr(self):
+        fn = self.and_expr()
+        while self.peek() == "OR":
+            self.take()
+            fn = _or(fn, self.and_expr())
+        return fn
+
+    def and_expr(self):
+        fn = self.not_expr()
+        while self.peek() == "AND":
+            self.take()
+            fn = _and(fn, self.not_expr())
+        return fn
+
+    def not_expr(self):
+        if self.peek() == "NOT":
+            self.take()
+            return _not(self.not_expr())
+        return self.atom()
+
+    def atom(self):
+        kind = self.peek()
+        if kind == "(":
+            self.take()
+            fn = self.or_expr()
+            if self.peek() != ")":
+                raise ValueError("missing )")
+            self.take()
+            return fn
+        if kind == "NAME":
+            return _ref(self.resolve(self.take()[1]))
+        raise ValueError(f"expected condition, got {kind or 'end of text'}")
+
+
+# Closures over `raw` (list of bool, one per rule row)
+def _ref(idx):
+    return lambda raw: raw[idx]
+
+
+def _not(fn):
+    return lambda raw: not fn(raw)
+
+
+def _and(a, b):
+    return lambda raw: a(raw) and b(raw)
+
+
+def _or(a, b):
+    return lambda raw: a(raw) or b(raw)
+
+
+def compile_logic(text: str, self_idx: int, name_index: dict):
+    """
+    Compile one Logic cell.
+
+    Args:
+        text: Isi kolom F
+        self_idx: Index rule pemilik cell
+        name_index: {param.lower(): step index}
+
+    Returns:
+        Closure raw -> bool, atau None kalau cell kosong / hanya SELF / angka (legacy, diabaikan).
+    Raises:
+        ValueError: sintaks salah atau nama rule tidak dikenal
+    """
+    text = (text or "").strip()
+    if not text or text.upper() in SELF_NAMES or re.fullmatch(r"[-+]?\d+(?:[.,]\d+)?", text):
+        return None
+
+    def resolve(name):
+        if name.upper() in SELF_NAMES:
+            return self_idx
+        if name.lower() not in name_index:
+            raise ValueError(f"unknown rule '{name}'")
+        return name_index[name.lower()]
+
+    return _Parser(tokenize(text), resolve).parse()
+
+
+if __name__ == "__main__":
+    # Test module
+    names = {"low do": 0, "power outage": 1, "high temp": 2}
+    fn = compile_logic("SELF AND NOT [Power Outage] OR (High Temp && !Low DO)", 0, names)
+    for raw in ([True, False, False], [True, True, False], [False, True, True], [False, False, False]):
+        print(raw, "->", fn(raw))
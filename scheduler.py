@@ -4,6 +4,7 @@ from ai_helper import check_out_of_range, generate_recommendations, EXPERT_NUMBE
 from forms.daily_form import daily_form_id
 from forms.weekly_form import weekly_form_id
 from drive import log_reading, log_weekly, upload_photo
+import llm_executor
 import os
 
 from twilio.rest import Client
@@ -96,16 +97,25 @@ def notify_experts(user_phone, data, ai_insight=None):
 
     # AI INSIGHT LOGIC
     if ai_insight:
-        rec_msg = f"\n\n🧠 **ANALISA CERDAS GEMINI:**\n{ai_insight}"
+        _send_expert_alert(summary + f"\n\n🧠 **ANALISA CERDAS GEMINI:**\n{ai_insight}")
+        return
+    # Gemini advice runs on the LLM alert lane (its own small pool, ahead of farmer chat),
+    # so the caller (e.g. the diagnosis worker) doesn't wait for it
+    if not llm_executor.submit(_send_with_recommendations, summary, alerts,
+                               priority=llm_executor.PRIORITY_ALERT):
+        _send_expert_alert(summary + "\n\n🧠 *Saran AI:*\nAntrean AI penuh, saran AI tidak tersedia.")
+
+
+def _send_with_recommendations(summary, alerts):
+    recommendations = generate_recommendations(alerts, lang="id")
+    if recommendations:
+        rec_msg = "\n\n🧠 *Saran AI:*\n" + "\n".join(recommendations)
     else:
-        recommendations = generate_recommendations(alerts, lang="id")
-        if recommendations:
-            rec_msg = "\n\n🧠 *Saran AI:*\n" + "\n".join(recommendations)
-        else:
-            rec_msg = "\n\n🧠 *Saran AI:*\nTidak ada anomali yang terdeteksi."
-
-    full_message = summary + rec_msg
-    
+        rec_msg = "\n\n🧠 *Saran AI:*\nTidak ada anomali yang terdeteksi."
+    _send_expert_alert(summary + rec_msg)
+
+
+def _send_expert_alert(full_message):
     # [MODIFIKASI] Tampilkan pesan lengkap (termasuk saran AI) di terminal untuk debug/simulasi
     print("\n" + "="*40)
     print("📢 PESAN UNTUK PAKAR (Termasuk AI):")
@@ -122,6 +132,20 @@ def notify_experts(user_phone, data, ai_insight=None):
 
 
 
+def notify_emergency(emergencies, source):
+    """Page experts immediately with emergency title / value / action (no Sheets read, no AI)."""
+    tanggal = format_date_indonesian()
+    blocks = [f"{e['title']}\n{e['detail']}\n\n*Tindakan:*\n{e['action']}" for e in emergencies]
+    message = f"🚨 *DARURAT* 🚨\n📅 {tanggal} {datetime.now():%H:%M}\n📡 Sumber: {source}\n\n" + "\n\n".join(blocks)
+    print(f"🚨 Emergency page ({source}): {', '.join(e['type'] for e in emergencies)}")
+    for expert in EXPERT_NUMBERS:
+        try:
+            send_whatsapp_message(expert, message)
+            print(f"✅ Emergency sent to expert {expert}")
+        except Exception as e:
+            print(f"❌ Failed to page expert {expert}: {e}")
+
+
 def send_daily_reminder():
     for number in REMINDER_RECIPIENTS:
         send_whatsapp_message(number, "🔔 Sekarang waktunya mengisi formulir harian!")
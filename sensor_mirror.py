@@ -0,0 +1,249 @@
+"""
+Sensor Mirror Module
+====================
+Mirror lokal (SQLite) dari tab 'Water Quality' untuk query time-window cepat.
+
+Fitur:
+1. Sinkronisasi inkremental (hanya baris setelah row index terakhir yang tersimpan)
+   + rebuild otomatis kalau baris di Sheet dihapus/bergeser, dan rebuild berkala untuk edit
+2. Kolom ter-index per timestamp: DO, pH, TDS, Temp beserta nilai ADC
+3. Query window waktu lokal dalam milidetik, tanpa kuota Google Sheets
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from rolling_window import parse_timestamp
+
+# Import from existing modules
+try:
+    import drive
+    import sheets_gateway
+except ImportError:
+    drive = None
+
+
+# === CONFIGURATION ===
+
+MIRROR_DB_PATH = os.getenv("SENSOR_MIRROR_DB", "sensor_mirror.db")
+
+MIRROR_CONFIG = {
+    "min_sync_interval_s": 15,   # Sync paling sering tiap 15 detik (hemat kuota)
+    "sync_batch_rows": 5000,     # Baris per request saat sinkronisasi awal
+    "rebuild_interval_s": int(os.getenv("SENSOR_MIRROR_REBUILD_S", "21600")),  # Edit di Sheet terbawa tiap 6 jam
+}
+
+# Column indices (from WATER_HEADERS in drive.py): A..K
+WATER_COLUMNS = [
+    ("type", 1, "TEXT"), ("device", 2, "TEXT"),
+    ("do_value", 3, "REAL"), ("do_adc", 4, "REAL"),
+    ("ph_value", 5, "REAL"), ("ph_adc", 6, "REAL"),
+    ("tds_value", 7, "REAL"), ("tds_adc", 8, "REAL"),
+    ("temp_value", 9, "REAL"), ("temp_adc", 10, "REAL"),
+]
+LAST_SYNC_COLUMN = "K"
+
+_sync_lock = threading.Lock()
+_last_sync = {"at": 0.0, "rebuilt": time.time()}
+
+
+# === STORAGE ===
+
+def _create_table(conn, table):
+    cols = ", ".join(f"{name} {sql_type}" for name, _, sql_type in WATER_COLUMNS)
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} ("
+        f"row_idx INTEGER PRIMARY KEY, ts TEXT, ts_raw TEXT, {cols})"
+    )
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(MIRROR_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    _create_table(conn, "water_quality")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_water_quality_ts ON water_quality(ts)")
+    return conn
+
+
+def _parse_number(val: str) -> Optional[float]:
+    if not val or val == "-":
+        return None
+    try:
+        return float(val.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _row_to_record(row_idx: int, row: List[str]) -> tuple:
+    ts_raw = row[0] if row else ""
+    ts = parse_timestamp(ts_raw) if ts_raw else None
+    values = []
+    for _, idx, sql_type in WATER_COLUMNS:
+        cell = row[idx] if len(row) > idx else ""
+        values.append(_parse_number(cell) if sql_type == "REAL" else cell)
+    return (row_idx, ts.strftime("%Y-%m-%d %H:%M:%S") if ts else None, ts_raw, *values)
+
+
+# === SYNC ===
+
+def _copy_rows(conn, table, start, overlap_ts_raw=None):
+    """
+    Copy Sheet rows from `start` onward into `table` in batches -> (rows added, last row).
+    With overlap_ts_raw, row `start` is the last row already mirrored: it is only compared,
+    and None is returned when it no longer matches (rows deleted / inserted in the Sheet).
+    """
+    batch = MIRROR_CONFIG["sync_batch_rows"]
+    placeholders = ", ".join("?" * (len(WATER_COLUMNS) + 3))
+    added, last_row = 0, start - 1
+    check_overlap = overlap_ts_raw is not None
+
+    while True:
+        with sheets_gateway.priority(sheets_gateway.PRIORITY_BACKGROUND):
+            values = drive.water_tab.get(f"A{start}:{LAST_SYNC_COLUMN}{start + batch - 1}")
+        full_batch = len(values) == batch
+        if check_overlap:
+            check_overlap = False
+            head = values[0] if values else []
+            if (head[0] if head else "") != overlap_ts_raw:
+                return None
+            values = values[1:]
+            start += 1
+            last_row = start - 1
+        if not values:
+            break
+        records = [_row_to_record(start + i, row) for i, row in enumerate(values)]
+        conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", records)
+        conn.commit()
+        added += len(records)
+        last_row = start + len(values) - 1
+        if not full_batch:
+            break
+        start = last_row + 1
+    return added, last_row
+
+
+def _rebuild(conn):
+    """Copy the whole tab into a scratch table, then swap it in; the old mirror stays if the read fails."""
+    conn.execute("DROP TABLE IF EXISTS water_quality_rebuild")
+    _create_table(conn, "water_quality_rebuild")
+    try:
+        added, last_row = _copy_rows(conn, "water_quality_rebuild", 2)
+    except Exception:
+        conn.execute("DROP TABLE IF EXISTS water_quality_rebuild")
+        raise
+    conn.execute("BEGIN")
+    try:
+        conn.execute("DROP TABLE water_quality")
+        conn.execute("ALTER TABLE water_quality_rebuild RENAME TO water_quality")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_water_quality_ts ON water_quality(ts)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _last_sync["rebuilt"] = time.time()
+    return added, last_row
+
+
+def sync_water_quality(force: bool = False, rebuild: bool = False) -> int:
+    """
+    Tarik baris baru dari 'Water Quality' (setelah row index terakhir di mirror).
+
+    Baris terakhir yang tersimpan ikut dibaca ulang: kalau isinya tidak sama lagi
+    (baris dihapus / disisipkan di Sheet), mirror dibangun ulang dari awal.
+    Mirror juga dibangun ulang tiap rebuild_interval_s supaya edit nilai ikut terbawa.
+    Rebuild mengisi tabel sementara dulu, jadi sync yang gagal tidak mengosongkan mirror.
+
+    Returns:
+        Jumlah baris baru yang disimpan.
+    """
+    if not drive or not drive.water_tab:
+        return 0
+
+    with _sync_lock:
+        if not force and not rebuild and time.time() - _last_sync["at"] < MIRROR_CONFIG["min_sync_interval_s"]:
+            return 0
+
+        # Baris manual yang masih di buffer harus masuk dulu
+        drive.flush_writes(drive.water_tab)
+
+        conn = _connect()
+        try:
+            copied = None
+            if not rebuild and time.time() - _last_sync["rebuilt"] < MIRROR_CONFIG["rebuild_interval_s"]:
+                last = conn.execute(
+                    "SELECT row_idx, ts_raw FROM water_quality ORDER BY row_idx DESC LIMIT 1"
+                ).fetchone()
+                if last:
+                    copied = _copy_rows(conn, "water_quality", last[0], last[1] or "")
+                    if copied is None:
+                        print(f"🪞 Sensor mirror: baris {last[0]} berubah di Sheet (dihapus/bergeser), rebuild")
+                else:
+                    copied = _copy_rows(conn, "water_quality", 2)
+            if copied is None:
+                print("🪞 Sensor mirror: rebuild dari awal")
+                copied = _rebuild(conn)
+            added, last_row = copied
+
+            _last_sync["at"] = time.time()
+            if added:
+                print(f"🪞 Sensor mirror: +{added} baris Water Quality (sampai baris {last_row})")
+            return added
+        finally:
+            conn.close()
+
+
+def rebuild_mirror() -> int:
+    """Hapus mirror lokal dan sinkronisasi ulang dari awal (mis. setelah baris dihapus di Sheet)."""
+    return sync_water_quality(rebuild=True)
+
+
+# === QUERY ===
+
+def query_water_quality(since: Optional[datetime] = None, last_n: Optional[int] = None) -> List[Dict]:
+    """
+    Ambil pembacaan Water Quality dari mirror lokal.
+
+    Args:
+        since: Hanya baris dengan timestamp >= since (None = semua)
+        last_n: Hanya n baris terakhir (urut row index)
+
+    Returns:
+        List of dict (timestamp sebagai datetime), urut dari yang paling lama.
+    """
+    conn = _connect()
+    try:
+        if last_n is not None:
+            rows = conn.execute(
+                "SELECT * FROM (SELECT * FROM water_quality ORDER BY row_idx DESC LIMIT ?) ORDER BY row_idx",
+                (last_n,)
+            ).fetchall()
+        elif since is not None:
+            rows = conn.execute(
+                "SELECT * FROM water_quality WHERE ts >= ? ORDER BY ts, row_idx",
+                (since.strftime("%Y-%m-%d %H:%M:%S"),)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT * FROM water_quality WHERE ts IS NOT NULL ORDER BY ts, row_idx"
+            ).fetchall()
+    finally:
+        conn.close()
+
+    readings = []
+    for row in rows:
+        record = dict(row)
+        record["timestamp"] = datetime.strptime(row["ts"], "%Y-%m-%d %H:%M:%S") if row["ts"] else None
+        readings.append(record)
+    return readings
+
+
+if __name__ == "__main__":
+    # Test module
+    print("=== Sensor Mirror Test ===")
+    print(f"Baris baru: {sync_water_quality(force=True)}")
+    for r in query_water_quality(last_n=5):
+        print(r["ts_raw"], r["do_value"], r["ph_value"], r["temp_value"])
@@ -0,0 +1,219 @@
+"""
+Sheets Gateway Module
+=====================
+Satu pintu untuk semua request Google Sheets (gspread).
+
+Fitur:
+1. Token bucket sesuai kuota project (default 60 request/menit)
+2. Priority lane: emergency diagnosis didahulukan dari lookup menu / sync background
+3. Exponential backoff + jitter untuk 429 / 5xx (write non-idempotent hanya di-retry pada 429)
+4. Counter per label (calls, errors, retries, waktu tunggu)
+"""
+
+import os
+import time
+import heapq
+import random
+import threading
+import itertools
+from contextlib import contextmanager
+
+try:
+    from gspread.exceptions import APIError
+except ImportError:
+    APIError = None
+
+
+# === CONFIGURATION ===
+
+GATEWAY_CONFIG = {
+    "quota_per_minute": int(os.getenv("SHEETS_QUOTA_PER_MINUTE", "60")),
+    "burst": int(os.getenv("SHEETS_QUOTA_BURST", "10")),
+    "max_retries": 5,
+    "backoff_base_s": 1.0,
+    "backoff_max_s": 32.0,
+}
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# A 5xx on these may come AFTER the server committed the write -> retrying duplicates rows/tabs.
+# They are retried on 429 only (rejected before anything was written).
+NON_IDEMPOTENT_METHODS = {
+    "append_row", "append_rows", "values_append", "add_worksheet",
+    "insert_row", "insert_rows", "insert_cols", "delete_rows", "delete_columns", "duplicate",
+}
+
+# Priority lanes (angka kecil = didahulukan)
+PRIORITY_EMERGENCY = 0
+PRIORITY_DIAGNOSIS = 1
+PRIORITY_NORMAL = 2
+PRIORITY_BACKGROUND = 3
+
+
+# === PRIORITY CONTEXT ===
+
+_local = threading.local()
+
+
+@contextmanager
+def priority(level):
+    """Semua request Sheets di dalam blok ini (thread yang sama) memakai lane `level`."""
+    previous = getattr(_local, "priority", None)
+    # Nested block tidak boleh menurunkan prioritas yang sudah lebih tinggi
+    _local.priority = level if previous is None else min(previous, level)
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    level = getattr(_local, "priority", None)
+    return PRIORITY_NORMAL if level is None else level
+
+
+# === TOKEN BUCKET ===
+
+class TokenBucket:
+    """Token bucket dengan antrean prioritas: token berikutnya selalu untuk waiter terpenting."""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, level=PRIORITY_NORMAL):
+        """Ambil satu token (blocking). Returns: detik menunggu."""
+        started = time.monotonic()
+        ticket = (level, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiters[0] == ticket and self.tokens >= 1:
+                        self.tokens -= 1
+                        return time.monotonic() - started
+                    if self._waiters[0] == ticket:
+                        timeout = (1 - self.tokens) / self.rate
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def penalize(self):
+        """Server bilang kuota habis: kosongkan bucket supaya semua lane ikut mengerem."""
+        with self._cond:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+
+_bucket = TokenBucket(GATEWAY_CONFIG["quota_per_minute"], GATEWAY_CONFIG["burst"])
+
+
+# === STATS ===
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _count(label, key, amount=1):
+    with _stats_lock:
+        entry = _stats.setdefault(label, {"calls": 0, "errors": 0, "retries": 0, "wait_s": 0.0})
+        entry[key] += amount
+
+
+def get_stats():
+    """Snapshot counter per label."""
+    with _stats_lock:
+        return {label: dict(entry) for label, entry in _stats.items()}
+
+
+# === CALL ===
+
+def _status_of(error):
+    if APIError is None or not isinstance(error, APIError):
+        return None
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def may_have_committed(error):
+    """False only when the server certainly rejected the request (429 / other 4xx)."""
+    status = _status_of(error)
+    return status is None or status >= 500
+
+
+def call(fn, *args, label=None, level=None, idempotent=True, **kwargs):
+    """
+    Jalankan satu request gspread lewat limiter + retry.
+
+    Args:
+        fn: Method gspread (mis. ws.get_all_values)
+        label: Nama untuk counter (default: nama fungsi)
+        level: Priority lane (default: dari context `priority()`)
+        idempotent: False untuk append / create -> hanya 429 yang di-retry
+    """
+    label = label or getattr(fn, "__qualname__", None) or getattr(fn, "__name__", "sheets")
+    level = current_priority() if level is None else level
+
+    attempt = 0
+    while True:
+        waited = _bucket.acquire(level)
+        _count(label, "calls")
+        if waited:
+            _count(label, "wait_s", waited)
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            status = _status_of(e)
+            retryable = status in RETRYABLE_STATUS and (idempotent or status == 429)
+            if not retryable or attempt >= GATEWAY_CONFIG["max_retries"]:
+                _count(label, "errors")
+                raise
+            if status == 429:
+                _bucket.penalize()
+            delay = min(GATEWAY_CONFIG["backoff_max_s"], GATEWAY_CONFIG["backoff_base_s"] * (2 ** attempt))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            attempt += 1
+            _count(label, "retries")
+            print(f"⏳ Sheets {status} on {label}, retry {attempt}/{GATEWAY_CONFIG['max_retries']} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def gated(obj, name):
+    """Bungkus method gspread `obj.name` sehingga selalu lewat gateway."""
+    fn = getattr(obj, name)
+    label = f"{getattr(obj, 'title', type(obj).__name__)}.{name}"
+    idempotent = name not in NON_IDEMPOTENT_METHODS
+
+    def wrapper(*args, **kwargs):
+        return call(fn, *args, label=label, idempotent=idempotent, **kwargs)
+    return wrapper
+
+
+if __name__ == "__main__":
+    # Test module
+    print("=== Sheets Gateway Test ===")
+    counter = {"n": 0}
+
+    def fake_request():
+        counter["n"] += 1
+        return counter["n"]
+
+    with priority(PRIORITY_EMERGENCY):
+        for _ in range(3):
+            call(fake_request, label="fake")
+    print(get_stats())
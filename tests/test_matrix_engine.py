@@ -0,0 +1,78 @@
+import itertools
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from matrix_engine import CompiledMatrix
+from matrix_reference import match_matrix_loop
+
+HEADERS = ["Index", "Frequency", "Diagnosis", "Low DO", "High DO", "Low pH", "High Temp", "Power Outage", "Cost ($)"]
+
+# Row 2 = weights; A/B tie (same conditions and frequency), C/D differ only by prior,
+# E has a non-numeric frequency and an OTHER cell, COST rows are skipped
+MATRIX = [
+    HEADERS,
+    ["", "", "", "2", "1", "1.5", "", "3", ""],
+    ["1", "4", "Aerasi kurang A", "PASS", "FAIL", "?", "", "FAIL", "100"],
+    ["2", "4", "Aerasi kurang B", "PASS", "FAIL", "?", "", "FAIL", "200"],
+    ["3", "1", "Suhu tinggi jarang", "?", "?", "FAIL", "PASS", "-", "50"],
+    ["4", "9", "Suhu tinggi sering", "?", "?", "FAIL", "PASS", "-", "50"],
+    ["5", "x", "Listrik mati", "PASS", "?", "?", "?", "PASS", "0"],
+    ["6", "2", "pH turun", "FAIL", "FAIL", "PASS", "FAIL", "MAYBE", "10"],
+    ["7", "1", "COST TOTAL", "PASS", "", "", "", "", ""],
+]
+
+PARAMS = ["Low DO", "High DO", "Low pH", "High Temp", "Power Outage"]
+
+
+def _snapshots():
+    for combo in itertools.product(("PASS", "FAIL", "?"), repeat=len(PARAMS)):
+        yield dict(zip(PARAMS, combo))
+    # Partial snapshots: parameters missing from the snapshot are not scored
+    yield {"Low DO": "PASS", "Power Outage": "PASS"}
+    yield {"High Temp": "PASS", "Unknown Param": "PASS"}
+
+
+def _assert_same(got, expected):
+    assert [r["diagnosis"] for r in got] == [r["diagnosis"] for r in expected]
+    for g, e in zip(got, expected):
+        assert g["final_score"] == pytest.approx(e["final_score"])
+        assert g["match_ratio"] == pytest.approx(e["match_ratio"])
+        assert (g["matched"], g["total"], g["missed"]) == (e["matched"], e["total"], e["missed"])
+        assert g["frequency"] == e["frequency"]
+
+
+@pytest.mark.parametrize("snapshot", list(_snapshots()))
+def test_ranking_matches_python_loop(snapshot):
+    compiled = CompiledMatrix(MATRIX)
+    expected = match_matrix_loop(snapshot, MATRIX)
+    _assert_same(compiled.rank(snapshot), expected)
+    for k in (1, 2, 3):
+        _assert_same(compiled.score([snapshot], top_k=k)[0], expected[:k])
+
+
+def test_batch_matches_python_loop():
+    # A batch shares one parameter set (one layout)
+    snapshots = [snap for snap in _snapshots() if list(snap) == PARAMS]
+    ranked = CompiledMatrix(MATRIX).score(snapshots, top_k=4)
+    for snapshot, results in zip(snapshots, ranked):
+        _assert_same(results, match_matrix_loop(snapshot, MATRIX)[:4])
+
+
+def test_ties_keep_sheet_order_and_priors_break_equal_matches():
+    snapshot = {"Low DO": "PASS", "High DO": "FAIL", "Low pH": "FAIL", "High Temp": "PASS", "Power Outage": "FAIL"}
+    names = [r["diagnosis"] for r in CompiledMatrix(MATRIX).rank(snapshot)]
+    assert names.index("Aerasi kurang A") + 1 == names.index("Aerasi kurang B")
+    assert names.index("Suhu tinggi sering") < names.index("Suhu tinggi jarang")
+
+
+def test_duplicate_header_uses_last_column_for_scores_and_weights():
+    matrix = [
+        ["Index", "Frequency", "Diagnosis", "Low DO", "Low DO"],
+        ["", "", "", "1", "5"],
+        ["1", "1", "A", "FAIL", "PASS"],
+    ]
+    compiled = CompiledMatrix(matrix)
+    assert compiled.parameter_weights() == {"Low DO": 5.0}
+    _assert_same(compiled.rank({"Low DO": "PASS"}), match_matrix_loop({"Low DO": "PASS"}, matrix))
@@ -0,0 +1,62 @@
+from message_splitter import StreamSplitter, split_message, WA_MAX_CHARS, WA_MIN_CHARS
+
+
+def _words(n_chars):
+    return " ".join(f"kata{i}" for i in range(n_chars))[:n_chars].strip()
+
+
+def _stream(text, step, **kwargs):
+    out = []
+    splitter = StreamSplitter(out.append, **kwargs)
+    for i in range(0, len(text), step):
+        splitter.feed(text[i:i + step])
+    splitter.close()
+    return out
+
+
+def _content(messages, prefix="", suffix=""):
+    joined = " ".join(messages)
+    return joined.replace(prefix, "", 1).rsplit(suffix, 1)[0].split()
+
+
+def test_split_message_packs_paragraphs_within_limit():
+    text = "\n\n".join(_words(300) for _ in range(8))
+    messages = split_message(text)
+    assert all(len(m) <= WA_MAX_CHARS for m in messages)
+    assert " ".join(messages).split() == text.split()
+
+
+def test_long_paragraph_with_prefix_and_suffix_has_no_fragments():
+    text = _words(3000)
+    for step in (len(text), 37):
+        messages = _stream(text, step, prefix="HDR", suffix="FOOT")
+        assert len(messages) == 3
+        assert all(WA_MIN_CHARS <= len(m) <= WA_MAX_CHARS for m in messages)
+        assert messages[0].startswith("HDR\n\n")
+        assert messages[-1].endswith("\n\nFOOT")
+        assert _content(messages, "HDR", "FOOT") == text.split()
+
+
+def test_suffix_splits_a_full_last_message_instead_of_going_alone():
+    text = _words(WA_MAX_CHARS - 2)
+    messages = _stream(text, 50, suffix="Ketik 'Menu' untuk kembali.")
+    assert len(messages) == 2
+    assert all(WA_MIN_CHARS <= len(m) <= WA_MAX_CHARS for m in messages)
+    assert messages[-1].endswith("Ketik 'Menu' untuk kembali.")
+
+
+def test_short_answer_is_one_message():
+    assert _stream("Jawaban singkat.", 5, prefix="HDR", suffix="FOOT") == ["HDR\n\nJawaban singkat.\n\nFOOT"]
+
+
+def test_empty_stream_sends_prefix_with_suffix():
+    assert _stream("", 5, prefix="HDR", suffix="FOOT") == ["HDR\n\nFOOT"]
+
+
+def test_finished_paragraphs_are_sent_while_streaming():
+    sent = []
+    splitter = StreamSplitter(sent.append)
+    splitter.feed(_words(500) + "\n\n")
+    assert sent == []
+    splitter.feed(_words(200) + "\n\n")
+    assert len(sent) == 1 and len(sent[0]) == 500
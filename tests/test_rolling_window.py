@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import rolling_window
+from rolling_window import RollingWindow, parse_timestamp, parse_window_operator
+
+START = datetime(2026, 1, 1, 0, 0)
+
+
+def _window(hours, values, step_minutes=30):
+    w = RollingWindow(hours * 3600)
+    for i, value in enumerate(values):
+        w.add(START + timedelta(minutes=step_minutes * i), value)
+    return w
+
+
+def test_parse_window_operator():
+    assert parse_window_operator("mean(2h) <") == {"agg": "mean", "seconds": 7200.0, "op": "<", "label": "mean 2h"}
+    assert parse_window_operator("AVG (1,5d) >=")["seconds"] == 1.5 * 86400
+    assert parse_window_operator("slope(30m) >")["agg"] == "slope"
+    assert parse_window_operator("<") is None
+    assert parse_window_operator("median(2h) <") is None
+
+
+def test_parse_timestamp_formats():
+    assert parse_timestamp("2026-01-01 08:30:00") == datetime(2026, 1, 1, 8, 30)
+    assert parse_timestamp("15/01/2026 08:30:00") == datetime(2026, 1, 15, 8, 30)
+    assert parse_timestamp("not a date") is None
+
+
+def test_readings_older_than_the_window_are_evicted():
+    # 10 readings every 30 min, window 2h -> last 5 (t = 2.0h .. 4.5h) remain
+    w = _window(2, [5.0 - 0.25 * i for i in range(10)])
+    assert w.value("count") == 5
+    assert w.value("mean") == pytest.approx(sum(5.0 - 0.25 * i for i in range(5, 10)) / 5)
+    assert w.value("min") == pytest.approx(2.75)
+    assert w.value("max") == pytest.approx(3.75)
+    assert w.value("sum") == pytest.approx(sum(5.0 - 0.25 * i for i in range(5, 10)))
+    assert w.value("slope") == pytest.approx(-0.5)
+
+
+def test_min_max_follow_evictions():
+    w = _window(1, [9.0, 1.0, 5.0, 4.0, 6.0])  # window keeps t >= 1.0h: 5.0, 4.0, 6.0
+    assert w.value("min") == 4.0
+    assert w.value("max") == 6.0
+
+
+def test_query_time_expires_stale_readings():
+    w = _window(2, [5.0, 4.0, 3.0])
+    assert w.value("count", now=START + timedelta(hours=2, minutes=30)) == 2  # t >= 0.5h kept
+    assert w.value("count", now=START + timedelta(days=1)) == 0
+    assert w.value("mean") is None
+    assert w.value("slope") is None
+
+
+def test_out_of_order_reading_is_ignored():
+    w = _window(2, [5.0, 4.0])
+    assert w.add(START, 100.0) is False
+    assert w.value("max") == 5.0
+
+
+def test_slope_needs_two_distinct_times():
+    w = RollingWindow(3600)
+    w.add(START, 1.0)
+    w.add(START, 2.0)
+    assert w.value("slope") is None
+
+
+def test_sums_stay_exact_across_rebuilds(monkeypatch):
+    monkeypatch.setattr(rolling_window, "REBUILD_EVERY", 7)
+    values = [float(i % 13) for i in range(500)]
+    w = _window(3, values, step_minutes=10)
+    kept = values[-19:]  # 3h window at 10 min steps, both ends included
+    assert w.value("count") == len(kept)
+    assert w.value("mean") == pytest.approx(sum(kept) / len(kept))
+    assert w.value("min") == min(kept)
+    assert w.value("max") == max(kept)
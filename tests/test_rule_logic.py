@@ -0,0 +1,54 @@
+import itertools
+
+import pytest
+
+from rule_logic import compile_logic, tokenize
+
+NAMES = {"low do": 0, "power outage": 1, "high temp": 2}
+
+
+def _truth_table(fn):
+    return {raw: fn(list(raw)) for raw in itertools.product((False, True), repeat=3)}
+
+
+def test_tokenize_joins_bare_words_and_reads_quoted_names():
+    assert tokenize('SELF AND NOT [Power Outage] || "High Temp"') == [
+        ("NAME", "SELF", False), ("AND",), ("NOT",), ("NAME", "Power Outage", True),
+        ("OR",), ("NAME", "High Temp", True),
+    ]
+    assert tokenize("Low DO && High Temp")[0] == ("NAME", "Low DO", False)
+
+
+@pytest.mark.parametrize("text", ["", "  ", "SELF", "this", "1", "0,5"])
+def test_empty_self_and_legacy_numbers_compile_to_none(text):
+    assert compile_logic(text, 0, NAMES) is None
+
+
+def test_and_binds_tighter_than_or():
+    fn = compile_logic("SELF AND NOT [Power Outage] OR (High Temp && !Low DO)", 0, NAMES)
+    table = _truth_table(fn)
+    for (low_do, outage, high_temp), result in table.items():
+        assert result == ((low_do and not outage) or (high_temp and not low_do))
+
+
+def test_parentheses_and_symbol_operators():
+    fn = compile_logic('!(SELF || "Power Outage") && [High Temp]', 0, NAMES)
+    for (low_do, outage, high_temp), result in _truth_table(fn).items():
+        assert result == (not (low_do or outage) and high_temp)
+
+
+def test_self_refers_to_the_owning_rule():
+    fn = compile_logic("NOT SELF", 2, NAMES)
+    assert fn([True, True, False]) is True
+    assert fn([False, False, True]) is False
+
+
+def test_names_are_case_insensitive():
+    fn = compile_logic("low do and POWER OUTAGE", 2, NAMES)
+    assert fn([True, True, False]) is True
+
+
+@pytest.mark.parametrize("text", ["SELF AND", "(SELF OR Low DO", "SELF Low DO)", "Unknown Rule", "SELF @ Low DO"])
+def test_bad_expressions_raise_value_error(text):
+    with pytest.raises(ValueError):
+        compile_logic(text, 0, NAMES)